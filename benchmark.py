@@ -0,0 +1,516 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import date, datetime
+
+# Each measurement runs in a fresh interpreter, so the peak RSS only reflects the code that is measured.
+# The measured code prints a JSON line with the load time in seconds and the peak RSS in MB.
+_MEASURE_TEMPLATE = """
+import json, resource, time
+start = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}}))
+"""
+
+_IMPORTS = "from content_manager import ContentManager\nfrom content_journal import open_content_manager\n"
+
+
+def _measure(code: str, setup: str = _IMPORTS) -> dict:
+    script = setup + _MEASURE_TEMPLATE.format(code=code)
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def benchmark_content_loading(json_path: str = './data/content.json') -> dict:
+    """
+    Compares startup time and peak RSS of loading the legacy content.json with ContentManager.deserialize
+    against loading the same content from a journal store with lazily loaded transcripts.
+
+    Args:
+    json_path (str): Path of a content.json file created by ContentManager.serialize.
+
+    Returns:
+    dict: The measurements of the baseline (interpreter and imports only), legacy and store loading.
+    """
+    json_path = os.path.abspath(json_path)
+    with tempfile.TemporaryDirectory() as store_dir:
+        # import the legacy file once, so that the measured run only loads the snapshot
+        _measure(f"_, journal = open_content_manager({store_dir!r}, {json_path!r})\njournal.close()")
+
+        results = {
+            "baseline": _measure("pass"),
+            "legacy_deserialize": _measure(f"ContentManager().deserialize(open({json_path!r}).read())"),
+            "journal_store": _measure(f"_, journal = open_content_manager({store_dir!r})\njournal.close()"),
+        }
+    return results
+
+
+def _time_per_call(function, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def benchmark_content_manager_indexes(narrative_count: int = 100_000, narratives_per_video: int = 10) -> dict:
+    """
+    Measures the narrative queries of the BFS and the knowledge graph (by iteration and by merged-flag) with the
+    ContentManager indexes against the linear scans they replace, and the cost of remove_narrative, on a synthetic
+    content manager with narrative_count narratives.
+
+    Returns:
+    dict: Seconds per call of each operation.
+    """
+    from content_manager import ContentManager
+    from narrative import Narrative
+    from video import Video
+
+    content_manager = ContentManager()
+    for index in range(narrative_count // narratives_per_video):
+        video = Video()
+        video.video_id = f"video{index:07d}"
+        content_manager.add_video_narratives(video, [f"narrative {index} {i}" for i in range(narratives_per_video)],
+                                             "search term", index % 3 + 1)
+    for start in range(1, narrative_count, 20):  # merged narratives, each based on 20 narratives
+        merged = Narrative(content_manager.next_narrative_id, "merged", 4, based_on=list(range(start, start + 20)))
+        content_manager._register_narrative(merged)
+        for narrative_id in merged.based_on:
+            for video in content_manager.get_videos_for_narrative(narrative_id):
+                content_manager.link_video_narrative(video.video_id, merged.narrative_id)
+
+    narratives = content_manager.narratives
+    results = {
+        "narratives": len(narratives),
+        "by_iteration_scan": _time_per_call(lambda: [n for n in narratives.values() if n.iteration == 4], 10),
+        "by_iteration_index": _time_per_call(lambda: content_manager.get_narratives_by_iteration(4), 10),
+        "merged_scan": _time_per_call(lambda: [n for n in narratives.values() if n.is_merged], 10),
+        "merged_index": _time_per_call(lambda: content_manager.get_merged_narratives(), 10),
+    }
+
+    narrative_ids = iter(range(1, narrative_count, 7))
+    results["remove_narrative"] = _time_per_call(lambda: content_manager.remove_narrative(next(narrative_ids)), 1000)
+    return results
+
+
+def _traced_bytes(build) -> tuple[object, int]:
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def benchmark_object_memory(json_path: str = './data/content.json', scale: int = 50) -> dict:
+    """
+    Measures the memory per video and per narrative (without transcripts) of the slotted Video and Narrative
+    classes against dict-backed replicas of the classes before they were slotted. The videos and narratives of
+    json_path are copied scale times, with unique IDs, to get a corpus large enough to measure.
+
+    Returns:
+    dict: Bytes per video and per narrative of the legacy and slotted representations.
+    """
+    from narrative import Narrative
+    from video import Video
+
+    class LegacyVideo:
+        pass
+
+    class LegacyNarrative:
+        def __init__(self, narrative_id, description, iteration, search_term=None, based_on=None):
+            self.narrative_id = narrative_id
+            self.description = description
+            self.search_term = search_term
+            self.iteration = iteration
+            self.based_on = based_on or []
+
+    data = json.loads(open(json_path).read())
+    video_data = []
+    for copy in range(scale):
+        for video_json in data["videos"].values():
+            video_json = {key: value for key, value in video_json.items() if key != 'transcript'}
+            # copy the strings, like json.loads would create them for a bigger file
+            video_data.append({key: ''.join(value) if isinstance(value, str) else value
+                               for key, value in video_json.items()} | {"video_id": f"{copy}-{video_json['video_id']}"})
+    narrative_data = [dict(narrative_json, search_term=''.join(narrative_json["search_term"] or '') or None)
+                      for _ in range(scale) for narrative_json in data["narratives"].values()]
+
+    def build_legacy_videos():
+        videos = []
+        for video_json in video_data:
+            video = LegacyVideo()
+            video.__dict__.update(video_json)
+            video.published_date = date.fromisoformat(video_json["published_date"][:10]) \
+                if video_json.get("published_date") else None
+            video._transcript = None
+            video._transcript_source = None
+            videos.append(video)
+        return videos
+
+    def build_videos():
+        videos = []
+        for video_json in video_data:
+            video = Video.from_json_data(video_json)
+            video.published_date = date.fromisoformat(video_json["published_date"][:10]) \
+                if video_json.get("published_date") else None
+            videos.append(video)
+        return videos
+
+    results = {"videos": len(video_data), "narratives": len(narrative_data)}
+    for name, build, count in (("legacy_video", build_legacy_videos, len(video_data)),
+                               ("slotted_video", build_videos, len(video_data)),
+                               ("legacy_narrative", lambda: [LegacyNarrative(**n) for n in narrative_data],
+                                len(narrative_data)),
+                               ("slotted_narrative", lambda: [Narrative(**n) for n in narrative_data],
+                                len(narrative_data))):
+        _, size = _traced_bytes(build)
+        results[name] = size / count
+    return results
+
+
+@contextmanager
+def _in_directory(directory: str):
+    # the pipeline writes to ./data, so benchmarks that run it work in a temporary directory
+    previous_directory = os.getcwd()
+    os.makedirs(os.path.join(directory, 'data'), exist_ok=True)
+    os.chdir(directory)
+    try:
+        yield
+    finally:
+        os.chdir(previous_directory)
+
+
+def _llm_summary(report: dict) -> dict:
+    return {"llm_calls": sum(usage["calls"] for usage in report["llm_usage"]),
+            "llm_tokens": sum(usage["prompt_tokens"] + usage["completion_tokens"] for usage in report["llm_usage"]),
+            "estimated_cost": sum(report["cost_per_model"].values())}
+
+
+def benchmark_expansion(max_total_videos: int = 200,
+                        latency: float = 0.02,
+                        failure_rate: float = 0.0,
+                        worker_count: int = 4) -> dict:
+    """
+    Measures the end-to-end throughput of the narrative expansion (search, transcripts, extraction, clustering and
+    search term creation) against the fake services, with the sequential BFS, the pipelined crawler and the
+    sequential BFS with a work queue and worker_count worker threads (worker processes cannot share the fakes).
+
+    Args:
+    max_total_videos (int): The video budget of each run.
+    latency (float): The average latency in seconds of each fake service call.
+    failure_rate (float): The fraction of fake service calls that fail with a transient error.
+    worker_count (int): The number of workers of the work queue.
+
+    Returns:
+    dict: Per mode the seconds, the number of videos, videos per second and the LLM usage.
+    """
+    from content_manager import ContentManager
+    from fakes import fake_services
+    from metrics import get_metrics
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory, _in_directory(directory):
+        from crawler import PipelinedCrawler
+        from main import iterative_narrative_expansion
+        from work_queue import WorkQueue, run_worker
+
+        for mode in ("sequential", "pipelined", "queued"):
+            with fake_services(latency=latency, failure_rate=failure_rate):
+                content_manager = ContentManager()
+                start = time.perf_counter()
+                if mode == "sequential":
+                    iterative_narrative_expansion(content_manager, "Israel Hamas", datetime(2023, 10, 7),
+                                                  max_iterations=3, max_total_videos=max_total_videos)
+                elif mode == "queued":
+                    queue_path = os.path.join(directory, 'work_queue.sqlite')
+                    stop = threading.Event()
+                    workers = [threading.Thread(target=run_worker,
+                                                args=(WorkQueue(queue_path, poll_interval=0.05), f"worker {index}"),
+                                                kwargs={"stop": stop})
+                               for index in range(worker_count)]
+                    for worker in workers:
+                        worker.start()
+                    iterative_narrative_expansion(content_manager, "Israel Hamas", datetime(2023, 10, 7),
+                                                  max_iterations=3, max_total_videos=max_total_videos,
+                                                  work_queue=WorkQueue(queue_path, poll_interval=0.05))
+                    seconds = time.perf_counter() - start
+                    stop.set()
+                    for worker in workers:
+                        worker.join()
+                else:
+                    PipelinedCrawler(content_manager, datetime(2023, 10, 7), max_total_videos).run("Israel Hamas", 3)
+                if mode != "queued":
+                    seconds = time.perf_counter() - start
+                results[mode] = {"seconds": seconds, "videos": len(content_manager.videos),
+                                 "videos_per_second": len(content_manager.videos) / seconds,
+                                 **_llm_summary(get_metrics().report())}
+    return results
+
+
+def benchmark_serialization(video_count: int) -> dict:
+    """
+    Measures ContentManager.serialize and deserialize, and the compact snapshot format of the content store, on a
+    synthetic corpus of video_count videos.
+
+    Returns:
+    dict: Seconds of each operation and the sizes in MB of both formats.
+    """
+    from content_manager import ContentManager
+    from synthetic_corpus import generate_content_manager
+
+    content_manager = generate_content_manager(video_count)
+    results = {"videos": len(content_manager.videos), "narratives": len(content_manager.narratives)}
+
+    start = time.perf_counter()
+    text = content_manager.serialize()
+    results["serialize_seconds"] = time.perf_counter() - start
+    results["json_mb"] = len(text) / 2 ** 20
+
+    start = time.perf_counter()
+    ContentManager().deserialize(text)
+    results["deserialize_seconds"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compact_text = json.dumps(content_manager.to_compact_dict())
+    results["compact_serialize_seconds"] = time.perf_counter() - start
+    results["compact_json_mb"] = len(compact_text) / 2 ** 20
+
+    start = time.perf_counter()
+    ContentManager().load_compact_dict(json.loads(compact_text))
+    results["compact_deserialize_seconds"] = time.perf_counter() - start
+    return results
+
+
+def benchmark_clustering_preparation(video_count: int) -> dict:
+    """
+    Measures the local preparation of clustering the narratives of the first iteration of a synthetic corpus of
+    video_count videos: collapsing near-duplicates and creating the similarity batches of the LLM calls.
+
+    Returns:
+    dict: The number of narratives, representatives and batches, and the seconds of both steps.
+    """
+    from narrative_clustering import _create_similarity_batches
+    from narrative_dedup import collapse_near_duplicates
+    from synthetic_corpus import generate_content_manager
+
+    content_manager = generate_content_manager(video_count)
+    narrative_id_desc_map = {narrative.narrative_id: narrative.description
+                             for narrative in content_manager.get_narratives_by_iteration(1)}
+
+    start = time.perf_counter()
+    representatives, _ = collapse_near_duplicates(narrative_id_desc_map)
+    dedup_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batches = _create_similarity_batches(representatives, max_batch_tokens=3000, max_batch_size=60)
+    return {"narratives": len(narrative_id_desc_map), "representatives": len(representatives),
+            "batches": len(batches), "dedup_seconds": dedup_seconds,
+            "batching_seconds": time.perf_counter() - start}
+
+
+def benchmark_knowledge_graph(video_count: int, latency: float = 0.0) -> dict:
+    """
+    Measures create_knowledge_graph on a synthetic corpus of video_count videos against the fake LLM: a build
+    from scratch and an incremental rebuild without changes.
+
+    Returns:
+    dict: The number of narratives in the graph, the seconds of both builds and the LLM usage of the first.
+    """
+    from fakes import fake_services
+    from knowledge_graph import create_knowledge_graph
+    from metrics import get_metrics
+    from synthetic_corpus import generate_content_manager
+
+    content_manager = generate_content_manager(video_count)
+    results = {"narratives": len(content_manager.get_narratives_by_iteration(4))}
+    with tempfile.TemporaryDirectory() as directory, _in_directory(directory), fake_services(latency=latency):
+        triple_store_path = os.path.join(directory, 'triple_store.json')
+        start = time.perf_counter()
+        create_knowledge_graph(content_manager, triple_store_path)
+        results["build_seconds"] = time.perf_counter() - start
+        results.update(_llm_summary(get_metrics().report()))
+
+        start = time.perf_counter()
+        create_knowledge_graph(content_manager, triple_store_path)
+        results["rebuild_seconds"] = time.perf_counter() - start
+    return results
+
+
+def benchmark_llm_gateway(call_count: int = 300, latency: float = 0.0) -> dict:
+    """
+    Measures LLM calls of triple extraction against the fake chat model: the per-call overhead and median
+    latency of building a chat model, prompt template and LLMChain for every call (as before the pooled gateway)
+    versus reusing the cached chain of the gateway backend, and the duration of extract_triples_batched. The fake
+    model has no HTTP transport, so the gain of reused connections is not included.
+
+    Returns:
+    dict: The mean and median milliseconds per call of both ways, and the seconds of the batched extraction.
+    """
+    from langchain.chains import LLMChain
+    from langchain.prompts import PromptTemplate
+
+    from fakes import FakeBackend, FakeChatOpenAI, fake_services
+    from synthetic_corpus import make_narrative
+    from triples_extraction import TRIPLES_PROMPT, extract_triples_batched
+
+    rng = random.Random(0)
+    narratives = [make_narrative(rng, index % 6) for index in range(call_count)]
+    backend = FakeBackend(latency)
+
+    def rebuilt(narrative):
+        llm = FakeChatOpenAI(model_name='gpt-4-1106-preview', temperature=1, max_tokens=500, latency=latency)
+        chain = LLMChain(llm=llm, prompt=PromptTemplate(input_variables=["narrative"], template=TRIPLES_PROMPT))
+        return chain.invoke({"narrative": narrative})["text"]
+
+    def pooled(narrative):
+        return backend.get_chain(TRIPLES_PROMPT, 'gpt-4-1106-preview', 1, 500).invoke({"narrative": narrative})
+
+    results = {}
+    for name, call in (("rebuilt", rebuilt), ("pooled", pooled)):
+        call(narratives[0])  # warm up
+        durations = []
+        for narrative in narratives:
+            start = time.perf_counter()
+            call(narrative)
+            durations.append(time.perf_counter() - start)
+        results[name] = {"mean_ms": 1000 * statistics.mean(durations), "p50_ms": 1000 * statistics.median(durations)}
+
+    with fake_services(latency=latency):
+        start = time.perf_counter()
+        extract_triples_batched(dict(enumerate(narratives, start=1)))
+        results["batched_extraction_seconds"] = time.perf_counter() - start
+    return results
+
+
+def _import_times(stderr: str) -> dict[str, float]:
+    # cumulative import time in seconds of each top-level import in the output of python -X importtime
+    times = {}
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and not line.endswith('imported package'):
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if not name[1:].startswith(' '):
+                times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def benchmark_startup(json_path: str = './data/content.json', budget_seconds: float = 0.5) -> dict:
+    """
+    Measures the import time (with python -X importtime) and the total run time of `cli.py stats` on a
+    content.json file. The stats command must start without importing the pipeline dependencies, so its imports
+    must stay within budget_seconds.
+
+    Returns:
+    dict: The import and total seconds, the heaviest top-level imports and whether the imports are within budget.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime', 'cli.py', 'stats', os.path.abspath(json_path)],
+                             capture_output=True, text=True, check=True, cwd=directory)
+    total_seconds = time.perf_counter() - start
+
+    import_times = _import_times(process.stderr)
+    import_seconds = sum(import_times.values())
+    heaviest = dict(sorted(import_times.items(), key=lambda item: -item[1])[:5])
+    return {"import_seconds": import_seconds, "total_seconds": total_seconds, "heaviest_imports": heaviest,
+            "within_budget": int(import_seconds <= budget_seconds)}
+
+
+def save_results(results: dict, directory: str = './benchmark_results') -> str:
+    """
+    Saves benchmark results as JSON, named after the time and the git commit they were measured at, so results
+    of different commits can be compared.
+
+    Returns:
+    str: The path of the results file.
+    """
+    def git(*args):
+        return subprocess.run(['git', *args], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+
+    commit = git('rev-parse', 'HEAD') or 'unknown'
+    data = {"commit": commit, "dirty": bool(git('status', '--porcelain', '--untracked-files=no')),
+            "timestamp": datetime.now().isoformat(timespec='seconds'), "python": platform.python_version(),
+            "results": results}
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{datetime.now():%Y%m%d-%H%M%S}-{commit[:10]}.json")
+    with open(path, 'w') as file:
+        json.dump(data, file, indent=2)
+    return path
+
+
+def compare_results(previous_path: str, results: dict) -> None:
+    """
+    Prints the numeric results next to those of a previous results file, with the ratio new / previous.
+    """
+    with open(previous_path) as file:
+        previous = json.load(file)
+    previous_values = dict(_flatten(previous["results"]))
+    print(f"Compared with {previous['commit'][:10]} ({previous['timestamp']}):")
+    for name, value in _flatten(results):
+        if isinstance(previous_values.get(name), (int, float)) and previous_values[name]:
+            print(f"{name:60} {previous_values[name]:12.4g} {value:12.4g} {value / previous_values[name]:6.2f}x")
+
+
+def _flatten(results: dict, prefix: str = ''):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)):
+            yield f"{prefix}{key}", value
+
+
+SUITES = ("loading", "indexes", "memory", "expansion", "serialization", "clustering", "knowledge_graph", "startup",
+          "llm_gateway")
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description="Runs the benchmarks offline and saves the results.")
+    argument_parser.add_argument('--suites', default=','.join(SUITES), help=f"Comma-separated subset of {SUITES}.")
+    argument_parser.add_argument('--sizes', default='1k,10k',
+                                 help="Comma-separated synthetic corpus sizes: 1k, 10k, 100k.")
+    argument_parser.add_argument('--save-dir', default='./benchmark_results', help="Directory of the results files.")
+    argument_parser.add_argument('--compare', help="Results file to compare with.")
+    arguments = argument_parser.parse_args()
+
+    from synthetic_corpus import CORPUS_SIZES
+
+    suites = arguments.suites.split(',')
+    sizes = {name: CORPUS_SIZES[name] for name in arguments.sizes.split(',')}
+    all_results = {}
+    if "loading" in suites:
+        all_results["loading"] = benchmark_content_loading()
+    if "indexes" in suites:
+        all_results["indexes"] = benchmark_content_manager_indexes()
+    if "memory" in suites:
+        all_results["memory"] = benchmark_object_memory()
+    if "expansion" in suites:
+        all_results["expansion"] = benchmark_expansion()
+    if "startup" in suites:
+        all_results["startup"] = benchmark_startup()
+    if "llm_gateway" in suites:
+        all_results["llm_gateway"] = benchmark_llm_gateway()
+    for suite, benchmark in (("serialization", benchmark_serialization),
+                             ("clustering", benchmark_clustering_preparation),
+                             ("knowledge_graph", benchmark_knowledge_graph)):
+        if suite in suites:
+            all_results[suite] = {name: benchmark(size) for name, size in sizes.items()}
+
+    for name, value in _flatten(all_results):
+        print(f"{name:60} {value:12.4g}")
+    print(f"Results saved to {save_results(all_results, arguments.save_dir)}")
+    if arguments.compare:
+        compare_results(arguments.compare, all_results)
+    if "startup" in all_results and not all_results["startup"]["within_budget"]:
+        sys.exit(f"Import time of cli.py stats is over budget; heaviest imports: "
+                 f"{all_results['startup']['heaviest_imports']}")
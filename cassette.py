@@ -0,0 +1,148 @@
+import gzip
+import json
+import logging
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+RECORD = 'record'
+REPLAY = 'replay'
+
+
+class CassetteMissError(Exception):
+    """Exception raised in replay mode when a request is not on the cassette."""
+    pass
+
+
+class ReplayedError(Exception):
+    """Exception replayed from a cassette: the recorded request raised an exception."""
+    pass
+
+
+class Cassette:
+    """
+    Recorded responses of external requests (searches, transcripts and LLM calls), keyed by the kind and a key of
+    the request. A request that is made several times (e.g. an LLM call that is retried because its response could
+    not be parsed) has a response per time; they are replayed in the same order, and the last one is repeated.
+    Exceptions are recorded too and replayed as ReplayedError.
+
+    The cassette file is gzip-compressed JSON.
+    """
+
+    def __init__(self, path: str, mode: str = REPLAY):
+        if mode not in (RECORD, REPLAY):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.entries: dict[tuple[str, str], list[dict]] = {}
+        self._replay_positions: dict[tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+        if mode == REPLAY:
+            self._load()
+
+    def call(self, kind: str, key: str, function):
+        """
+        Records the response of function() for a request, or replays the recorded response.
+
+        Args:
+        kind (str): The kind of request, e.g. "search", "transcript" or "llm".
+        key (str): Identifies the request within its kind.
+        function: Makes the request and returns a JSON-serializable response.
+        """
+        entry_key = (kind, key)
+        if self.mode == REPLAY:
+            with self._lock:
+                responses = self.entries.get(entry_key)
+                if not responses:
+                    raise CassetteMissError(f"No recorded {kind} response for {key[:100]}")
+                position = self._replay_positions.get(entry_key, 0)
+                self._replay_positions[entry_key] = position + 1
+            response = responses[min(position, len(responses) - 1)]
+            if "error" in response:
+                raise ReplayedError(response["error"])
+            return response["value"]
+
+        try:
+            value = function()
+        except Exception as e:
+            with self._lock:
+                self.entries.setdefault(entry_key, []).append({"error": f"{type(e).__name__}: {e}"})
+            raise
+        with self._lock:
+            self.entries.setdefault(entry_key, []).append({"value": value})
+        return value
+
+    def save(self) -> None:
+        """
+        Writes the recorded responses to the cassette file, atomically replacing an older version.
+        """
+        with self._lock:
+            entries = [[kind, key, responses] for (kind, key), responses in self.entries.items()]
+        data = {"version": 1, "entries": entries}
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with gzip.open(self.path + '.tmp', 'wt', encoding='utf-8') as file:
+            json.dump(data, file)
+        os.replace(self.path + '.tmp', self.path)
+
+    def _load(self) -> None:
+        with gzip.open(self.path, 'rt', encoding='utf-8') as file:
+            data = json.load(file)
+        self.entries = {(kind, key): responses for kind, key, responses in data["entries"]}
+
+
+_cassette: Cassette | None = None
+
+
+def through_cassette(kind: str, key: str, function):
+    """
+    Calls function() to make an external request, through the active cassette if there is one.
+    """
+    cassette = _cassette
+    return cassette.call(kind, key, function) if cassette else function()
+
+
+@contextmanager
+def use_cassette(path: str, mode: str = REPLAY):
+    """
+    Context manager that records all external requests to a cassette file, or replays them from it.
+
+    While the cassette is active, the LLM and search caches are disabled and transcripts are stored in a temporary
+    transcript store, so every request reaches the cassette: a recording is complete, and a replay does not depend
+    on the local caches. The cassette is saved when the context is left, also after an exception.
+
+    A replay makes the same requests as the recording only if the run is deterministic: the sequential crawl is, but
+    the order of narratives of a concurrent crawl (and so its clustering prompts) depends on timing. main.main
+    therefore always runs the sequential crawl with a cassette; a PipelinedCrawler can only be recorded and
+    replayed with one worker per stage.
+
+    Args:
+    path (str): The path of the cassette file.
+    mode (str): "record" or "replay".
+    """
+    # imported here, as these modules make their requests through this module
+    from llm_gateway import get_llm_cache, set_llm_cache
+    from search_cache import get_search_cache, set_search_cache
+    from transcript_store import TranscriptStore, get_transcript_store, set_transcript_store
+
+    global _cassette
+    cassette = Cassette(path, mode)
+    previous_llm_cache, previous_search_cache = get_llm_cache(), get_search_cache()
+    previous_transcript_store = get_transcript_store()
+    with tempfile.TemporaryDirectory() as directory:
+        transcript_store = TranscriptStore(os.path.join(directory, 'transcripts.sqlite'))
+        set_llm_cache(None)
+        set_search_cache(None)
+        set_transcript_store(transcript_store)
+        _cassette = cassette
+        try:
+            yield cassette
+        finally:
+            _cassette = None
+            set_llm_cache(previous_llm_cache)
+            set_search_cache(previous_search_cache)
+            set_transcript_store(previous_transcript_store)
+            transcript_store.close()
+            if mode == RECORD:
+                cassette.save()
+                logging.info(f"Cassette with {len(cassette.entries)} requests saved to {path}")
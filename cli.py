@@ -0,0 +1,161 @@
+import argparse
+import json
+import os
+from collections import Counter
+
+# The subcommands import their dependencies when they run: langchain, duckduckgo_search, networkx and pyvis take
+# seconds to import, and stats and export do not need them. Check the startup time with benchmark.py --suites startup.
+
+DEFAULT_CONTENT_PATH = './data/content.json'
+DEFAULT_STORE_DIR = './data/content_store'
+DEFAULT_QUEUE_PATH = './data/work_queue.sqlite'
+
+
+def load_content_manager(source: str):
+    """
+    Loads a content manager from a content.json file or from a journaled content store directory, read-only.
+    """
+    from content_manager import ContentManager
+    from utils import read_from_file
+
+    if os.path.isdir(source):
+        from content_journal import load_content_store
+        return load_content_store(source)
+    content_manager = ContentManager()
+    content_manager.deserialize(read_from_file(source))
+    return content_manager
+
+
+def _default_source() -> str:
+    return DEFAULT_STORE_DIR if os.path.isdir(DEFAULT_STORE_DIR) else DEFAULT_CONTENT_PATH
+
+
+def crawl(arguments) -> None:
+    from main import main
+    main(pipelined=not arguments.sequential, content_store_dir=arguments.store_dir,
+         cassette_path=arguments.cassette, cassette_mode=arguments.cassette_mode, resume=arguments.resume,
+         queue_path=arguments.queue)
+
+
+def worker(arguments) -> None:
+    from work_queue import WorkQueue, open_shared_caches, run_worker
+
+    open_shared_caches()
+    work_queue = WorkQueue(arguments.queue, lease_seconds=arguments.lease_seconds)
+    try:
+        done = run_worker(work_queue, arguments.worker_id, arguments.batch_size, idle_timeout=arguments.idle_timeout)
+    finally:
+        work_queue.close()
+    print(f"{done} jobs done")
+
+
+def build_graph(arguments) -> None:
+    from knowledge_graph import main
+    main(arguments.content, arguments.store_dir, cassette_path=arguments.cassette,
+         cassette_mode=arguments.cassette_mode)
+
+
+def stats(arguments) -> None:
+    content_manager = load_content_manager(arguments.source or _default_source())
+    narratives = list(content_manager.narratives.values())
+    iterations = Counter(narrative.iteration for narrative in narratives)
+    published_dates = [video.published_date for video in content_manager.videos.values() if video.published_date]
+
+    print(f"Videos:           {len(content_manager.videos)}")
+    print(f"Narratives:       {len(narratives)} ({len(content_manager.get_merged_narratives())} merged)")
+    for iteration in sorted(iterations):
+        print(f"  iteration {iteration}:    {iterations[iteration]}")
+    print(f"Search terms:     {len({n.search_term for n in narratives if n.search_term})}")
+    if published_dates:
+        print(f"Published:        {min(published_dates)} - {max(published_dates)}")
+    uploaders = Counter(video.uploader for video in content_manager.videos.values() if video.uploader)
+    for uploader, count in uploaders.most_common(arguments.top):
+        print(f"  {count:6} videos by {uploader}")
+
+
+def export(arguments) -> None:
+    if arguments.format in ("json", "compact"):
+        content_manager = load_content_manager(arguments.source or _default_source())
+        text = content_manager.serialize() if arguments.format == "json" \
+            else json.dumps(content_manager.to_compact_dict(include_transcripts=True))
+        with open(arguments.output, 'w', encoding='utf-8') as file:
+            file.write(text)
+        print(f"Content exported to {arguments.output}")
+        return
+
+    # the knowledge graph, as standardized in the triple store by the last build-graph
+    from graph_export import export_edge_list, export_graphml, export_json_lines, narrative_view
+    from triple_store import DEFAULT_TRIPLE_STORE_PATH, TripleStore
+
+    triple_store = TripleStore(arguments.triple_store or DEFAULT_TRIPLE_STORE_PATH)
+    triples = narrative_view(triple_store.get_triples(sorted(triple_store.narrative_triples)),
+                             triple_store.entity_map, triple_store.predicate_map)
+    exporters = {"jsonl": export_json_lines, "graphml": export_graphml, "edgelist": export_edge_list}
+    count = exporters[arguments.format](triples, arguments.output)
+    print(f"{count} triples exported to {arguments.output}")
+
+
+def create_argument_parser() -> argparse.ArgumentParser:
+    argument_parser = argparse.ArgumentParser(description="Narrative detection in YouTube videos.")
+    subparsers = argument_parser.add_subparsers(dest='command', required=True)
+
+    def add_cassette_arguments(subparser):
+        subparser.add_argument('--cassette', help="Cassette file to record external requests to or replay them from.")
+        subparser.add_argument('--cassette-mode', choices=('record', 'replay'), default='replay')
+
+    crawl_parser = subparsers.add_parser('crawl', help="Search videos and extract and merge their narratives.")
+    crawl_parser.add_argument('--sequential', action='store_true',
+                              help="Use the level-by-level expansion instead of the pipelined crawler "
+                                   "(always used with --cassette).")
+    crawl_parser.add_argument('--store-dir', default=DEFAULT_STORE_DIR, help="Directory of the content store.")
+    crawl_parser.add_argument('--resume', action='store_true',
+                              help="Continue the interrupted crawl of the checkpoint in the content store.")
+    crawl_parser.add_argument('--queue',
+                              help="Work queue file: process videos with worker processes (see the worker command) "
+                                   "and the level-by-level expansion. Workers on other hosts may share the queue "
+                                   "and the caches in ./data, but not the content store.")
+    add_cassette_arguments(crawl_parser)
+    crawl_parser.set_defaults(function=crawl)
+
+    worker_parser = subparsers.add_parser('worker', help="Process the videos of a crawl from its work queue.")
+    worker_parser.add_argument('--queue', default=DEFAULT_QUEUE_PATH, help="Work queue file of the crawl.")
+    worker_parser.add_argument('--worker-id', help="Name of the worker in the queue (default: host and process ID).")
+    worker_parser.add_argument('--batch-size', type=int, default=1, help="Number of jobs leased at a time.")
+    worker_parser.add_argument('--lease-seconds', type=float, default=600,
+                               help="Seconds after which the job of a worker that does not finish is leased again.")
+    worker_parser.add_argument('--idle-timeout', type=float,
+                               help="Stop when the queue has been empty for this many seconds.")
+    worker_parser.set_defaults(function=worker)
+
+    graph_parser = subparsers.add_parser('build-graph', help="Build the knowledge graph of the merged narratives.")
+    graph_parser.add_argument('--content', default=DEFAULT_CONTENT_PATH, help="Legacy content.json file.")
+    graph_parser.add_argument('--store-dir', default=DEFAULT_STORE_DIR, help="Directory of the content store.")
+    add_cassette_arguments(graph_parser)
+    graph_parser.set_defaults(function=build_graph)
+
+    stats_parser = subparsers.add_parser('stats', help="Print statistics of the crawled content (read-only, so it "
+                                                       "can run during a crawl).")
+    stats_parser.add_argument('source', nargs='?',
+                              help="content.json file or content store directory (default: the content store, "
+                                   "or content.json if there is no store).")
+    stats_parser.add_argument('--top', type=int, default=5, help="Number of top uploaders to print.")
+    stats_parser.set_defaults(function=stats)
+
+    export_parser = subparsers.add_parser('export', help="Export the content or the knowledge graph.")
+    export_parser.add_argument('output', help="Output file.")
+    export_parser.add_argument('--format', choices=('json', 'compact', 'jsonl', 'graphml', 'edgelist'),
+                               default='json',
+                               help="json or compact for the content; jsonl, graphml or edgelist for the graph.")
+    export_parser.add_argument('--source', help="content.json file or content store directory.")
+    export_parser.add_argument('--triple-store', help="Triple store file of the knowledge graph.")
+    export_parser.set_defaults(function=export)
+    return argument_parser
+
+
+def main(argv: list[str] | None = None) -> None:
+    arguments = create_argument_parser().parse_args(argv)
+    arguments.function(arguments)
+
+
+if __name__ == '__main__':
+    main()
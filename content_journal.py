@@ -0,0 +1,195 @@
+import json
+import logging
+import os
+
+from content_manager import ContentManager
+from transcript_blobs import TranscriptBlobFile
+from utils import read_from_file
+
+DEFAULT_STORE_DIR = './data/content_store'
+
+
+class ContentJournal:
+    """
+    Append-only persistence for a ContentManager.
+
+    Every mutation of the attached content manager is appended as one JSON line to journal.jsonl, so a crash
+    loses at most the mutation that was being written. Every compact_every entries, the journal is compacted:
+    the full state is written to snapshot.json and the journal is truncated. At startup, the state is rebuilt
+    by loading the snapshot and replaying the journal entries that are newer than the snapshot.
+
+    Transcripts are not part of the snapshot. Compaction appends them to transcripts.bin and the snapshot only
+    holds their offsets, so loaded videos read their transcript lazily and startup time and memory depend on
+    the metadata only. Videos and narratives are written as rows (see ContentManager.to_compact_dict).
+    """
+
+    def __init__(self, directory: str = DEFAULT_STORE_DIR, compact_every: int = 5000, fsync: bool = False):
+        self.directory = directory
+        self.snapshot_path = os.path.join(directory, 'snapshot.json')
+        self.journal_path = os.path.join(directory, 'journal.jsonl')
+        self.transcript_blob_file = TranscriptBlobFile(os.path.join(directory, 'transcripts.bin'))
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self.content_manager: ContentManager | None = None
+        self._file = None
+        self._seq = 0  # sequence number of the last journal entry
+        self._entries_since_compaction = 0
+
+    def exists(self) -> bool:
+        return os.path.exists(self.snapshot_path) or os.path.exists(self.journal_path)
+
+    def open(self, content_manager: ContentManager, read_only: bool = False) -> None:
+        """
+        Restores the state of the content manager from the snapshot and the journal, and attaches the journal
+        to it, so that all subsequent mutations are persisted.
+
+        Args:
+        content_manager (ContentManager): The empty content manager to restore.
+        read_only (bool): If True, the state is only restored: the journal is not attached and no file is written,
+        so a store can be read while a crawl writes to it. A torn last entry is then ignored, not truncated.
+        """
+        snapshot_seq = 0
+        if os.path.exists(self.snapshot_path):
+            snapshot = json.loads(read_from_file(self.snapshot_path))
+            snapshot_seq = snapshot.pop("journal_seq", 0)
+            transcript_index = snapshot.pop("transcript_index", {})
+            if snapshot.get("format") == "compact":
+                content_manager.load_compact_dict(snapshot)
+            else:  # snapshots written before the compact format
+                content_manager.load_dict(snapshot)
+            for video_id, (offset, length) in transcript_index.items():
+                content_manager.videos[video_id].set_transcript_source(self.transcript_blob_file, offset, length)
+        self._seq = snapshot_seq
+
+        valid_end = 0  # offset after the last complete journal entry
+        missing_newline = False
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'rb') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        logging.warning(f"Ignoring incomplete journal entry in {self.journal_path}")
+                        break  # a torn last line from a crash mid-write
+                    valid_end += len(line)
+                    missing_newline = not line.endswith(b'\n')
+                    if entry["seq"] <= snapshot_seq:
+                        continue  # already contained in the snapshot
+                    content_manager.apply_journal_entry(entry["op"], entry["data"])
+                    self._seq = entry["seq"]
+                    self._entries_since_compaction += 1
+            if valid_end < os.path.getsize(self.journal_path) and not read_only:
+                # new entries must not be appended behind the torn entry, as the next startup stops there
+                os.truncate(self.journal_path, valid_end)
+        if read_only:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._file = open(self.journal_path, 'a')
+        if missing_newline:
+            self._file.write('\n')
+            self._file.flush()
+        self.content_manager = content_manager
+        content_manager.attach_journal(self)
+
+    def append(self, op: str, data: dict) -> None:
+        """
+        Appends a mutation to the journal. Called by the content manager for every mutation.
+        """
+        self._seq += 1
+        line = json.dumps({"seq": self._seq, "op": op, "data": data}, default=ContentManager._json_serialize)
+        self._file.write(line + '\n')
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+        self._entries_since_compaction += 1
+        if self._entries_since_compaction >= self.compact_every:
+            self.compact()
+
+    def compact(self) -> None:
+        """
+        Writes the full state to the snapshot and truncates the journal. The snapshot is replaced atomically and
+        records the sequence number of the last journal entry it contains, so a crash between both steps is safe.
+        """
+        snapshot = self.content_manager.to_compact_dict()
+        snapshot["journal_seq"] = self._seq
+        snapshot["transcript_index"] = self._store_transcripts()
+
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(snapshot, file, default=ContentManager._json_serialize)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+        self._file.close()
+        self._file = open(self.journal_path, 'w')
+        self._entries_since_compaction = 0
+
+    def _store_transcripts(self) -> dict[str, tuple[int, int]]:
+        """
+        Appends all transcripts that are still held in memory to the blob file, switches their videos to lazy
+        loading and returns the offset index of all stored transcripts.
+        """
+        transcript_index = {}
+        for video_id, video in list(self.content_manager.videos.items()):
+            source = video.transcript_source
+            if source is None or source[0] is not self.transcript_blob_file:
+                transcript = video.transcript
+                if transcript is None:
+                    continue
+                offset, length = self.transcript_blob_file.append(transcript)
+                video.set_transcript_source(self.transcript_blob_file, offset, length)
+                source = video.transcript_source
+            transcript_index[video_id] = (source[1], source[2])
+
+        if transcript_index:
+            self.transcript_blob_file.flush()  # the snapshot must never point to transcripts that are not on disk
+        return transcript_index
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.transcript_blob_file.close()
+        if self.content_manager is not None:
+            self.content_manager.attach_journal(None)
+            self.content_manager = None
+
+
+def open_content_manager(store_dir: str = DEFAULT_STORE_DIR, legacy_json_path: str | None = None,
+                         compact_every: int = 5000) -> tuple[ContentManager, ContentJournal]:
+    """
+    Creates a content manager backed by a journal. If the journal store does not exist yet, the state is
+    imported from the legacy content.json file (if given and present) and written as the first snapshot.
+
+    Args:
+    store_dir (str): Directory of the snapshot and journal files.
+    legacy_json_path (str | None): Path of a content.json file created by ContentManager.serialize.
+    compact_every (int): Number of journal entries after which the journal is compacted.
+
+    Returns:
+    tuple[ContentManager, ContentJournal]: The restored content manager and its attached journal.
+    """
+    content_manager = ContentManager()
+    journal = ContentJournal(store_dir, compact_every)
+    imported = False
+    if not journal.exists() and legacy_json_path and os.path.exists(legacy_json_path):
+        content_manager.deserialize(read_from_file(legacy_json_path))
+        imported = True
+
+    journal.open(content_manager)
+    if imported:
+        journal.compact()
+    return content_manager, journal
+
+
+def load_content_store(store_dir: str = DEFAULT_STORE_DIR) -> ContentManager:
+    """
+    Loads the content of a journaled content store read-only, e.g. to inspect the store of a running crawl.
+    Transcripts are read lazily from the store.
+    """
+    content_manager = ContentManager()
+    ContentJournal(store_dir).open(content_manager, read_only=True)
+    return content_manager
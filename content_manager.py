@@ -1,7 +1,10 @@
 import json
+import sys
+import threading
+from array import array
+from bisect import bisect_left
 from datetime import date, datetime
 
-from narrative_clustering import cluster_narratives_with_retry
 from narrative import Narrative
 from video import Video
 
@@ -10,15 +13,56 @@ class ContentManager:
     def __init__(self):
         self.videos: dict[str, Video] = dict()
         self.narratives: dict[int, Narrative] = dict()
-        self.video_to_narratives = {}  # Maps video IDs to sets of narrative IDs
-        self.narrative_to_videos = {}  # Maps narrative IDs to sets of video IDs
+        self.video_to_narratives: dict[str, array] = {}  # Maps video IDs to sorted arrays of narrative IDs
+        self.narrative_to_videos: dict[int, set[str]] = {}  # Maps narrative IDs to sets of video IDs
         self.next_narrative_id = 1  # Auto-incrementing ID for Narratives
 
+        # Secondary indexes of narrative IDs, updated on every mutation
+        self._narratives_by_iteration: dict[int, set[int]] = {}
+        self._narratives_by_search_term: dict[str, set[int]] = {}
+        self._merged_narratives: set[int] = set()
+
+        self._lock = threading.RLock()  # Guards mutations when videos are processed concurrently
+        self.journal = None  # Optional ContentJournal that persists every mutation
+
+    def attach_journal(self, journal) -> None:
+        """
+        Attaches a journal to which every subsequent mutation is appended. Pass None to detach it.
+        """
+        with self._lock:
+            self.journal = journal
+
+    def _record(self, op: str, data: dict) -> None:
+        if self.journal is not None:
+            self.journal.append(op, data)
+
     def add_video(self, video: Video) -> bool:
-        if not self.contains_video(video):
-            self.videos[video.video_id] = video
-            return True
-        return False
+        with self._lock:
+            if not self.contains_video(video):
+                self.videos[video.video_id] = video
+                self._record("add_video", {"video": self._convert_video_to_dict(video)})
+                return True
+            return False
+
+    def add_video_narratives(self, video: Video, narrative_descriptions: list[str], search_term: str,
+                             iteration: int) -> list[Narrative]:
+        """
+        Adds a video and creates its narratives as one atomic step, so that narratives of concurrently
+        processed videos are never interleaved and narrative IDs stay consecutive per video.
+
+        Args:
+        video (Video): The processed video.
+        narrative_descriptions (list[str]): The narratives extracted from the video's transcript.
+        search_term (str): the search term used to find the video
+        iteration (int): The current search iteration during which the narratives were created.
+
+        Returns:
+        list[Narrative]: The created Narrative objects.
+        """
+        with self._lock:
+            self.add_video(video)
+            return [self.create_video_narrative(video.video_id, description, search_term, iteration)
+                    for description in narrative_descriptions]
 
     def contains_video(self, video: Video) -> bool:
         return video.video_id in self.videos
@@ -37,25 +81,52 @@ class ContentManager:
         Returns:
         Narrative: The created Narrative object.
         """
-        # Create and set up the Narrative object
-        narrative = Narrative(self.next_narrative_id, narrative_description, iteration, search_term)
-        self.next_narrative_id += 1
+        with self._lock:
+            # Create and set up the Narrative object
+            narrative = Narrative(self.next_narrative_id, narrative_description, iteration, search_term)
 
-        # Register the narrative and link it with the video
-        self.narratives[narrative.narrative_id] = narrative
-        self.link_video_narrative(video_id, narrative.narrative_id)
+            # Register the narrative and link it with the video
+            self._register_narrative(narrative)
+            self.link_video_narrative(video_id, narrative.narrative_id)
 
-        return narrative
+            return narrative
+
+    def _register_narrative(self, narrative: Narrative) -> None:
+        with self._lock:
+            self.narratives[narrative.narrative_id] = narrative
+            self.next_narrative_id = max(self.next_narrative_id, narrative.narrative_id + 1)
+            self._index_narrative(narrative)
+            self._record("add_narrative", {"narrative": narrative.to_json_data()})
+
+    def _index_narrative(self, narrative: Narrative) -> None:
+        self._narratives_by_iteration.setdefault(narrative.iteration, set()).add(narrative.narrative_id)
+        if narrative.search_term is not None:
+            self._narratives_by_search_term.setdefault(narrative.search_term, set()).add(narrative.narrative_id)
+        if narrative.is_merged:
+            self._merged_narratives.add(narrative.narrative_id)
+
+    def _unindex_narrative(self, narrative: Narrative) -> None:
+        self._narratives_by_iteration.get(narrative.iteration, set()).discard(narrative.narrative_id)
+        if narrative.search_term is not None:
+            self._narratives_by_search_term.get(narrative.search_term, set()).discard(narrative.narrative_id)
+        self._merged_narratives.discard(narrative.narrative_id)
+
+    def set_narrative_search_term(self, narrative_id: int, search_term: str) -> None:
+        with self._lock:
+            narrative = self.narratives[narrative_id]
+            self._unindex_narrative(narrative)
+            narrative.search_term = sys.intern(search_term)
+            self._index_narrative(narrative)
+            self._record("set_search_term", {"narrative_id": narrative_id, "search_term": search_term})
 
     def link_video_narrative(self, video_id: str, narrative_id: int):
-        if video_id in self.video_to_narratives:
-            self.video_to_narratives[video_id].append(narrative_id)
-        else:
-            self.video_to_narratives[video_id] = [narrative_id]
-        if narrative_id in self.narrative_to_videos:
-            self.narrative_to_videos[narrative_id].append(video_id)
-        else:
-            self.narrative_to_videos[narrative_id] = [video_id]
+        with self._lock:
+            narrative_ids = self.video_to_narratives.setdefault(video_id, array('q'))
+            index = bisect_left(narrative_ids, narrative_id)
+            if index == len(narrative_ids) or narrative_ids[index] != narrative_id:
+                narrative_ids.insert(index, narrative_id)
+            self.narrative_to_videos.setdefault(narrative_id, set()).add(video_id)
+            self._record("link", {"video_id": video_id, "narrative_id": narrative_id})
 
     def get_video(self, video_id: str) -> Video:
         return self.videos.get(video_id)
@@ -64,86 +135,212 @@ class ContentManager:
         return self.narratives.get(narrative_id)
 
     def get_videos_for_narrative(self, narrative_id: int):
-        return [self.get_video(video_id) for video_id in self.narrative_to_videos.get(narrative_id, set())]
+        with self._lock:
+            return [self.get_video(video_id) for video_id in sorted(self.narrative_to_videos.get(narrative_id, ()))]
 
     def get_narratives_for_video(self, video_id: str):
-        return [self.get_narrative(narrative_id) for narrative_id in self.video_to_narratives.get(video_id, set())]
+        with self._lock:
+            return [self.get_narrative(narrative_id) for narrative_id in self.video_to_narratives.get(video_id, ())]
+
+    def get_narratives_by_iteration(self, iteration: int) -> list[Narrative]:
+        """
+        Returns the narratives created in the given iteration, ordered by ID.
+        """
+        return self._get_indexed_narratives(self._narratives_by_iteration.get(iteration, ()))
+
+    def get_narratives_by_search_term(self, search_term: str) -> list[Narrative]:
+        """
+        Returns the narratives with the given search term, ordered by ID.
+        """
+        return self._get_indexed_narratives(self._narratives_by_search_term.get(search_term, ()))
+
+    def get_merged_narratives(self) -> list[Narrative]:
+        """
+        Returns the narratives that are the result of a merge, ordered by ID.
+        """
+        return self._get_indexed_narratives(self._merged_narratives)
+
+    def _get_indexed_narratives(self, narrative_ids) -> list[Narrative]:
+        with self._lock:
+            return [self.narratives[narrative_id] for narrative_id in sorted(narrative_ids)]
 
     def remove_narrative(self, narrative_id: int):
-        for video in self.get_videos_for_narrative(narrative_id):
-            self.video_to_narratives[video.video_id].remove(narrative_id)
-        del self.narratives[narrative_id]
-        del self.narrative_to_videos[narrative_id]
+        with self._lock:
+            for video_id in self.narrative_to_videos.pop(narrative_id, ()):
+                narrative_ids = self.video_to_narratives[video_id]
+                index = bisect_left(narrative_ids, narrative_id)
+                if index < len(narrative_ids) and narrative_ids[index] == narrative_id:
+                    del narrative_ids[index]
+            self._unindex_narrative(self.narratives.pop(narrative_id))
+            self._record("remove_narrative", {"narrative_id": narrative_id})
 
     def cluster_and_merge_narratives(self, narratives: list[Narrative], iteration: int) -> list[Narrative]:
         """
-        Clusters and merges narratives using an LLM.
+        Clusters and merges narratives using an LLM. Near-duplicate narratives are collapsed locally first, and
+        large sets of narratives are clustered hierarchically in batches; the based_on of each new narrative
+        always refers to all given narratives it covers, including collapsed near-duplicates.
         """
+        # imported here, so loading and inspecting content does not import the LLM libraries
+        from narrative_clustering import cluster_narratives_hierarchical
+        from narrative_dedup import collapse_near_duplicates
+
         result = []
         narrative_id_desc_map = {n.narrative_id: n.description for n in narratives}
-        clusters = cluster_narratives_with_retry(narrative_id_desc_map)
+        representatives, members = collapse_near_duplicates(narrative_id_desc_map)
+        clusters = [(description, [nid for rep_id in based_on for nid in members.get(rep_id, [rep_id])])
+                    for description, based_on in cluster_narratives_hierarchical(representatives)]
 
         # merge each cluster into a new narrative
-        for description, based_on in clusters:
-            new_narrative = Narrative(self.next_narrative_id, description, iteration)
-            new_narrative.based_on = based_on
-            self.narratives[new_narrative.narrative_id] = new_narrative
-            self.next_narrative_id += 1
-            result.append(new_narrative)
-
-            # link new narrative and remove old narratives
-            for narrative_id in based_on:
-                videos = self.get_videos_for_narrative(narrative_id)
-                for video in videos:
-                    self.link_video_narrative(video.video_id, new_narrative.narrative_id)
+        with self._lock:
+            for description, based_on in clusters:
+                new_narrative = Narrative(self.next_narrative_id, description, iteration, based_on=based_on)
+                self._register_narrative(new_narrative)
+                result.append(new_narrative)
+
+                # link new narrative and remove old narratives
+                for narrative_id in based_on:
+                    videos = self.get_videos_for_narrative(narrative_id)
+                    for video in videos:
+                        self.link_video_narrative(video.video_id, new_narrative.narrative_id)
 
         return result
 
+    def apply_journal_entry(self, op: str, data: dict) -> None:
+        """
+        Re-applies a mutation that was recorded by a ContentJournal. The entry is not recorded again.
+        """
+        with self._lock:
+            journal, self.journal = self.journal, None
+            try:
+                if op == "add_video":
+                    self.add_video(self._convert_dict_to_video(data["video"]))
+                elif op == "add_narrative":
+                    self._register_narrative(Narrative(**data["narrative"]))
+                elif op == "link":
+                    self.link_video_narrative(data["video_id"], data["narrative_id"])
+                elif op == "set_search_term":
+                    self.set_narrative_search_term(data["narrative_id"], data["search_term"])
+                elif op == "remove_narrative":
+                    self.remove_narrative(data["narrative_id"])
+                else:
+                    raise ValueError(f"Unknown journal operation: {op}")
+            finally:
+                self.journal = journal
+
     def serialize(self) -> str:
         """
         Serializes the content manager's state to a JSON string.
         """
-        data = {
-            "videos": {vid: self._convert_video_to_dict(video) for vid, video in self.videos.items()},
-            "narratives": {nid: vars(narrative) for nid, narrative in self.narratives.items()},
-            "video_to_narratives": self.video_to_narratives,
-            "narrative_to_videos": self.narrative_to_videos,
-            "next_narrative_id": self.next_narrative_id
-        }
-        return json.dumps(data, default=self._json_serialize)
+        return json.dumps(self.to_dict(), default=self._json_serialize)
 
     def deserialize(self, json_string: str):
         """
         Deserializes a JSON string to restore the content manager's state.
         """
-        data = json.loads(json_string)
+        self.load_dict(json.loads(json_string))
 
+    def to_dict(self, include_transcripts: bool = True) -> dict:
+        """
+        Returns the content manager's state as a JSON-serializable dict (the legacy content.json layout).
+
+        Args:
+        include_transcripts (bool): Whether the video transcripts are included.
+        """
+        with self._lock:
+            return {
+                "videos": {vid: self._convert_video_to_dict(video, include_transcripts)
+                           for vid, video in self.videos.items()},
+                "narratives": {nid: narrative.to_json_data() for nid, narrative in self.narratives.items()},
+                "video_to_narratives": self.video_to_narratives,
+                "narrative_to_videos": self.narrative_to_videos,
+                "next_narrative_id": self.next_narrative_id
+            }
+
+    def load_dict(self, data: dict):
+        """
+        Restores the content manager's state from a dict created by to_dict.
+        """
         # Reconstruct Video objects
-        self.videos = {}
-        for vid, v_data in data["videos"].items():
-            video = Video()
-            video.__dict__.update(v_data)
-            if 'published_date' in v_data and v_data['published_date']:
-                video.published_date = datetime.fromisoformat(v_data['published_date'])
-            self.videos[vid] = video
+        self.videos = {vid: self._convert_dict_to_video(v_data) for vid, v_data in data["videos"].items()}
 
         # Reconstruct Narrative objects
         self.narratives = {int(nid): Narrative(**n_data) for nid, n_data in data["narratives"].items()}
 
         # Restore relationships
-        self.video_to_narratives = data["video_to_narratives"]
-        self.narrative_to_videos = {int(nid): [v_list] if isinstance(v_list, str) else v_list
+        self.video_to_narratives = {vid: array('q', sorted(set(n_list)))
+                                    for vid, n_list in data["video_to_narratives"].items()}
+        self.narrative_to_videos = {int(nid): {v_list} if isinstance(v_list, str) else set(v_list)
                                     for nid, v_list in data["narrative_to_videos"].items()}
 
         # Restore the next narrative ID
         self.next_narrative_id = data["next_narrative_id"]
 
+        self._rebuild_indexes()
+
+    def to_compact_dict(self, include_transcripts: bool = False) -> dict:
+        """
+        Returns the content manager's state as a compact JSON-serializable dict, used by the content store.
+        Videos and narratives are stored as rows of values instead of dicts, and narrative_to_videos is left out,
+        as it is the inverse of video_to_narratives. Transcripts are left out unless include_transcripts is True.
+        """
+        with self._lock:
+            data = {
+                "format": "compact",
+                "video_fields": Video.ROW_FIELDS,
+                "videos": [video.to_row() for video in self.videos.values()],
+                "narratives": [narrative.to_row() for narrative in self.narratives.values()],
+                "video_to_narratives": {vid: n_ids.tolist() for vid, n_ids in self.video_to_narratives.items()},
+                "next_narrative_id": self.next_narrative_id
+            }
+            if include_transcripts:
+                data["transcripts"] = {vid: video.transcript for vid, video in self.videos.items()}
+            return data
+
+    def load_compact_dict(self, data: dict):
+        """
+        Restores the content manager's state from a dict created by to_compact_dict.
+        """
+        if tuple(data["video_fields"]) != Video.ROW_FIELDS:
+            raise ValueError(f"Unsupported video fields: {data['video_fields']}")
+
+        self.videos = {}
+        for row in data["videos"]:
+            video = Video.from_row(row)
+            self.videos[video.video_id] = video
+        for vid, transcript in data.get("transcripts", {}).items():
+            self.videos[vid].transcript = transcript
+
+        self.narratives = {}
+        for row in data["narratives"]:
+            narrative = Narrative.from_row(row)
+            self.narratives[narrative.narrative_id] = narrative
+
+        self.video_to_narratives = {vid: array('q', n_list) for vid, n_list in data["video_to_narratives"].items()}
+        self.narrative_to_videos = {}
+        for vid, n_ids in self.video_to_narratives.items():
+            for nid in n_ids:
+                self.narrative_to_videos.setdefault(nid, set()).add(vid)
+
+        self.next_narrative_id = data["next_narrative_id"]
+        self._rebuild_indexes()
+
+    def _rebuild_indexes(self):
+        self._narratives_by_iteration = {}
+        self._narratives_by_search_term = {}
+        self._merged_narratives = set()
+        for narrative in self.narratives.values():
+            self._index_narrative(narrative)
+
+    @staticmethod
+    def _convert_video_to_dict(video: Video, include_transcript: bool = True) -> dict:
+        return video.to_json_data(include_transcript)
+
     @staticmethod
-    def _convert_video_to_dict(video: Video) -> dict:
-        video_dict = vars(video)
-        if video.published_date:
-            video_dict['published_date'] = video.published_date.isoformat()
-        return video_dict
+    def _convert_dict_to_video(video_dict: dict) -> Video:
+        video = Video.from_json_data(video_dict)
+        if 'published_date' in video_dict and video_dict['published_date']:
+            video.published_date = datetime.fromisoformat(video_dict['published_date'])
+        return video
 
     @staticmethod
     def _json_serialize(obj):
@@ -152,4 +349,8 @@ class ContentManager:
         """
         if isinstance(obj, (date, datetime)):
             return obj.isoformat()
+        if isinstance(obj, set):
+            return sorted(obj)
+        if isinstance(obj, array):
+            return obj.tolist()
         raise TypeError(f"Type {type(obj)} not serializable")
@@ -0,0 +1,141 @@
+import json
+import logging
+import os
+
+from content_manager import ContentManager
+from search_cache import SearchedTerms
+
+CHECKPOINT_FILE_NAME = 'crawl_checkpoint.json'
+
+
+class CrawlCheckpoint:
+    """
+    The BFS state of a crawl: the queue of search terms still to search (the frontier), the searched terms, the
+    current level, the levels whose narratives are merged and the merged narratives whose search terms are not
+    queued yet. Together with the journaled content store (see content_journal.py), it lets an interrupted crawl
+    continue where it stopped.
+
+    The checkpoint is saved to a JSON file in the content store directory, atomically replacing the previous
+    version, so a crash while saving leaves the previous checkpoint intact. A checkpoint without a path is not
+    saved, so the crawl functions can always keep their state in a checkpoint.
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = path
+        self.initial_search_term: str | None = None
+        self.max_iterations: int | None = None
+        self.iteration = 1
+        self.search_queue: list[tuple[str, int, bool]] = []  # (search term, depth, merge flag)
+        self.searched = SearchedTerms()
+        self.merged_iterations: list[int] = []
+        self.seed_narrative_ids: list[int] = []
+        self.first_narrative_id = 1  # narratives with lower IDs were created before the crawl
+        self.finished = False
+
+    @property
+    def started(self) -> bool:
+        return self.initial_search_term is not None
+
+    def start(self, initial_search_term: str, max_iterations: int, first_narrative_id: int) -> None:
+        """
+        Initializes the state of a new crawl.
+
+        Args:
+        initial_search_term (str): The initial search term of the crawl.
+        max_iterations (int): The number of BFS levels of the crawl.
+        first_narrative_id (int): The ID of the first narrative the crawl creates, i.e. the next narrative ID of
+        the content manager, so narratives of earlier crawls in the same store are never discarded.
+        """
+        self.initial_search_term = initial_search_term
+        self.max_iterations = max_iterations
+        self.first_narrative_id = first_narrative_id
+        self.search_queue = [(initial_search_term, max_iterations, True)]
+
+    def check_crawl(self, initial_search_term: str, max_iterations: int) -> None:
+        """
+        Raises a ValueError if the checkpoint is of a crawl with another initial search term or number of levels.
+        """
+        if (self.initial_search_term, self.max_iterations) != (initial_search_term, max_iterations):
+            raise ValueError(f"The checkpoint {self.path} is of a crawl from '{self.initial_search_term}' with "
+                             f"{self.max_iterations} iterations, not from '{initial_search_term}' with "
+                             f"{max_iterations} iterations.")
+
+    def is_merged(self, iteration: int) -> bool:
+        return iteration in self.merged_iterations
+
+    def discard_unfinished_merge(self, content_manager: ContentManager, iteration: int) -> None:
+        """
+        Removes the merged narratives of a merge of the given iteration that was interrupted, so the merge can be
+        done again. Completed merges are recorded in the checkpoint and never discarded, and neither are the
+        narratives of earlier crawls in the same content store.
+        """
+        if self.is_merged(iteration):
+            return
+        unfinished = [narrative for narrative in content_manager.get_narratives_by_iteration(iteration)
+                      if narrative.is_merged and narrative.narrative_id >= self.first_narrative_id]
+        if unfinished:
+            logging.info(f"Discarding {len(unfinished)} narratives of the interrupted merge of iteration {iteration}")
+        for narrative in unfinished:
+            content_manager.remove_narrative(narrative.narrative_id)
+
+    def to_dict(self) -> dict:
+        return {
+            "version": 1,
+            "initial_search_term": self.initial_search_term,
+            "max_iterations": self.max_iterations,
+            "iteration": self.iteration,
+            "search_queue": self.search_queue,
+            "searched": list(self.searched),
+            "merged_iterations": self.merged_iterations,
+            "seed_narrative_ids": self.seed_narrative_ids,
+            "first_narrative_id": self.first_narrative_id,
+            "finished": self.finished,
+        }
+
+    def load_dict(self, data: dict) -> None:
+        self.initial_search_term = data["initial_search_term"]
+        self.max_iterations = data["max_iterations"]
+        self.iteration = data["iteration"]
+        self.search_queue = [tuple(item) for item in data["search_queue"]]
+        self.searched = SearchedTerms()
+        for search_term in data["searched"]:
+            self.searched.add(search_term)
+        self.merged_iterations = data["merged_iterations"]
+        self.seed_narrative_ids = data["seed_narrative_ids"]
+        self.first_narrative_id = data["first_narrative_id"]
+        self.finished = data["finished"]
+
+    def save(self) -> None:
+        """
+        Writes the checkpoint to its file, atomically replacing the previous version.
+        """
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.to_dict(), file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+
+    @classmethod
+    def open(cls, store_dir: str, resume: bool) -> 'CrawlCheckpoint':
+        """
+        Returns the checkpoint of the crawl of a content store. If resume is True, the saved checkpoint is loaded;
+        otherwise, or if there is none, the checkpoint of a new crawl is returned.
+
+        Args:
+        store_dir (str): The directory of the journaled content store.
+        resume (bool): Whether to continue the crawl of the saved checkpoint.
+        """
+        checkpoint = cls(os.path.join(store_dir, CHECKPOINT_FILE_NAME))
+        if resume:
+            if os.path.exists(checkpoint.path):
+                with open(checkpoint.path, 'r', encoding='utf-8') as file:
+                    checkpoint.load_dict(json.load(file))
+                logging.info(f"Resuming the crawl at iteration {checkpoint.iteration} with "
+                             f"{len(checkpoint.search_queue)} queued and {len(checkpoint.searched)} searched terms")
+            else:
+                logging.warning(f"No crawl checkpoint in {store_dir}, starting a new crawl")
+        return checkpoint
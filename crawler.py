@@ -0,0 +1,355 @@
+import asyncio
+import logging
+from datetime import datetime
+
+from content_manager import ContentManager
+from crawl_checkpoint import CrawlCheckpoint
+from metrics import get_metrics
+from narrative import Narrative
+from narrative_extraction import extract_narratives_chunked
+from rate_limiter import backoff_delay
+from relevance import RelevanceFilter
+from search_cache import SearchedTerms, get_search_cache
+from search_term_creation import create_search_term
+from video import Video
+from yt_searcher import search_videos
+
+_DONE = object()  # put in a queue once per consuming worker when the producing stage is finished
+
+
+class MaxSkipsReachedException(Exception):
+    """Exception raised when the maximum number of consecutive skips is reached."""
+    pass
+
+
+class VideoBudget:
+    """
+    Exact budget of processed videos. A video reserves a slot before its transcript is fetched. The slot is kept
+    when the video is committed and released when the video is skipped, so committed plus in-flight videos never
+    exceed the limit and searches only hand out as many videos as can still be committed.
+    """
+
+    def __init__(self, limit: int, used: int = 0):
+        self.limit = limit
+        self.used = used
+        self.reserved = 0
+        self._condition = asyncio.Condition()
+
+    @property
+    def exhausted(self) -> bool:
+        return self.used >= self.limit
+
+    async def reserve(self) -> bool:
+        """
+        Reserves a slot for a video. Waits while the remaining slots are all reserved by in-flight videos, as one
+        of those may still be skipped.
+
+        Returns:
+        bool: True if a slot is reserved, False if the budget is used up by committed videos.
+        """
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.used + self.reserved < self.limit or self.reserved == 0)
+            if self.used + self.reserved >= self.limit:
+                return False
+            self.reserved += 1
+            return True
+
+    async def release(self, committed: bool) -> None:
+        async with self._condition:
+            self.reserved -= 1
+            if committed:
+                self.used += 1
+            self._condition.notify_all()
+
+
+class PipelinedCrawler:
+    """
+    Asynchronous version of the BFS in main.iterative_narrative_expansion.
+
+    A BFS level is a pipeline of four stages connected by bounded queues: search term generation, video search,
+    transcript fetching and narrative extraction. Each stage has its own pool of workers that run the blocking
+    calls in threads, so a level takes about as long as its slowest stage instead of the sum of all calls.
+    Levels are still separated by a barrier: the narratives of a level are clustered and merged when all its
+    videos are processed, and the merged narratives seed the search terms of the next level.
+
+    The total number of videos is enforced exactly with a VideoBudget. Unlike the sequential BFS, videos are
+    committed in order of completion, so narrative IDs depend on timing.
+    """
+
+    def __init__(self,
+                 content_manager: ContentManager,
+                 start_date: datetime,
+                 max_total_videos: int,
+                 term_workers: int = 4,
+                 search_workers: int = 2,
+                 fetch_workers: int = 8,
+                 extract_workers: int = 4,
+                 queue_size: int = 16,
+                 max_skips: int = 3,
+                 max_retries: int = 1,
+                 min_yield: float = 0.1,
+                 min_relevance: float | None = 0.15,
+                 oversample: int = 2):
+        """
+        Args:
+        content_manager (ContentManager): The content manager instance.
+        start_date (datetime): The starting date for video search.
+        max_total_videos (int): Maximum total number of videos, including the videos already in the content manager.
+        term_workers (int): Number of concurrent search term generations.
+        search_workers (int): Number of concurrent video searches.
+        fetch_workers (int): Number of concurrent transcript fetches.
+        extract_workers (int): Number of concurrent narrative extractions.
+        queue_size (int): Maximum number of items waiting between two stages.
+        max_skips (int): The maximum number of consecutive failed videos before crawling is stopped.
+        max_retries (int): Number of retries of a failed transcript fetch or narrative extraction.
+        min_yield (float): Search terms whose earlier searches had a lower fraction of new videos are skipped.
+        min_relevance (float | None): The minimum relevance score (see relevance.py) of a video to be processed.
+        If None, all new videos are processed.
+        oversample (int): With a relevance filter, searches return oversample times the videos that are processed,
+        so the most relevant ones can be chosen.
+        """
+        self.content_manager = content_manager
+        self.start_date = start_date
+        self.max_total_videos = max_total_videos
+        self.term_workers = term_workers
+        self.search_workers = search_workers
+        self.fetch_workers = fetch_workers
+        self.extract_workers = extract_workers
+        self.queue_size = queue_size
+        self.max_skips = max_skips
+        self.max_retries = max_retries
+        self.min_yield = min_yield
+        self.min_relevance = min_relevance
+        self.oversample = oversample
+        self.searched = SearchedTerms()  # also matches terms that only differ in word order, case or punctuation
+        self._in_flight: set[str] = set()
+        self._consecutive_skips = 0
+        self._budget: VideoBudget | None = None
+        self._relevance_filter: RelevanceFilter | None = None
+        self._checkpoint: CrawlCheckpoint | None = None
+        self._unfinished_videos: dict[str, int] = {}  # search term -> number of its videos not committed or skipped
+
+    def run(self, initial_search_term: str, max_iterations: int, checkpoint: CrawlCheckpoint | None = None) -> None:
+        """
+        Runs the BFS from the initial search term for at most max_iterations levels, then merges all merged
+        narratives, like main.iterative_narrative_expansion.
+
+        The BFS state is kept in checkpoint, which is saved after every level and whenever all videos of a search
+        term are committed or skipped, as the sequential BFS does after every search. If the checkpoint is of an
+        interrupted crawl, the crawl continues at the level where it stopped: finished search terms are not
+        searched again, search terms of its narratives that were already created are reused, and committed videos
+        of the unfinished search terms are not processed again.
+        """
+        asyncio.run(self.crawl(initial_search_term, max_iterations, checkpoint))
+
+    async def crawl(self, initial_search_term: str, max_iterations: int,
+                    checkpoint: CrawlCheckpoint | None = None) -> None:
+        state = checkpoint or CrawlCheckpoint()
+        if state.started:
+            state.check_crawl(initial_search_term, max_iterations)
+        else:
+            state.start(initial_search_term, max_iterations, self.content_manager.next_narrative_id)
+            state.save()
+        if state.finished:
+            logging.info("The crawl of the checkpoint is already finished.")
+            return
+
+        self._checkpoint = state
+        self.searched = SearchedTerms()  # the finished search terms of the checkpoint and the terms in progress
+        for search_term in state.searched:
+            self.searched.add(search_term)
+        self._budget = VideoBudget(self.max_total_videos, len(self.content_manager.videos))
+        if self.min_relevance is not None:
+            self._relevance_filter = RelevanceFilter(initial_search_term, self.min_relevance)
+
+        while not self._budget.exhausted and state.iteration <= max_iterations:
+            iteration = state.iteration
+            max_results = 2 ** (max_iterations - iteration + 3)  # 32, 16, 8 for 3 iterations
+            initial_terms = [search_term for search_term, _, _ in state.search_queue]
+            seed_narratives = [self.content_manager.get_narrative(narrative_id)
+                               for narrative_id in state.seed_narrative_ids]
+            await self._run_level(iteration, max_results, initial_terms, seed_narratives)
+
+            state.discard_unfinished_merge(self.content_manager, iteration)
+            narratives_to_merge = self.content_manager.get_narratives_by_iteration(iteration)
+            new_narratives = await asyncio.to_thread(self.content_manager.cluster_and_merge_narratives,
+                                                     narratives_to_merge, iteration)
+            state.merged_iterations.append(iteration)
+            state.iteration += 1
+            state.search_queue = []
+            state.seed_narrative_ids = [narrative.narrative_id for narrative in new_narratives]
+            state.save()
+
+        # do a final merge of all merged narratives
+        state.discard_unfinished_merge(self.content_manager, state.iteration)
+        narratives_to_merge = self.content_manager.get_merged_narratives()
+        await asyncio.to_thread(self.content_manager.cluster_and_merge_narratives, narratives_to_merge,
+                                state.iteration)
+        state.finished = True
+        state.save()
+
+    async def _run_level(self, iteration: int, max_results: int, initial_terms: list[str],
+                         seed_narratives: list[Narrative]) -> None:
+        term_queue = asyncio.Queue(self.queue_size)
+        video_queue = asyncio.Queue(self.queue_size)
+        transcript_queue = asyncio.Queue(self.queue_size)
+        narratives = iter(seed_narratives)
+
+        async def generate_terms():
+            for term in initial_terms:
+                await term_queue.put(term)
+            await _run_workers(self.term_workers, lambda: self._term_worker(narratives, term_queue))
+            await _finish(term_queue, self.search_workers)
+
+        async def search():
+            await _run_workers(self.search_workers,
+                               lambda: self._search_worker(term_queue, video_queue, max_results))
+            await _finish(video_queue, self.fetch_workers)
+
+        async def fetch():
+            await _run_workers(self.fetch_workers, lambda: self._fetch_worker(video_queue, transcript_queue))
+            await _finish(transcript_queue, self.extract_workers)
+
+        async def extract():
+            await _run_workers(self.extract_workers, lambda: self._extract_worker(transcript_queue, iteration))
+
+        await _gather_or_cancel([generate_terms(), search(), fetch(), extract()])
+
+    async def _term_worker(self, narratives, term_queue: asyncio.Queue) -> None:
+        for narrative in narratives:  # the iterator is shared by all term workers
+            if self._budget.exhausted:
+                return
+            search_term = narrative.search_term  # created before the crawl was interrupted
+            if search_term is None:
+                search_term = await asyncio.to_thread(create_search_term, narrative.description)
+                self.content_manager.set_narrative_search_term(narrative.narrative_id, search_term)
+            await term_queue.put(search_term)
+
+    async def _search_worker(self, term_queue: asyncio.Queue, video_queue: asyncio.Queue, max_results: int) -> None:
+        while (search_term := await term_queue.get()) is not _DONE:
+            if not self._should_search(search_term):
+                continue
+            self.searched.add(search_term)
+            self._unfinished_videos[search_term] = 1  # the search itself, finished when all videos are queued
+
+            search_results = max_results * self.oversample if self._relevance_filter else max_results
+            videos = await asyncio.to_thread(lambda: list(search_videos(search_term, self.start_date, search_results)))
+            new_videos = [video for video in videos
+                          if not self.content_manager.contains_video(video) and video.video_id not in self._in_flight]
+            logging.info(f"{len(new_videos)} new videos found for '{search_term}'.")
+            cache = get_search_cache()
+            if cache:
+                cache.record_yield(search_term, len(videos), len(new_videos))
+            if self._relevance_filter:
+                new_videos = self._relevance_filter.select(new_videos, search_term, top_n=max_results,
+                                                          corpus=videos)
+
+            for video in new_videos:
+                if video.video_id in self._in_flight:  # found by another search while waiting for the budget
+                    continue
+                if not await self._budget.reserve():
+                    break
+                self._in_flight.add(video.video_id)
+                self._unfinished_videos[search_term] += 1
+                await video_queue.put((video, search_term))
+            self._finish_video(search_term)
+
+    def _should_search(self, search_term: str) -> bool:
+        if self._budget.exhausted:
+            return False
+        similar_term = self.searched.find_similar(search_term)
+        if similar_term is not None:
+            logging.info(f"Search term '{search_term}' is skipped, as the similar term '{similar_term}' is searched.")
+            return False
+        cache = get_search_cache()
+        if cache and cache.is_low_yield(search_term, self.min_yield):
+            logging.info(f"Search term '{search_term}' is skipped, as it yielded few new videos before.")
+            return False
+        return True
+
+    async def _fetch_worker(self, video_queue: asyncio.Queue, transcript_queue: asyncio.Queue) -> None:
+        while (item := await video_queue.get()) is not _DONE:
+            video, search_term = item
+            try:
+                await self._with_retries(video, video.fetch_transcript)
+            except Exception:
+                await self._skip(video, search_term, failed=True)
+                continue
+
+            if not video.transcript:
+                logging.info(f"Video {video.video_id} has no transcript and is skipped.")
+                await self._skip(video, search_term, failed=False)
+                continue
+            await transcript_queue.put(item)
+
+    async def _extract_worker(self, transcript_queue: asyncio.Queue, iteration: int) -> None:
+        while (item := await transcript_queue.get()) is not _DONE:
+            video, search_term = item
+            try:
+                narrative_descriptions = await self._with_retries(
+                    video, extract_narratives_chunked, video.transcript, video.get_captions())
+            except Exception:
+                await self._skip(video, search_term, failed=True)
+                continue
+
+            self.content_manager.add_video_narratives(video, narrative_descriptions, search_term, iteration)
+            self._in_flight.discard(video.video_id)
+            self._consecutive_skips = 0
+            await self._budget.release(committed=True)
+            self._finish_video(search_term)
+
+    async def _with_retries(self, video: Video, function, *args):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await asyncio.to_thread(function, *args)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logging.error(f"Error processing video {video.url}: {e}", exc_info=True)
+                    raise
+                get_metrics().count("video_retries", stage="process_video")
+                await asyncio.sleep(backoff_delay(attempt))
+
+    async def _skip(self, video: Video, search_term: str, failed: bool) -> None:
+        self._in_flight.discard(video.video_id)
+        await self._budget.release(committed=False)
+        if failed:
+            self._consecutive_skips += 1
+            if self._consecutive_skips == self.max_skips:
+                # the search term stays unfinished, so a resumed crawl searches it again
+                raise MaxSkipsReachedException(f"{self.max_skips} consecutive videos are skipped due to errors. "
+                                               f"Stopping video processing.")
+        self._finish_video(search_term)
+
+    def _finish_video(self, search_term: str) -> None:
+        """
+        Counts a video of a search term as committed or skipped. When all videos of the term are, the term is
+        recorded as searched in the checkpoint.
+        """
+        self._unfinished_videos[search_term] -= 1
+        if self._unfinished_videos[search_term] == 0:
+            del self._unfinished_videos[search_term]
+            self._checkpoint.searched.add(search_term)
+            self._checkpoint.save()
+
+
+async def _run_workers(count: int, create_worker) -> None:
+    await _gather_or_cancel([create_worker() for _ in range(count)])
+
+
+async def _finish(queue: asyncio.Queue, consumer_count: int) -> None:
+    for _ in range(consumer_count):
+        await queue.put(_DONE)
+
+
+async def _gather_or_cancel(coroutines) -> None:
+    """
+    Runs coroutines concurrently. If one of them fails, the others are cancelled and the exception is raised.
+    """
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
@@ -0,0 +1,266 @@
+import ast
+import functools
+import random
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import ExitStack, contextmanager
+from datetime import date, timedelta
+from unittest import mock
+
+import youtube_transcript_api
+from duckduckgo_search.exceptions import DuckDuckGoSearchException
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from youtube_transcript_api import TooManyRequests, TranscriptsDisabled
+
+import llm_gateway
+import metrics
+import rate_limiter
+import search_cache
+import transcript_store
+import yt_searcher
+from search_cache import normalize_search_term
+from synthetic_corpus import TOPICS, make_narrative, make_transcript
+from utils import estimate_tokens, tokenize_words
+
+# Deterministic local stand-ins for DuckDuckGo, the YouTube transcript API and the OpenAI chat models, for benchmarks
+# without network access and costs. Their responses and failures only depend on their input (and the number of times
+# the same input was seen), never on timing, so runs are reproducible.
+
+
+class FakeRateLimitError(Exception):
+    """Rate-limit error of the fake chat model, retried by the rate limiter like an OpenAI 429."""
+    status_code = 429
+
+
+def _stable_hash(text: str) -> int:
+    return zlib.crc32(text.encode('utf-8'))
+
+
+def _simulate(latency: float, failure_rate: float, key: str, attempts: dict, lock: threading.Lock) -> bool:
+    """
+    Sleeps for about latency seconds and returns True if this attempt for key must fail.
+    """
+    with lock:
+        attempt = attempts.get(key, 0)
+        attempts[key] = attempt + 1
+    if latency:
+        time.sleep(latency * (0.5 + _stable_hash(key) % 1000 / 1000))
+    return _stable_hash(f"{attempt}:{key}") % 10_000 < failure_rate * 10_000
+
+
+def _topic_of(text: str) -> int:
+    words = set(tokenize_words(text))
+    overlaps = [len(words & set(tokenize_words(' '.join(sum(topic, []))))) for topic in TOPICS]
+    return max(range(len(TOPICS)), key=lambda topic: (overlaps[topic], -topic))
+
+
+def _video_id(index: int) -> str:
+    return f"fk{index:09d}"
+
+
+class FakeDDGS:
+    """
+    Stand-in for duckduckgo_search.DDGS. A search returns videos of a fixed universe of video_universe videos,
+    mostly about the topic of the search term, so searches of related terms return overlapping videos.
+    """
+
+    _attempts: dict[str, int] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, video_universe: int = 10_000):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.video_universe = video_universe
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def videos(self, keywords: str, safesearch: str = "moderate", duration: str | None = None,
+               max_results: int | None = None, **kwargs):
+        key = f"{normalize_search_term(keywords)}|{max_results}"
+        if _simulate(self.latency, self.failure_rate, key, self._attempts, self._lock):
+            raise DuckDuckGoSearchException("Ratelimit")
+
+        rng = random.Random(_stable_hash(key))
+        topic = _topic_of(keywords)
+        topic_videos = self.video_universe // len(TOPICS)
+        for _ in range(max_results or 20):
+            index = topic + len(TOPICS) * rng.randrange(topic_videos) if rng.random() < 0.8 \
+                else rng.randrange(self.video_universe)
+            video_rng = random.Random(index)
+            yield {
+                "content": f"https://www.youtube.com/watch?v={_video_id(index)}",
+                "description": make_narrative(video_rng, index % len(TOPICS)),
+                "duration": f"{video_rng.randint(4, 19)}:{video_rng.randint(0, 59):02d}",
+                "published": (date(2023, 9, 1) + timedelta(days=video_rng.randrange(180))).isoformat(),
+                "publisher": "YouTube" if video_rng.random() < 0.9 else "Vimeo",
+                "statistics": {"viewCount": video_rng.randrange(100, 1_000_000)},
+                "title": make_narrative(video_rng, index % len(TOPICS))[:80],
+                "uploader": f"Channel {video_rng.randrange(500)}",
+            }
+
+
+class FakeYouTubeTranscriptApi:
+    """
+    Stand-in for youtube_transcript_api.YouTubeTranscriptApi. Transcripts are mostly about the topic of the video;
+    missing_rate of the videos have no transcript.
+    """
+
+    _attempts: dict[str, int] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, missing_rate: float = 0.1,
+                 sentence_count: int = 60):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.missing_rate = missing_rate
+        self.sentence_count = sentence_count
+
+    def get_transcript(self, video_id: str, languages=('en',), **kwargs) -> list[dict]:
+        if _simulate(self.latency, self.failure_rate, video_id, self._attempts, self._lock):
+            raise TooManyRequests(video_id)
+        rng = random.Random(video_id)
+        if rng.random() < self.missing_rate:
+            raise TranscriptsDisabled(video_id)
+
+        index = int(video_id[2:]) if video_id[2:].isdigit() else _stable_hash(video_id)
+        captions = make_transcript(rng, index % len(TOPICS), self.sentence_count)
+        return [{"text": text, "start": 5.0 * position, "duration": 5.0} for position, text in enumerate(captions)]
+
+
+class FakeChatOpenAI(BaseChatModel):
+    """
+    Stand-in for langchain_openai.ChatOpenAI that answers the prompts of this project with well-formed responses
+    derived from the prompt: narratives are sentences of the transcript, clusters group narratives by their first
+    words, triples split sentences into subject, verb and object, and so on. Token usage is reported like OpenAI
+    does, so the metrics can estimate the cost.
+    """
+
+    model_name: str = "gpt-4-1106-preview"
+    temperature: float = 1
+    max_tokens: int | None = None
+    max_retries: int = 0
+    latency: float = 0.0
+    failure_rate: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-openai"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        prompt = '\n'.join(str(message.content) for message in messages)
+        if _simulate(self.latency, self.failure_rate, prompt, _llm_attempts, _llm_lock):
+            raise FakeRateLimitError("Rate limit reached (fake)")
+
+        text = respond(prompt)
+        token_usage = {"prompt_tokens": estimate_tokens(prompt), "completion_tokens": estimate_tokens(text)}
+        token_usage["total_tokens"] = token_usage["prompt_tokens"] + token_usage["completion_tokens"]
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))],
+                          llm_output={"token_usage": token_usage, "model_name": self.model_name})
+
+
+_llm_attempts: dict[str, int] = {}
+_llm_lock = threading.Lock()
+
+
+class FakeBackend(llm_gateway.LLMBackend):
+    """
+    LLM backend of FakeChatOpenAI models, for llm_gateway.set_llm_backend.
+    """
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.failure_rate = failure_rate
+
+    def create_chat_model(self, model_name: str, temperature: float):
+        return FakeChatOpenAI(model_name=model_name, temperature=temperature, latency=self.latency,
+                              failure_rate=self.failure_rate)
+
+
+def respond(prompt: str) -> str:
+    """
+    Returns the fake LLM response to a prompt of this project, recognized by the objective of the prompt.
+    """
+    data = prompt.split('---')[1].strip() if prompt.count('---') >= 2 else prompt
+
+    if "Create a search term" in prompt:
+        # the search term prompt has a single --- marker: the narrative runs up to the instructions
+        narrative = prompt.split('---', 1)[-1].split('### INSTRUCTIONS', 1)[0]
+        return ' '.join(tokenize_words(narrative)[:5])
+    if "extract and summarize the narratives" in prompt:
+        sentences = list(dict.fromkeys(sentence.strip(' .') + '.' for sentence in data.split('. ') if sentence.strip()))
+        rng = random.Random(_stable_hash(data))
+        return repr(rng.sample(sentences, min(5, len(sentences))))
+    if "Merge narratives that are the same" in prompt:
+        return repr(ast.literal_eval(data)[:10])
+    if "Cluster these narratives" in prompt:
+        clusters = {}
+        for narrative_id, description in ast.literal_eval(data).items():
+            clusters.setdefault(' '.join(tokenize_words(description)[:2]), []).append((narrative_id, description))
+        return repr([(members[0][1], [narrative_id for narrative_id, _ in members]) for members in clusters.values()])
+    if "Extract triples for each narrative" in prompt:
+        narratives = ast.literal_eval(data)
+        return repr({narrative_id: _triples(description) for narrative_id, description in narratives.items()})
+    if "Extract triples for this text" in prompt:
+        return repr(_triples(data))
+    if "are synonyms or alternative phrasings" in prompt:
+        mapping = {}
+        for line in data.splitlines():
+            group = ast.literal_eval(line)
+            for phrase in group[1:]:
+                if tokenize_words(phrase)[-1:] == tokenize_words(group[0])[-1:]:
+                    mapping[phrase] = group[0]
+        return repr(mapping)
+    return ""
+
+
+def _triples(description: str) -> list[tuple]:
+    triples = []
+    for sentence in description.split('. '):
+        words = sentence.strip(' .').split()
+        if len(words) >= 3:
+            triples.append((' '.join(words[:-2]), words[-2], words[-1]))
+    return triples
+
+
+@contextmanager
+def fake_services(latency: float = 0.0,
+                  failure_rate: float = 0.0,
+                  missing_transcript_rate: float = 0.1,
+                  video_universe: int = 10_000):
+    """
+    Context manager that replaces DuckDuckGo, the YouTube transcript API and the OpenAI chat models by the fakes,
+    disables the rate limits, the LLM and search caches, and uses an empty transcript store and fresh metrics.
+
+    Args:
+    latency (float): The average latency in seconds of each fake call.
+    failure_rate (float): The fraction of fake calls that fail with a transient error.
+    missing_transcript_rate (float): The fraction of videos without a transcript.
+    video_universe (int): The number of distinct videos the fake searches return.
+    """
+    unlimited = {key: {"requests_per_minute": None, "tokens_per_minute": None} for key in rate_limiter.DEFAULT_LIMITS}
+    with tempfile.TemporaryDirectory() as directory, ExitStack() as stack:
+        store = transcript_store.TranscriptStore(f"{directory}/transcripts.sqlite")
+        stack.callback(store.close)
+        for target, attribute, value in (
+                (yt_searcher, 'DDGS', functools.partial(FakeDDGS, latency, failure_rate, video_universe)),
+                (youtube_transcript_api, 'YouTubeTranscriptApi',
+                 FakeYouTubeTranscriptApi(latency, failure_rate, missing_transcript_rate)),
+                (llm_gateway, '_llm_backend', FakeBackend(latency, failure_rate)),
+                (rate_limiter, '_buckets', {}),
+                (rate_limiter, '_rate_limiters', {}),
+                (llm_gateway, '_cache_disabled', True),
+                (search_cache, '_cache_disabled', True),
+                (transcript_store, '_transcript_store', store),
+                (metrics, '_metrics', metrics.Metrics())):
+            stack.enter_context(mock.patch.object(target, attribute, value))
+        stack.enter_context(mock.patch.dict(rate_limiter.DEFAULT_LIMITS, unlimited))
+        yield
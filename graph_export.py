@@ -0,0 +1,162 @@
+import json
+import os
+from collections import Counter, deque
+from xml.sax.saxutils import quoteattr
+
+
+def build_graph(triples):
+    """
+    Creates a directed multigraph of triples. Each triple is an edge from subject to object, keyed by its
+    predicate, so edges with different predicates between the same entities are all kept.
+
+    Returns:
+    networkx.MultiDiGraph: The graph.
+    """
+    import networkx as nx
+
+    graph = nx.MultiDiGraph()
+    for subject, predicate, obj in triples:
+        graph.add_edge(subject, obj, key=predicate, title=predicate)
+    return graph
+
+
+def export_edge_list(triples, output_path: str) -> int:
+    """
+    Writes triples as a tab-separated edge list (subject, predicate, object), one triple per line.
+
+    Returns:
+    int: The number of written triples.
+    """
+    count = 0
+    with open(output_path, 'w') as file:
+        for subject, predicate, obj in triples:
+            file.write('\t'.join(_single_line(part) for part in (subject, predicate, obj)) + '\n')
+            count += 1
+    return count
+
+
+def export_json_lines(triples, output_path: str, narrative_ids: dict[tuple, list[int]] | None = None) -> int:
+    """
+    Writes triples as JSON lines with subject, predicate and object, and optionally the IDs of the narratives
+    each triple was extracted from.
+
+    Returns:
+    int: The number of written triples.
+    """
+    count = 0
+    with open(output_path, 'w') as file:
+        for triple in triples:
+            record = {"subject": triple[0], "predicate": triple[1], "object": triple[2]}
+            if narrative_ids is not None:
+                record["narratives"] = narrative_ids.get(tuple(triple), [])
+            file.write(json.dumps(record) + '\n')
+            count += 1
+    return count
+
+
+def export_graphml(triples, output_path: str) -> int:
+    """
+    Writes triples as a directed GraphML multigraph. Nodes and edges are streamed to the file as the triples are
+    read, so no graph object is built in memory; only the set of written node names is kept.
+
+    Returns:
+    int: The number of written edges.
+    """
+    written_nodes = set()
+    count = 0
+    with open(output_path, 'w', encoding='utf-8') as file:
+        file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+                   '  <key id="predicate" for="edge" attr.name="predicate" attr.type="string"/>\n'
+                   '  <graph edgedefault="directed">\n')
+        for subject, predicate, obj in triples:
+            for node in (subject, obj):
+                if node not in written_nodes:
+                    written_nodes.add(node)
+                    file.write(f'    <node id={quoteattr(node)}/>\n')
+            file.write(f'    <edge source={quoteattr(subject)} target={quoteattr(obj)}>'
+                       f'<data key="predicate">{_escape_text(predicate)}</data></edge>\n')
+            count += 1
+        file.write('  </graph>\n</graphml>\n')
+    return count
+
+
+def top_degree_view(triples, k: int = 100) -> list[tuple]:
+    """
+    Returns the triples between the k entities with the highest degree.
+    """
+    triples = list(triples)
+    degree = Counter()
+    for subject, _, obj in triples:
+        degree[subject] += 1
+        degree[obj] += 1
+    top_nodes = {node for node, _ in degree.most_common(k)}
+    return [triple for triple in triples if triple[0] in top_nodes and triple[2] in top_nodes]
+
+
+def ego_view(triples, entity: str, radius: int = 1, max_edges: int = 1000) -> list[tuple]:
+    """
+    Returns the triples of the ego-network of an entity: all triples between entities that are at most radius
+    steps away from it (in either direction), up to max_edges triples, nearest first.
+    """
+    triples = list(triples)
+    adjacency = {}
+    for index, (subject, _, obj) in enumerate(triples):
+        adjacency.setdefault(subject, []).append((index, obj))
+        adjacency.setdefault(obj, []).append((index, subject))
+
+    distance = {entity: 0}
+    queue = deque([entity])
+    edge_indices = {}
+    while queue and len(edge_indices) < max_edges:
+        node = queue.popleft()
+        for index, neighbor in adjacency.get(node, []):
+            if neighbor not in distance:
+                if distance[node] == radius:
+                    continue
+                distance[neighbor] = distance[node] + 1
+                queue.append(neighbor)
+            edge_indices.setdefault(index, None)
+            if len(edge_indices) >= max_edges:
+                break
+    return [triples[index] for index in edge_indices]
+
+
+def narrative_view(narrative_triples: list[tuple], entity_map: dict[str, str],
+                   predicate_map: dict[str, str]) -> list[tuple]:
+    """
+    Returns the standardized triples of a single narrative.
+
+    Args:
+    narrative_triples (list[tuple]): The raw triples of the narrative, e.g. from TripleStore.get_triples.
+    entity_map (dict[str, str]): The entity mapping of the standardization.
+    predicate_map (dict[str, str]): The predicate mapping of the standardization.
+    """
+    return list(dict.fromkeys((entity_map.get(s, s), predicate_map.get(p, p), entity_map.get(o, o))
+                              for s, p, o in narrative_triples))
+
+
+def render_view(triples, output_path: str, max_edges: int = 2000) -> int:
+    """
+    Renders triples as an interactive directed HTML graph with pyvis. At most max_edges triples are rendered, so
+    render time and file size stay bounded; use one of the view functions to choose which triples to render.
+
+    Returns:
+    int: The number of rendered triples.
+    """
+    from pyvis.network import Network
+
+    triples = list(triples)[:max_edges]
+    net = Network(notebook=False, height="750px", width="100%", directed=True)
+    net.from_nx(build_graph(triples))
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    net.save_graph(output_path)
+    return len(triples)
+
+
+def _single_line(text: str) -> str:
+    return text.replace('\t', ' ').replace('\n', ' ')
+
+
+def _escape_text(text: str) -> str:
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
@@ -1,69 +1,99 @@
 import os
+from contextlib import nullcontext
 
-from pyvis.network import Network
-import networkx as nx
-
+from cassette import REPLAY, use_cassette
+from content_journal import open_content_manager
 from content_manager import ContentManager
-from triples_extraction import extract_triples
-from triples_standardization import standardize_triples
-from utils import write_to_file, read_from_file
-
-
-def visualize_knowledge_graph(triples, output_path):
-    # Create a NetworkX graph
-    G = nx.Graph()
-    for node1, edge, node2 in triples:
-        G.add_node(node1)
-        G.add_node(node2)
-        G.add_edge(node1, node2, title=edge)
-
-    # Initialize PyVis network without assuming Jupyter Notebook
-    net = Network(notebook=False, height="750px", width="100%")
-    net.from_nx(G)
-
-    # Save the graph to the specified directory
-    net.save_graph(output_path)
-
-
-def create_knowledge_graph(content_manager: ContentManager):
-
+from graph_export import export_json_lines, render_view, top_degree_view, narrative_view
+from metrics import get_metrics
+from triple_store import TripleStore, DEFAULT_TRIPLE_STORE_PATH
+from triples_extraction import extract_triples_batched
+from triples_standardization import build_standardization_mapping, apply_standardization_mapping
+from utils import write_to_file
+
+
+def visualize_knowledge_graph(triples, output_path, max_nodes=300, max_edges=2000):
+    """
+    Renders the knowledge graph as a directed multigraph in HTML. Large graphs are reduced to the triples between
+    the max_nodes entities with the highest degree, so the page stays usable; see graph_export for other views
+    and for exports of the full graph.
+    """
+    triples = list(triples)
+    if len(triples) > max_edges:
+        triples = top_degree_view(triples, max_nodes)
+    render_view(triples, output_path, max_edges)
+
+
+def create_knowledge_graph(content_manager: ContentManager, triple_store_path: str = DEFAULT_TRIPLE_STORE_PATH):
+    """
+    Creates (or updates) the knowledge graph of the twice merged narratives. Triples are only extracted for
+    narratives that are new or changed since the last build, and only their triples are standardized, against
+    the canonical vocabulary of the previous builds. The output files are only rewritten if the graph changed.
+    """
     kg_triples_path = os.path.abspath('./data/knowledge_graph.txt')
     kg_graph_path = os.path.abspath('./data/knowledge_graph.html')
+    kg_jsonl_path = os.path.abspath('./data/knowledge_graph.jsonl')
 
     # get the twice merged narratives (with iteration max_iterations + 1 = 4)
-    narratives = [n for n in content_manager.narratives.values() if n.iteration == 4]
+    narrative_id_desc_map = {n.narrative_id: n.description for n in content_manager.get_narratives_by_iteration(4)}
+
+    # extract the triples of new and changed narratives
+    triple_store = TripleStore(triple_store_path)
+    changed_narratives = triple_store.changed_narratives(narrative_id_desc_map)
+    removed_narratives = triple_store.retain(narrative_id_desc_map)
+    for narrative_id, triples in extract_triples_batched(changed_narratives).items():
+        triple_store.set_triples(narrative_id, changed_narratives[narrative_id], triples)
+
+    # standardize the new triples against the existing canonical vocabulary
+    new_triples = sorted(triple_store.get_triples(changed_narratives), key=lambda x: ''.join(x))
+    triple_store.entity_map, triple_store.predicate_map = build_standardization_mapping(
+        new_triples, entity_map=triple_store.entity_map, predicate_map=triple_store.predicate_map)
+    triple_store.save()
 
-    # collect all triples
-    all_triples = set()
-    for narrative in narratives:
-        triples = extract_triples(narrative.description)
-        all_triples.update(triples)
+    if not changed_narratives and not removed_narratives and os.path.exists(kg_triples_path) \
+            and os.path.exists(kg_graph_path):
+        return kg_triples_path, kg_graph_path  # nothing changed since the last build
 
-    # standardize triples
-    sorted_triples = sorted(all_triples, key=lambda x: ''.join(x))
-    standardized_triples = standardize_triples(sorted_triples)
+    standardized_triples = apply_standardization_mapping(triple_store.get_triples(narrative_id_desc_map),
+                                                         triple_store.entity_map, triple_store.predicate_map)
 
     # same triples as text file
     write_to_file(kg_triples_path, str(sorted(standardized_triples, key=lambda x: ''.join(x))))
+    # stream the triples with the narratives they come from as JSON lines
+    narrative_ids = {}
+    for narrative_id in sorted(narrative_id_desc_map):
+        for triple in narrative_view(triple_store.get_triples([narrative_id]),
+                                     triple_store.entity_map, triple_store.predicate_map):
+            narrative_ids.setdefault(triple, []).append(narrative_id)
+    export_json_lines(standardized_triples, kg_jsonl_path, narrative_ids)
     # visualize graph in HTML
     visualize_knowledge_graph(list(standardized_triples), kg_graph_path)
 
     return kg_triples_path, kg_graph_path
 
 
-def main(content_file_path: str):
+def main(content_file_path: str,
+         content_store_dir: str = './data/content_store',
+         cassette_path: str | None = None,
+         cassette_mode: str = REPLAY):
     try:
-        if os.path.exists(content_file_path):
-            content_manager = ContentManager()
-            content_json = read_from_file(content_file_path)
-            content_manager.deserialize(content_json)
-            kg_triples_path, kg_graph_path = create_knowledge_graph(content_manager)
+        if os.path.exists(content_file_path) or os.path.exists(content_store_dir):
+            content_manager, journal = open_content_manager(content_store_dir, legacy_json_path=content_file_path)
+            journal.close()
+            # with a cassette, the triple extraction and standardization calls are recorded or replayed
+            with use_cassette(cassette_path, cassette_mode) if cassette_path else nullcontext():
+                kg_triples_path, kg_graph_path = create_knowledge_graph(content_manager)
             print(f"Knowledge graph created:\n{kg_triples_path}\n{kg_graph_path}")
         else:
             print(f"File not found: {content_file_path}")
     except Exception as e:
         print(f"Exception while creating a knowledge graph: {e}")
+    finally:
+        json_path, _ = get_metrics().write_report('knowledge_graph')
+        print(f"Run report written to {json_path}")
 
 
 if __name__ == '__main__':
-    main('./data/content.json')
+    main('./data/content.json',
+         cassette_path=os.environ.get('NARRATIVE_CASSETTE'),
+         cassette_mode=os.environ.get('NARRATIVE_CASSETTE_MODE', REPLAY))
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class LLMCache:
+    """
+    Persistent, content-addressed cache for LLM responses, stored in SQLite.
+
+    Entries are keyed on a hash of the prompt template, the prompt inputs and the model parameters. The cache
+    is shared by all LLM calls, evicts the least recently used entries when it grows beyond max_size_bytes and
+    treats entries older than ttl_seconds as missing.
+
+    Processes on several hosts that share the cache file must open it with journal_mode DELETE, as the default
+    WAL mode only works on one host.
+    """
+
+    def __init__(self, db_path: str, max_size_bytes: int = 256 * 1024 * 1024, ttl_seconds: float | None = None,
+                 journal_mode: str = 'WAL'):
+        self.db_path = db_path
+        self.max_size_bytes = max_size_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute(f"PRAGMA journal_mode={journal_mode}")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS entries (
+                                        key TEXT PRIMARY KEY,
+                                        value TEXT NOT NULL,
+                                        size INTEGER NOT NULL,
+                                        created_at REAL NOT NULL,
+                                        accessed_at REAL NOT NULL)""")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+        self._connection.commit()
+        self._total_size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    @staticmethod
+    def make_key(prompt_template: str, inputs: dict, model_name: str, temperature: float, **model_params) -> str:
+        """
+        Creates the cache key for an LLM call.
+
+        Args:
+        prompt_template (str): The prompt template text.
+        inputs (dict): The values of the prompt's input variables.
+        model_name (str): The name of the model.
+        temperature (float): The sampling temperature.
+        model_params: Any other model parameters that influence the response, e.g. max_tokens.
+
+        Returns:
+        str: A SHA-256 hex digest identifying the call.
+        """
+        data = {
+            "template": prompt_template,
+            "inputs": inputs,
+            "model_name": model_name,
+            "temperature": temperature,
+            "model_params": model_params,
+        }
+        return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        """
+        Returns the cached response for a key, or None if it is missing or expired.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute("SELECT value, size, created_at FROM entries WHERE key = ?",
+                                           (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            value, size, created_at = row
+            if self.ttl_seconds is not None and created_at + self.ttl_seconds < now:
+                self._connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._connection.commit()
+                self._total_size -= size
+                self.misses += 1
+                return None
+
+            self._connection.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+            self._connection.commit()
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        """
+        Stores a response and evicts least recently used entries if the cache is too large.
+        """
+        now = time.time()
+        size = len(value.encode('utf-8'))
+        with self._lock:
+            row = self._connection.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._total_size -= row[0]
+            self._connection.execute("INSERT OR REPLACE INTO entries (key, value, size, created_at, accessed_at) "
+                                     "VALUES (?, ?, ?, ?, ?)", (key, value, size, now, now))
+            self._total_size += size
+            self._evict()
+            self._connection.commit()
+
+    def _evict(self) -> None:
+        while self._total_size > self.max_size_bytes:
+            rows = self._connection.execute("SELECT key, size FROM entries ORDER BY accessed_at LIMIT 100").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self._total_size <= self.max_size_bytes:
+                    break
+                self._connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._total_size -= size
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        """
+        Returns the hit/miss counters and the current size of the cache.
+        """
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": entries,
+            "size_bytes": self._total_size,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,273 @@
+import asyncio
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cassette import through_cassette
+from llm_cache import LLMCache
+from metrics import get_metrics
+from rate_limiter import get_rate_limiter
+from utils import estimate_tokens
+
+DEFAULT_CACHE_PATH = './data/llm_cache.sqlite'
+
+_llm_cache: LLMCache | None = None
+_cache_disabled = False
+
+_llm_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_llm_cache() -> LLMCache | None:
+    """
+    Returns the LLM cache shared by all LLM calls, creating it on first use. Returns None if caching is disabled.
+    """
+    global _llm_cache
+    if _cache_disabled:
+        return None
+    if _llm_cache is None:
+        os.makedirs(os.path.dirname(DEFAULT_CACHE_PATH), exist_ok=True)
+        _llm_cache = LLMCache(DEFAULT_CACHE_PATH)
+    return _llm_cache
+
+
+def set_llm_cache(cache: LLMCache | None) -> None:
+    """
+    Replaces the shared LLM cache. Pass None to disable caching.
+    """
+    global _llm_cache, _cache_disabled
+    _llm_cache = cache
+    _cache_disabled = cache is None
+
+
+class PromptChain:
+    """
+    A parsed prompt template and the chat model its prompts are sent to, reused by all calls of the prompt.
+    """
+    __slots__ = ('prompt_template', 'chat_model', 'max_tokens')
+
+    def __init__(self, prompt_template, chat_model, max_tokens: int):
+        self.prompt_template = prompt_template
+        self.chat_model = chat_model
+        self.max_tokens = max_tokens
+
+    def invoke(self, inputs: dict) -> str:
+        """
+        Sends the prompt with the given inputs to the chat model and returns the response text.
+        """
+        # the chat model is called directly, as an LLMChain or runnable sequence adds a millisecond per call
+        message = self.chat_model.invoke(self.prompt_template.format_prompt(**inputs), max_tokens=self.max_tokens)
+        return message.content
+
+
+class LLMBackend:
+    """
+    Creates the chat models of the LLM calls. Each chat model is created once per model and temperature and
+    reused by all calls, and so is the chain of each prompt, so clients, their HTTP connections and parsed prompt
+    templates are not rebuilt for every call. Subclasses implement create_chat_model.
+    """
+
+    def __init__(self):
+        self._chat_models = {}
+        self._chains = {}
+        self._lock = threading.Lock()
+
+    def create_chat_model(self, model_name: str, temperature: float):
+        """
+        Returns a new langchain chat model. max_tokens is passed per call, so it is not a parameter here.
+        """
+        raise NotImplementedError
+
+    def get_chain(self, prompt_text: str, model_name: str, temperature: float, max_tokens: int) -> PromptChain:
+        """
+        Returns the chain of a prompt template and a chat model, creating it on first use.
+        """
+        key = (prompt_text, model_name, temperature, max_tokens)
+        with self._lock:
+            chain = self._chains.get(key)
+            if chain is None:
+                from langchain.prompts import PromptTemplate
+
+                chat_model = self._chat_models.get((model_name, temperature))
+                if chat_model is None:
+                    chat_model = self.create_chat_model(model_name, temperature)
+                    self._chat_models[(model_name, temperature)] = chat_model
+                chain = PromptChain(PromptTemplate.from_template(prompt_text), chat_model, max_tokens)
+                self._chains[key] = chain
+        return chain
+
+    def close(self) -> None:
+        pass
+
+
+class OpenAIBackend(LLMBackend):
+    """
+    Backend of the OpenAI chat models. All models share one OpenAI client with a pooled HTTP transport, so
+    connections are kept alive and reused by all calls and threads.
+    """
+
+    def __init__(self, max_connections: int = 20, timeout: float = 120):
+        super().__init__()
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._client = None
+
+    def create_chat_model(self, model_name: str, temperature: float):
+        import httpx
+        import openai
+        from langchain_openai import ChatOpenAI
+
+        if self._client is None:
+            limits = httpx.Limits(max_connections=self.max_connections,
+                                  max_keepalive_connections=self.max_connections)
+            # retries are done by the rate limiter, which honors Retry-After and is shared by all threads
+            self._client = openai.OpenAI(max_retries=0, timeout=self.timeout,
+                                         http_client=httpx.Client(limits=limits, timeout=self.timeout))
+        return ChatOpenAI(model_name=model_name, temperature=temperature, max_retries=0,
+                          client=self._client.chat.completions)
+
+    def close(self) -> None:
+        if self._client is not None:
+            self._client.close()
+
+
+def get_llm_backend() -> LLMBackend:
+    """
+    Returns the backend of all LLM calls, creating the OpenAI backend on first use.
+    """
+    global _llm_backend
+    with _backend_lock:
+        if _llm_backend is None:
+            _llm_backend = OpenAIBackend()
+        return _llm_backend
+
+
+def set_llm_backend(backend: LLMBackend | None) -> None:
+    """
+    Replaces the backend of all LLM calls, e.g. by a fake backend in benchmarks (see fakes.py). Pass None to use
+    the OpenAI backend again.
+    """
+    global _llm_backend
+    with _backend_lock:
+        _llm_backend = backend
+
+
+def invoke(prompt_text: str,
+           inputs: dict,
+           model_name: str,
+           max_tokens: int,
+           temperature: float = 1,
+           output_parser=None):
+    """
+    Runs a prompt through the LLM chain of the backend, serving identical calls from the shared LLM cache.
+
+    The raw response text is cached only after it has been parsed successfully, so responses that fail the
+    output parser are retried instead of being served from the cache.
+
+    Calls that are not cached go through the shared rate limiter of the model (see rate_limiter.py), which keeps
+    the requests and tokens per minute within the limits and retries transient errors with backoff. Their tokens
+    and estimated cost are recorded in the metrics, for the stage that is running (see metrics.py). When a
+    cassette is active (see cassette.py), the response text is recorded to or replayed from the cassette.
+
+    Args:
+    prompt_text (str): The prompt template text.
+    inputs (dict): The values for the input variables of the prompt template.
+    model_name (str): The name of the OpenAI model.
+    max_tokens (int): The maximum number of tokens in the response.
+    temperature (float): The sampling temperature.
+    output_parser (BaseOutputParser | None): Parser for the response text. If None, the text is returned as is.
+
+    Returns:
+    The parsed response.
+    """
+    cache = get_llm_cache()
+    key = LLMCache.make_key(prompt_text, inputs, model_name, temperature, max_tokens=max_tokens)
+
+    text = cache.get(key) if cache else None
+    if text is not None:
+        get_metrics().count("llm_cache_hits")
+        return output_parser.parse(text) if output_parser else text
+
+    def generate() -> str:
+        # imported on the first call that is not cached, as the langchain libraries take seconds to import
+        from langchain_community.callbacks import get_openai_callback
+
+        chain = get_llm_backend().get_chain(prompt_text, model_name, temperature, max_tokens)
+        tokens = estimate_tokens(prompt_text) + sum(estimate_tokens(str(value)) for value in inputs.values()) \
+            + max_tokens
+        with get_openai_callback() as callback:
+            response = get_rate_limiter("openai", model_name).call(chain.invoke, inputs, tokens=tokens)
+        get_metrics().record_llm_usage(model_name, callback.prompt_tokens, callback.completion_tokens,
+                                       callback.total_cost)
+        return response
+
+    text = through_cassette("llm", key, generate)
+
+    try:
+        result = output_parser.parse(text) if output_parser else text
+    except Exception:
+        get_metrics().count("parse_failures")
+        raise
+
+    if cache:
+        cache.set(key, text)
+    return result
+
+
+def batch(prompt_text: str,
+          inputs_list: list[dict],
+          model_name: str,
+          max_tokens: int,
+          temperature: float = 1,
+          output_parser=None,
+          max_concurrency: int = 4,
+          return_exceptions: bool = False) -> list:
+    """
+    Runs a prompt for each of several inputs, with up to max_concurrency calls at a time on the shared chat model
+    of the backend. Each call is cached, rate limited and recorded like a call of invoke.
+
+    Args:
+    prompt_text (str): The prompt template text.
+    inputs_list (list[dict]): The values for the input variables of the prompt template, per call.
+    model_name (str): The name of the OpenAI model.
+    max_tokens (int): The maximum number of tokens in each response.
+    temperature (float): The sampling temperature.
+    output_parser (BaseOutputParser | None): Parser for the response texts. If None, the texts are returned as is.
+    max_concurrency (int): The maximum number of concurrent calls.
+    return_exceptions (bool): If True, the exception of a failed call is returned in its place; otherwise the
+    first exception is raised.
+
+    Returns:
+    list: The parsed responses, in the order of inputs_list.
+    """
+    def call(inputs):
+        try:
+            return invoke(prompt_text, inputs, model_name, max_tokens, temperature, output_parser)
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            return e
+
+    if len(inputs_list) <= 1 or max_concurrency <= 1:
+        return [call(inputs) for inputs in inputs_list]
+    with ThreadPoolExecutor(max_workers=min(max_concurrency, len(inputs_list))) as executor:
+        # each call runs in a copy of the caller's context, so its LLM usage is attributed to the caller's stage
+        futures = [executor.submit(contextvars.copy_context().run, call, inputs) for inputs in inputs_list]
+        return [future.result() for future in futures]
+
+
+async def abatch(prompt_text: str,
+                 inputs_list: list[dict],
+                 model_name: str,
+                 max_tokens: int,
+                 temperature: float = 1,
+                 output_parser=None,
+                 max_concurrency: int = 4,
+                 return_exceptions: bool = False) -> list:
+    """
+    Async version of batch, for the asyncio crawler. The calls run in worker threads, as the rate limiters and
+    the LLM cache are synchronous.
+    """
+    return await asyncio.to_thread(batch, prompt_text, inputs_list, model_name, max_tokens, temperature,
+                                   output_parser, max_concurrency, return_exceptions)
@@ -1,13 +1,23 @@
-import os
 import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime
 
 from tqdm import tqdm
 
+from cassette import REPLAY, use_cassette
+from content_journal import DEFAULT_STORE_DIR, open_content_manager
 from content_manager import ContentManager
-from narrative_extraction import extract_narratives
-from search_term_creation import create_search_term
-from utils import write_to_file, read_from_file
+from crawl_checkpoint import CrawlCheckpoint
+from crawler import MaxSkipsReachedException, PipelinedCrawler
+from metrics import get_metrics
+from narrative_extraction import fetch_video_narratives
+from relevance import RelevanceFilter
+from search_cache import SearchedTerms, get_search_cache
+from search_term_creation import create_search_terms
+from work_queue import FAILED, WorkQueue, open_shared_caches
 from yt_searcher import search_videos
 
 
@@ -20,84 +30,203 @@ logging.basicConfig(
 )
 
 
-class MaxSkipsReachedException(Exception):
-    """Exception raised when the maximum number of consecutive skips is reached."""
-    pass
-
+def main(pipelined: bool = True,
+         content_store_dir: str = DEFAULT_STORE_DIR,
+         cassette_path: str | None = None,
+         cassette_mode: str = REPLAY,
+         resume: bool = False,
+         queue_path: str | None = None):
+    """
+    Crawls videos and narratives, starting from the search term "Israel Hamas".
 
-def main():
+    Args:
+    pipelined (bool): Whether to use the pipelined crawler instead of the level-by-level thread pool.
+    content_store_dir (str): The directory of the journaled content store.
+    cassette_path (str | None): If given, all searches, transcript fetches and LLM calls are recorded to or
+    replayed from this cassette file (see cassette.py). The crawl is then always sequential, as the order of the
+    requests of a concurrent crawl depends on timing, so it cannot be replayed.
+    cassette_mode (str): "record" or "replay".
+    resume (bool): Whether to continue the crawl of the checkpoint in the content store (see crawl_checkpoint.py),
+    e.g. after it stopped because of too many failed videos. If False, a new crawl is started.
+    queue_path (str | None): If given, videos are processed by worker processes through the work queue in this
+    file (see work_queue.py) and the level-by-level expansion coordinates them. Cannot be combined with a
+    cassette, as the requests of the worker processes do not go through it.
+    """
+    if cassette_path and queue_path:
+        raise ValueError("A crawl with a work queue cannot be recorded to or replayed from a cassette.")
+    if cassette_path and pipelined:
+        logging.info("The sequential crawl is used, as the pipelined crawl cannot be replayed from a cassette.")
+        pipelined = False
     start_date = datetime(2023, 10, 7)
-    content_manager = ContentManager()
-    logging.info("ContentManager initialized")
-
-    json_path = './data/content.json'
-    if os.path.exists(json_path):
-        content_json = read_from_file(json_path)
-        content_manager.deserialize(content_json)
 
-    narrative_count = len(content_manager.narratives)
-    video_count = len(content_manager.videos)
+    # every mutation is journaled, so work is persisted incrementally; content.json is only imported once
+    content_manager, journal = open_content_manager(content_store_dir, legacy_json_path='./data/content.json')
+    logging.info("ContentManager initialized")
+    checkpoint = CrawlCheckpoint.open(content_store_dir, resume)
+    work_queue = None
+    if queue_path:
+        open_shared_caches()  # the workers, possibly on other hosts, use the same caches
+        work_queue = WorkQueue(queue_path)
+        if not resume:
+            work_queue.clear()  # jobs of an earlier crawl
 
     try:
-        iterative_narrative_expansion(content_manager,
-                                      "Israel Hamas",
-                                      start_date,
-                                      max_iterations=3,
-                                      max_total_videos=500)
+        with use_cassette(cassette_path, cassette_mode) if cassette_path else nullcontext():
+            if pipelined and work_queue is None:
+                crawler = PipelinedCrawler(content_manager, start_date, max_total_videos=500)
+                crawler.run("Israel Hamas", max_iterations=3, checkpoint=checkpoint)
+            else:
+                iterative_narrative_expansion(content_manager,
+                                              "Israel Hamas",
+                                              start_date,
+                                              max_iterations=3,
+                                              max_total_videos=500,
+                                              checkpoint=checkpoint,
+                                              work_queue=work_queue)
     except Exception as e:
         logging.error(f"Searching and processing videos is interrupted: {e}", exc_info=True)
-
-    # serialize
-    if len(content_manager.narratives) != narrative_count or len(content_manager.videos) != video_count:
-        content_json = content_manager.serialize()
-        write_to_file(json_path, content_json)
+    finally:
+        if work_queue:
+            work_queue.close()
+        journal.compact()
+        journal.close()
+        json_path, _ = get_metrics().write_report('crawl')
+        logging.info(f"Run report written to {json_path}")
 
 
 def iterative_narrative_expansion(content_manager: ContentManager,
                                   initial_search_term: str,
                                   start_date: datetime,
                                   max_iterations: int,
-                                  max_total_videos: int):
+                                  max_total_videos: int,
+                                  max_workers: int = 4,
+                                  min_yield: float = 0.1,
+                                  min_relevance: float | None = 0.15,
+                                  checkpoint: CrawlCheckpoint | None = None,
+                                  work_queue: WorkQueue | None = None):
     """
     Iteratively expands the search for videos based on narratives using a BFS approach.
     Narratives are merged after completing each BFS level.
 
+    The BFS state is kept in a crawl checkpoint, which is saved after every search term and every merge. If the
+    checkpoint is of an interrupted crawl, the crawl continues where it stopped: searched terms and completed
+    merges are not done again, and an interrupted merge is discarded and done again. Videos of an interrupted
+    search that are already in the (journaled) content manager are not processed again.
+
+    With a work queue, the videos of each search are queued instead of processed, and worker processes (see
+    work_queue.run_worker) process them. Before a level is merged, this function waits until the jobs of the
+    level are drained and commits their results to the content manager. Queued videos count as processed for
+    max_total_videos.
+
     Args:
     content_manager (ContentManager): The content manager instance.
     initial_search_term (str): The initial search term for videos.
     start_date (datetime): The starting date for video search.
     max_iterations (int): Maximum number of iterations for the BFS loop.
     max_total_videos (int): Maximum total number of videos to process.
+    max_workers (int): Maximum number of videos processed concurrently.
+    min_yield (float): Search terms whose earlier searches had a lower fraction of new videos are skipped.
+    min_relevance (float | None): The minimum relevance score (see relevance.py) of a video, against the search
+    term and the initial search term, to be processed. If None, all new videos are processed.
+    checkpoint (CrawlCheckpoint | None): The BFS state, new or of an interrupted crawl. If None, the state is not
+    saved.
+    work_queue (WorkQueue | None): The queue of video jobs for worker processes. If None, videos are processed
+    by a thread pool in this process.
     """
-    iteration = 1
-    searched = set()
-    search_queue = [(initial_search_term, max_iterations, True)]
-
-    while search_queue and len(content_manager.videos) < max_total_videos:
-        current_search_term, current_depth, merge_flag = search_queue.pop(0)
+    relevance_filter = RelevanceFilter(initial_search_term, min_relevance) if min_relevance is not None else None
+    state = checkpoint or CrawlCheckpoint()
+    if state.started:
+        state.check_crawl(initial_search_term, max_iterations)
+    else:
+        state.start(initial_search_term, max_iterations, content_manager.next_narrative_id)
+        state.save()
+    if state.finished:
+        logging.info("The crawl of the checkpoint is already finished.")
+        return
+
+    while True:
+        if state.seed_narrative_ids:
+            _queue_seed_search_terms(content_manager, state, max_workers)
+        queued_count = sum(1 for video_id in work_queue.queued_video_ids(state.iteration)
+                           if video_id not in content_manager.videos) if work_queue else 0
+        if not state.search_queue or len(content_manager.videos) + queued_count >= max_total_videos:
+            break
+        current_search_term, current_depth, merge_flag = state.search_queue[0]
 
         # Calculate max_results based on the current depth
         max_results = 2 ** (current_depth + 2)  # 32, 16, 8 for 3 iterations
 
-        if current_search_term not in searched:
-            search_and_process_videos(content_manager, current_search_term, start_date, iteration, max_results)
-            searched.add(current_search_term)
+        # searched terms also match terms that only differ in word order, case or punctuation
+        if _should_search(current_search_term, state.searched, min_yield):
+            search_and_process_videos(content_manager, current_search_term, start_date, state.iteration,
+                                      max_results, max_workers=max_workers, relevance_filter=relevance_filter,
+                                      work_queue=work_queue)
+            state.searched.add(current_search_term)
 
         if merge_flag:
-            narratives_to_merge = [n for n in content_manager.narratives.values() if n.iteration == iteration]
-            new_narratives = content_manager.cluster_and_merge_narratives(narratives_to_merge, iteration)
-            iteration += 1
-            if iteration > max_iterations:
-                break
-
-            for idx, narrative in enumerate(new_narratives):
-                narrative.search_term = create_search_term(narrative.description)
-                merge_flag = idx == len(new_narratives) - 1  # Set merge_flag to True for the last narrative
-                search_queue.append((narrative.search_term, current_depth - 1, merge_flag))
+            state.save()  # so the search is not repeated if the merge is interrupted
+            if work_queue:
+                _commit_queued_level(content_manager, work_queue, state.iteration)
+            state.discard_unfinished_merge(content_manager, state.iteration)
+            narratives_to_merge = content_manager.get_narratives_by_iteration(state.iteration)
+            new_narratives = content_manager.cluster_and_merge_narratives(narratives_to_merge, state.iteration)
+            state.merged_iterations.append(state.iteration)
+            state.iteration += 1
+            if state.iteration <= max_iterations:
+                state.seed_narrative_ids = [narrative.narrative_id for narrative in new_narratives]
+
+        state.search_queue.pop(0)
+        state.save()
 
     # do a final merge of all merged narratives
-    narratives_to_merge = [n for n in content_manager.narratives.values() if n.is_merged]
-    content_manager.cluster_and_merge_narratives(narratives_to_merge, iteration)
+    if work_queue:
+        _commit_queued_level(content_manager, work_queue, state.iteration)  # the level that was cut short
+    state.discard_unfinished_merge(content_manager, state.iteration)
+    narratives_to_merge = content_manager.get_merged_narratives()
+    content_manager.cluster_and_merge_narratives(narratives_to_merge, state.iteration)
+    state.finished = True
+    state.save()
+
+
+def _commit_queued_level(content_manager: ContentManager, work_queue: WorkQueue, level: int) -> None:
+    work_queue.wait_until_drained(level)
+    committed = work_queue.commit_level(level, content_manager)
+    counts = work_queue.counts(level)
+    if not counts:
+        return
+    logging.info(f"{committed} queued videos of level {level} committed; jobs: {counts}")
+    print(f"Iteration: {level}. {committed} queued videos committed, {counts.get(FAILED, 0)} failed.")
+
+
+def _queue_seed_search_terms(content_manager: ContentManager, state: CrawlCheckpoint, max_workers: int) -> None:
+    """
+    Creates the search terms of the merged narratives of the last merge and queues them for the next BFS level.
+    Search terms that were created before an interruption are reused.
+    """
+    narratives = [content_manager.get_narrative(narrative_id) for narrative_id in state.seed_narrative_ids]
+    without_term = [narrative for narrative in narratives if narrative.search_term is None]
+    search_terms = create_search_terms([narrative.description for narrative in without_term], max_workers)
+    for narrative, search_term in zip(without_term, search_terms):
+        content_manager.set_narrative_search_term(narrative.narrative_id, search_term)
+
+    depth = state.max_iterations - state.iteration + 1
+    for idx, narrative in enumerate(narratives):
+        merge_flag = idx == len(narratives) - 1  # Set merge_flag to True for the last narrative
+        state.search_queue.append((narrative.search_term, depth, merge_flag))
+    state.seed_narrative_ids = []
+    state.save()
+
+
+def _should_search(search_term: str, searched: SearchedTerms, min_yield: float) -> bool:
+    similar_term = searched.find_similar(search_term)
+    if similar_term is not None:
+        logging.info(f"Search term '{search_term}' is skipped, as the similar term '{similar_term}' is searched.")
+        return False
+    cache = get_search_cache()
+    if cache and cache.is_low_yield(search_term, min_yield):
+        logging.info(f"Search term '{search_term}' is skipped, as it yielded few new videos before.")
+        return False
+    return True
 
 
 def search_and_process_videos(content_manager: ContentManager,
@@ -105,51 +234,76 @@ def search_and_process_videos(content_manager: ContentManager,
                               start_date: datetime,
                               iteration: int,
                               max_results: int,
-                              max_skips: int = 3) -> None:
+                              max_skips: int = 3,
+                              max_workers: int = 4,
+                              relevance_filter: RelevanceFilter | None = None,
+                              oversample: int = 2,
+                              work_queue: WorkQueue | None = None) -> None:
+    """
+    Searches videos for a search term and extracts the narratives of all new videos. With a relevance filter,
+    oversample times max_results videos are searched, and only the max_results most relevant new videos above
+    the threshold of the filter are processed.
+
+    Transcripts are fetched and narratives are extracted by a pool of max_workers threads, but results are
+    committed to the content manager in search result order, so narrative IDs are the same as in a sequential run.
+    Processing stops when max_skips consecutive videos (in search result order) fail. With a work queue, the new
+    videos are queued for worker processes instead, and retries of failed videos are left to the queue.
+
+    Args:
+    content_manager (ContentManager): The content manager instance.
+    search_term (str): The search term for videos.
+    start_date (datetime): The starting date for video search.
+    iteration (int): The current search iteration.
+    max_results (int): The maximum number of search results.
+    max_skips (int): The maximum number of consecutive failures before processing is stopped.
+    max_workers (int): The maximum number of videos processed concurrently. Use 1 to process sequentially.
+    relevance_filter (RelevanceFilter | None): Filter that ranks and selects the new videos to process.
+    oversample (int): The factor of extra search results to choose from when a relevance filter is used.
+    work_queue (WorkQueue | None): The queue of video jobs for worker processes.
+    """
     consecutive_skips = 0
 
-    videos = search_videos(search_term, start_date, max_results)
+    search_results = max_results * oversample if relevance_filter else max_results
+    videos = list(search_videos(search_term, start_date, search_results))
     new_videos = [video for video in videos if not content_manager.contains_video(video)]
+    if work_queue:
+        queued_video_ids = work_queue.queued_video_ids(iteration)  # found by an earlier search of this level
+        new_videos = [video for video in new_videos if video.video_id not in queued_video_ids]
+    cache = get_search_cache()
+    if cache:
+        cache.record_yield(search_term, len(videos), len(new_videos))
+    if relevance_filter:
+        new_videos = relevance_filter.select(new_videos, search_term, top_n=max_results, corpus=videos)
     print(f"Iteration: {iteration}. {len(new_videos)} new videos found.")
+    if work_queue:
+        work_queue.enqueue(iteration, new_videos, search_term)
+        return
 
-    for video in tqdm(new_videos):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fetch_video_narratives, video) for video in new_videos]
         try:
-            if process_video(content_manager, video, search_term, iteration):
-                consecutive_skips = 0  # Reset skip count on success
-            # Else: video is skipped because transcript is missing -> consecutive_skips stays the same
-        except Exception:
-            consecutive_skips += 1  # Increment skip count on processing failure
-            if consecutive_skips == max_skips:
-                raise MaxSkipsReachedException(f"{max_skips} consecutive videos are skipped due to errors. "
-                                               f"Stopping video processing.")
-
-
-def process_video(content_manager: ContentManager, video, search_term: str, iteration, max_retries=1) -> bool:
-    """
-    Processes a single video, extracting narratives and linking them to the video.
-
-    Returns:
-    bool: True if the video was processed successfully, False otherwise.
-    """
-    for attempt in range(max_retries + 1):
-        try:
-            video.fetch_transcript()
-            if not video.transcript:
-                logging.info(f"Video {video.video_id} has no transcript and is skipped.")
-                return False
-
-            content_manager.add_video(video)
-            for narrative_description in extract_narratives(video.transcript):
-                content_manager.create_video_narrative(video.video_id, narrative_description, search_term, iteration)
-
-            return True  # Successfully processed
-        except Exception as e:
-            if attempt == max_retries:
-                logging.error(f"Error processing video {video.url}: {e}", exc_info=True)
-                raise  # Reraise the exception after final attempt
-    return False
+            for video, future in tqdm(zip(new_videos, futures), total=len(new_videos)):
+                try:
+                    narrative_descriptions = future.result()
+                except Exception:
+                    consecutive_skips += 1  # Increment skip count on processing failure
+                    if consecutive_skips == max_skips:
+                        raise MaxSkipsReachedException(f"{max_skips} consecutive videos are skipped due to errors. "
+                                                       f"Stopping video processing.")
+                    continue
+
+                if narrative_descriptions is not None:
+                    content_manager.add_video_narratives(video, narrative_descriptions, search_term, iteration)
+                    consecutive_skips = 0  # Reset skip count on success
+                # Else: video is skipped because transcript is missing -> consecutive_skips stays the same
+        finally:
+            for future in futures:
+                future.cancel()  # no-op for finished futures; drops queued work when processing is stopped
 
 
 if __name__ == '__main__':
-    main()
+    # e.g. NARRATIVE_CASSETTE=./data/crawl.cassette.gz NARRATIVE_CASSETTE_MODE=record python main.py
+    main(cassette_path=os.environ.get('NARRATIVE_CASSETTE'),
+         cassette_mode=os.environ.get('NARRATIVE_CASSETTE_MODE', REPLAY),
+         resume='--resume' in sys.argv[1:])
 
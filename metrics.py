@@ -0,0 +1,208 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from rate_limiter import get_rate_limiter_stats
+
+DEFAULT_REPORT_DIR = './data/metrics'
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float('inf'))
+
+# The stage of the code that is running, so that LLM calls are attributed to the stage that made them
+_current_stage = contextvars.ContextVar('current_stage', default='other')
+
+
+class Metrics:
+    """
+    Per-stage metrics of a run: the number of calls, errors and wall time of each stage with a latency histogram,
+    the prompt and completion tokens and estimated cost of the LLM calls per stage and model, and event counts
+    such as cache hits, retries and parse failures. Thread-safe.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.stages: dict[str, dict] = {}
+        self.llm_usage: dict[tuple[str, str], dict] = {}  # (stage, model) -> tokens, calls and cost
+        self.events: dict[tuple[str, str], int] = {}  # (event, stage) -> count
+        self._lock = threading.Lock()
+
+    def record_call(self, stage: str, seconds: float, error: bool = False) -> None:
+        with self._lock:
+            stats = self.stages.setdefault(stage, {"calls": 0, "errors": 0, "seconds": 0.0,
+                                                   "latency_buckets": [0] * len(LATENCY_BUCKETS)})
+            stats["calls"] += 1
+            stats["errors"] += error
+            stats["seconds"] += seconds
+            for index, upper_bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= upper_bound:
+                    stats["latency_buckets"][index] += 1
+                    break
+
+    def record_llm_usage(self, model: str, prompt_tokens: int, completion_tokens: int, cost: float,
+                         stage: str | None = None) -> None:
+        with self._lock:
+            usage = self.llm_usage.setdefault((stage or _current_stage.get(), model),
+                                              {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0})
+            usage["calls"] += 1
+            usage["prompt_tokens"] += prompt_tokens
+            usage["completion_tokens"] += completion_tokens
+            usage["cost"] += cost
+
+    def count(self, event: str, amount: int = 1, stage: str | None = None) -> None:
+        key = (event, stage or _current_stage.get())
+        with self._lock:
+            self.events[key] = self.events.get(key, 0) + amount
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Context manager that records the wall time of a call of a stage, and attributes the LLM calls and events
+        within it to the stage.
+        """
+        token = _current_stage.set(name)
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.record_call(name, time.perf_counter() - start, error)
+            _current_stage.reset(token)
+
+    def report(self) -> dict:
+        """
+        Returns all metrics as a JSON-serializable dict, including the counters of the rate limiters.
+        """
+        with self._lock:
+            stages = {name: dict(stats, latency_buckets=dict(zip(map(str, LATENCY_BUCKETS), stats["latency_buckets"])))
+                      for name, stats in self.stages.items()}
+            llm_usage = [dict(usage, stage=stage, model=model) for (stage, model), usage in self.llm_usage.items()]
+            events = [{"event": event, "stage": stage, "count": count} for (event, stage), count in self.events.items()]
+
+        cost_per_model = {}
+        for usage in llm_usage:
+            cost_per_model[usage["model"]] = cost_per_model.get(usage["model"], 0.0) + usage["cost"]
+        return {
+            "started_at": datetime.fromtimestamp(self.started_at).isoformat(),
+            "wall_seconds": time.time() - self.started_at,
+            "stages": stages,
+            "llm_usage": llm_usage,
+            "cost_per_model": cost_per_model,
+            "events": events,
+            "rate_limiters": get_rate_limiter_stats(),
+        }
+
+    def to_prometheus(self, report: dict | None = None) -> str:
+        """
+        Returns the metrics in the Prometheus text format, for the textfile collector of the node exporter.
+        """
+        report = report or self.report()
+        lines = []
+
+        def add(name, metric_type, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{_escape_label(str(val))}"' for key, val in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        stages = report["stages"]
+        add("narrative_stage_calls_total", "counter", "Number of calls per stage.",
+            [({"stage": stage}, stats["calls"]) for stage, stats in stages.items()])
+        add("narrative_stage_errors_total", "counter", "Number of failed calls per stage.",
+            [({"stage": stage}, stats["errors"]) for stage, stats in stages.items()])
+
+        histogram = []
+        for stage, stats in stages.items():
+            cumulative = 0
+            for upper_bound, count in stats["latency_buckets"].items():
+                cumulative += count
+                histogram.append(({"stage": stage, "le": "+Inf" if upper_bound == "inf" else upper_bound}, cumulative))
+            histogram.append(({"stage": stage, "__suffix": "_sum"}, stats["seconds"]))
+            histogram.append(({"stage": stage, "__suffix": "_count"}, stats["calls"]))
+        lines.append("# HELP narrative_stage_latency_seconds Latency of the calls per stage.")
+        lines.append("# TYPE narrative_stage_latency_seconds histogram")
+        for labels, value in histogram:
+            suffix = labels.pop("__suffix", "_bucket")
+            label_text = ','.join(f'{key}="{_escape_label(str(val))}"' for key, val in labels.items())
+            lines.append(f"narrative_stage_latency_seconds{suffix}{{{label_text}}} {value}")
+
+        usage = report["llm_usage"]
+        add("narrative_llm_calls_total", "counter", "Number of LLM calls (not served from the cache).",
+            [({"stage": u["stage"], "model": u["model"]}, u["calls"]) for u in usage])
+        add("narrative_llm_tokens_total", "counter", "Number of LLM tokens.",
+            [({"stage": u["stage"], "model": u["model"], "kind": kind}, u[f"{kind}_tokens"])
+             for u in usage for kind in ("prompt", "completion")])
+        add("narrative_llm_cost_dollars_total", "counter", "Estimated cost of the LLM calls in dollars.",
+            [({"model": model}, cost) for model, cost in report["cost_per_model"].items()])
+        add("narrative_events_total", "counter", "Number of events, such as cache hits, retries and parse failures.",
+            [({"event": e["event"], "stage": e["stage"]}, e["count"]) for e in report["events"]])
+        for counter in ("calls", "retries", "failures", "rate_limited", "circuit_rejections", "throttled_seconds",
+                        "backoff_seconds"):
+            add(f"narrative_rate_limiter_{counter}_total", "counter", f"Rate limiter counter {counter}.",
+                [({"limiter": name}, stats[counter]) for name, stats in report["rate_limiters"].items()])
+        add("narrative_run_wall_seconds", "gauge", "Wall time of the run.", [({}, report["wall_seconds"])])
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self, name: str, directory: str = DEFAULT_REPORT_DIR) -> tuple[str, str]:
+        """
+        Writes the run report as JSON (name.json) and in the Prometheus text format (name.prom). The Prometheus
+        file is replaced atomically, as the textfile collector may read it at any time.
+
+        Returns:
+        tuple[str, str]: The paths of the JSON report and the Prometheus file.
+        """
+        os.makedirs(directory, exist_ok=True)
+        report = self.report()
+        json_path = os.path.join(directory, f"{name}.json")
+        prometheus_path = os.path.join(directory, f"{name}.prom")
+        with open(json_path, 'w') as file:
+            json.dump(report, file, indent=2)
+        with open(prometheus_path + '.tmp', 'w') as file:
+            file.write(self.to_prometheus(report))
+        os.replace(prometheus_path + '.tmp', prometheus_path)
+        return json_path, prometheus_path
+
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+_metrics = Metrics()
+
+
+def get_metrics() -> Metrics:
+    """
+    Returns the metrics of the current run, shared by all modules.
+    """
+    return _metrics
+
+
+def reset_metrics() -> Metrics:
+    """
+    Starts a new run: replaces the shared metrics by empty metrics.
+    """
+    global _metrics
+    _metrics = Metrics()
+    return _metrics
+
+
+def timed(stage: str):
+    """
+    Decorator that records each call of the decorated function as a call of the given stage.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with get_metrics().stage(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
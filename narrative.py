@@ -1,14 +1,46 @@
+import sys
+from array import array
+
+
 class Narrative:
+    # Slotted to keep large corpora compact; based_on is an array of 64-bit narrative IDs.
+    __slots__ = ('narrative_id', 'description', 'search_term', 'iteration', 'based_on')
+
     def __init__(self, narrative_id: int, description: str, iteration: int, search_term=None, based_on=None):
         self.narrative_id: int = narrative_id
         self.description: str = description
-        self.search_term: str | None = search_term
+        self.search_term: str | None = sys.intern(search_term) if search_term is not None else None
         self.iteration = iteration
-        self.based_on: list[int] = based_on if based_on else []
+        self.based_on: array = array('q', based_on) if based_on else array('q')
 
     @property
     def is_merged(self) -> bool:
         return bool(self.based_on)
 
+    def to_json_data(self) -> dict:
+        """
+        Returns the narrative as JSON data, with the keyword arguments of the constructor as keys.
+        """
+        return {
+            "narrative_id": self.narrative_id,
+            "description": self.description,
+            "search_term": self.search_term,
+            "iteration": self.iteration,
+            "based_on": self.based_on.tolist(),
+        }
+
+    def to_row(self) -> list:
+        """
+        Returns the narrative as a list of constructor arguments, the compact serialization used by the content store.
+        """
+        return [self.narrative_id, self.description, self.iteration, self.search_term, self.based_on.tolist()]
+
+    @classmethod
+    def from_row(cls, row: list) -> 'Narrative':
+        """
+        Initialize a Narrative object from a row created by to_row.
+        """
+        return cls(*row)
+
     def __repr__(self):
         return f"Narrative(description='{self.description}'"
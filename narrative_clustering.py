@@ -1,35 +1,19 @@
 import ast
-import time
+import logging
 
-from langchain.chains import LLMChain
-from langchain_openai import ChatOpenAI
-from langchain.prompts import PromptTemplate
 from langchain.schema import BaseOutputParser
 
+from llm_gateway import batch, invoke
+from metrics import timed
+from rate_limiter import CircuitOpenError
+from utils import estimate_tokens, tokenize_words
 
-class NarrativeClusteringOutputParser(BaseOutputParser):
-
-    def parse(self, input_string: str):
-        # Convert the string representation of the list of tuples into an actual list of tuples
-        data = ast.literal_eval(input_string)
-
-        # Check if the data is in the correct format (list of tuples)
-        if not isinstance(data, list) or not all(isinstance(item, tuple) and len(item) == 2 for item in data):
-            raise ValueError("Input string does not represent a list of tuples with the expected format.")
-
-        # Process each tuple
-        processed_data = []
-        for text, numbers in data:
-            if not isinstance(text, str) or not isinstance(numbers, list) or not all(
-                    isinstance(num, int) for num in numbers):
-                raise ValueError("Elements of tuples are not in the expected format (string, list of integers).")
-            processed_data.append((text, numbers))
+# Words that carry no information about which narratives are similar
+STOP_WORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the their this to was were with "
+    "which who while into over than they them these those not but also".split())
 
-        return processed_data
-
-
-def cluster_narratives(narrative_id_desc_map: dict[int, str]) -> list[tuple[str, list[int]]]:
-    prompt_text = """### CONTEXT
+CLUSTER_NARRATIVES_PROMPT = """### CONTEXT
 The texts in the dict below are summaries of narratives  about the Israel-Hamas conflict that started on 7 October 2023 taken from YouTube transcripts:
 ---
 {narrative_id_desc_map}
@@ -51,26 +35,177 @@ The results will used to detect hate speech and disinformation in a knowledge gr
 Respond as a list of tuples. Each tuple consists of the new narrative description and a list of narrative-IDs on which it is based. For example: [("description1", [1, 2]), ("description2", [3, 4])]
 """
 
-    prompt_template = PromptTemplate(
-        input_variables=["narrative_id_desc_map"],
-        template=prompt_text
-    )
 
-    llm = ChatOpenAI(temperature=1, model_name='gpt-4-1106-preview', max_tokens=4000)
+class NarrativeClusteringOutputParser(BaseOutputParser):
+
+    def parse(self, input_string: str):
+        # Convert the string representation of the list of tuples into an actual list of tuples
+        data = ast.literal_eval(input_string)
+
+        # Check if the data is in the correct format (list of tuples)
+        if not isinstance(data, list) or not all(isinstance(item, tuple) and len(item) == 2 for item in data):
+            raise ValueError("Input string does not represent a list of tuples with the expected format.")
+
+        # Process each tuple
+        processed_data = []
+        for text, numbers in data:
+            if not isinstance(text, str) or not isinstance(numbers, list) or not all(
+                    isinstance(num, int) for num in numbers):
+                raise ValueError("Elements of tuples are not in the expected format (string, list of integers).")
+            processed_data.append((text, numbers))
+
+        return processed_data
+
 
-    chain = LLMChain(llm=llm, prompt=prompt_template, output_parser=NarrativeClusteringOutputParser())
-    result = chain.invoke({"narrative_id_desc_map": (str(narrative_id_desc_map))})
-    return result["text"]
+@timed('clustering')
+def cluster_narratives(narrative_id_desc_map: dict[int, str]) -> list[tuple[str, list[int]]]:
+    return invoke(CLUSTER_NARRATIVES_PROMPT,
+                  {"narrative_id_desc_map": str(narrative_id_desc_map)},
+                  model_name='gpt-4-1106-preview',
+                  max_tokens=4000,
+                  temperature=1,
+                  output_parser=NarrativeClusteringOutputParser())
+
+
+@timed('clustering')
+def cluster_narratives_batch(narrative_id_desc_maps: list[dict[int, str]],
+                             max_concurrency: int = 4) -> list[list[tuple[str, list[int]]] | Exception]:
+    """
+    Clusters several sets of narratives, with up to max_concurrency concurrent LLM calls. The result of a set
+    that could not be clustered is the exception of its call.
+    """
+    return batch(CLUSTER_NARRATIVES_PROMPT,
+                 [{"narrative_id_desc_map": str(narrative_id_desc_map)}
+                  for narrative_id_desc_map in narrative_id_desc_maps],
+                 model_name='gpt-4-1106-preview',
+                 max_tokens=4000,
+                 temperature=1,
+                 output_parser=NarrativeClusteringOutputParser(),
+                 max_concurrency=max_concurrency,
+                 return_exceptions=True)
 
 
 def cluster_narratives_with_retry(narrative_id_desc_map, max_retries=3):
+    # Rate limits and other transient API errors are retried with backoff by the rate limiter of invoke, so
+    # the retries here are for responses that cannot be parsed and are retried right away.
     retries = 0
     while retries < max_retries:
         try:
             clusters = cluster_narratives(narrative_id_desc_map)
             return clusters
+        except CircuitOpenError:
+            raise
         except Exception as e:
             print(f"Exception while clustering narratives: {e}")
             retries += 1
-            if retries < max_retries:
-                time.sleep(60)
+
+
+def cluster_narratives_hierarchical(narrative_id_desc_map: dict[int, str],
+                                    max_batch_tokens: int = 3000,
+                                    max_batch_size: int = 60,
+                                    max_workers: int = 4) -> list[tuple[str, list[int]]]:
+    """
+    Clusters any number of narratives by map-reduce. If all narratives fit in one prompt, they are clustered
+    with a single call. Otherwise, they are split into token-budgeted batches of similar narratives, the batches
+    are clustered in parallel, and the resulting cluster descriptions are clustered again, recursively, until
+    one level fits in a single prompt. The IDs in the result always refer to the given narratives, and every
+    given narrative is in the result: narratives the LLM leaves out are returned as clusters of their own.
+
+    Args:
+    narrative_id_desc_map (dict[int, str]): Maps narrative IDs to narrative descriptions.
+    max_batch_tokens (int): The maximum estimated number of tokens of the narratives in one prompt.
+    max_batch_size (int): The maximum number of narratives in one prompt.
+    max_workers (int): The maximum number of batches that are clustered concurrently.
+
+    Returns:
+    list[tuple[str, list[int]]]: The cluster descriptions and the IDs of the narratives they are based on.
+    """
+    if _fits_in_batch(narrative_id_desc_map, max_batch_tokens, max_batch_size):
+        clusters = cluster_narratives_with_retry(narrative_id_desc_map)
+        return _complete_batch_clusters(narrative_id_desc_map, clusters or [])
+
+    batches = _create_similarity_batches(narrative_id_desc_map, max_batch_tokens, max_batch_size)
+    clusters = []
+    for narrative_batch, batch_clusters in zip(batches, cluster_narratives_batch(batches, max_workers)):
+        if isinstance(batch_clusters, CircuitOpenError):
+            raise batch_clusters
+        if isinstance(batch_clusters, Exception):
+            print(f"Exception while clustering narratives: {batch_clusters}")
+            batch_clusters = cluster_narratives_with_retry(narrative_batch, max_retries=2)
+        clusters.extend(_complete_batch_clusters(narrative_batch, batch_clusters or []))
+
+    if len(clusters) >= len(narrative_id_desc_map):
+        logging.warning(f"Clustering {len(narrative_id_desc_map)} narratives in {len(batches)} batches did not "
+                        f"reduce their number. Returning the clusters of the batches.")
+        return clusters
+
+    # cluster the cluster descriptions at the next level, under temporary IDs that map to the original IDs
+    summary_id_desc_map = {}
+    provenance = {}
+    for summary_id, (description, based_on) in enumerate(clusters, start=1):
+        summary_id_desc_map[summary_id] = description
+        provenance[summary_id] = based_on
+    merged_clusters = cluster_narratives_hierarchical(summary_id_desc_map, max_batch_tokens, max_batch_size,
+                                                      max_workers)
+
+    return [(description, sorted({narrative_id for summary_id in summary_ids if summary_id in provenance
+                                  for narrative_id in provenance[summary_id]}))
+            for description, summary_ids in merged_clusters]
+
+
+def _fits_in_batch(narrative_id_desc_map: dict[int, str], max_batch_tokens: int, max_batch_size: int) -> bool:
+    return (len(narrative_id_desc_map) <= max_batch_size and
+            sum(estimate_tokens(desc) for desc in narrative_id_desc_map.values()) <= max_batch_tokens)
+
+
+def _create_similarity_batches(narrative_id_desc_map: dict[int, str],
+                               max_batch_tokens: int,
+                               max_batch_size: int) -> list[dict[int, str]]:
+    """
+    Splits narratives into batches within the token budget. Each batch starts with the first remaining narrative
+    and is filled with the remaining narratives that share most words with it (Jaccard similarity), so that
+    narratives that belong to the same cluster are likely to end up in the same batch.
+    """
+    words = {nid: frozenset(tokenize_words(desc)) - STOP_WORDS for nid, desc in narrative_id_desc_map.items()}
+    tokens = {nid: estimate_tokens(desc) for nid, desc in narrative_id_desc_map.items()}
+    remaining = list(narrative_id_desc_map)
+
+    batches = []
+    while remaining:
+        seed = remaining.pop(0)
+        seed_words = words[seed]
+
+        def similarity(nid):
+            union = len(seed_words | words[nid])
+            return len(seed_words & words[nid]) / union if union else 0.0
+
+        narrative_batch = {seed: narrative_id_desc_map[seed]}
+        batch_tokens = tokens[seed]
+        for nid in sorted(remaining, key=similarity, reverse=True):
+            if len(narrative_batch) >= max_batch_size:
+                break
+            if batch_tokens + tokens[nid] <= max_batch_tokens:
+                narrative_batch[nid] = narrative_id_desc_map[nid]
+                batch_tokens += tokens[nid]
+        remaining = [nid for nid in remaining if nid not in narrative_batch]
+        batches.append(narrative_batch)
+    return batches
+
+
+def _complete_batch_clusters(narrative_batch: dict[int, str],
+                             clusters: list[tuple[str, list[int]]]) -> list[tuple[str, list[int]]]:
+    """
+    Completes the clusters of one batch. IDs that are not in the batch are dropped, and narratives the LLM left
+    out of every cluster (or all narratives, if clustering failed) are passed on as clusters of their own, so
+    that no narrative loses its place in the provenance of the final clusters.
+    """
+    result = []
+    clustered_ids = set()
+    for description, based_on in clusters:
+        based_on = [nid for nid in based_on if nid in narrative_batch and nid not in clustered_ids]
+        if based_on:
+            result.append((description, based_on))
+            clustered_ids.update(based_on)
+
+    result.extend((description, [nid]) for nid, description in narrative_batch.items() if nid not in clustered_ids)
+    return result
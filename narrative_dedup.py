@@ -0,0 +1,106 @@
+import logging
+import zlib
+
+import numpy as np
+
+from utils import estimate_tokens, tokenize_words
+
+_PRIME = np.uint64(4294967311)  # smallest prime above 2**32, so (a * h + b) % p fits in 64 bits
+_MASK_32 = 0xFFFFFFFF
+
+
+def collapse_near_duplicates(narrative_id_desc_map: dict[int, str],
+                             threshold: float = 0.8,
+                             num_perm: int = 128,
+                             bands: int = 16,
+                             seed: int = 1) -> tuple[dict[int, str], dict[int, list[int]]]:
+    """
+    Collapses near-duplicate narrative descriptions into representatives before they are sent to the LLM.
+
+    Descriptions are compared by the Jaccard similarity of their word bigrams, estimated with MinHash. Candidate
+    pairs are found with locality-sensitive hashing over bands of the signatures and verified against the
+    threshold, all as NumPy array operations. Near-duplicates are grouped transitively; the narrative with the
+    lowest ID represents its group.
+
+    Args:
+    narrative_id_desc_map (dict[int, str]): Maps narrative IDs to narrative descriptions.
+    threshold (float): The minimum estimated Jaccard similarity of near-duplicates.
+    num_perm (int): The number of MinHash permutations. Must be divisible by bands.
+    bands (int): The number of LSH bands.
+    seed (int): Seed of the MinHash permutations.
+
+    Returns:
+    tuple[dict[int, str], dict[int, list[int]]]: The representatives (ID to description) and, for each
+    representative, the IDs of all narratives it represents (including its own).
+    """
+    narrative_ids = sorted(narrative_id_desc_map)
+    if len(narrative_ids) < 2:
+        return dict(narrative_id_desc_map), {nid: [nid] for nid in narrative_ids}
+
+    signatures = _minhash_signatures([narrative_id_desc_map[nid] for nid in narrative_ids], num_perm, seed)
+    parent = np.arange(len(narrative_ids))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    rows = num_perm // bands
+    for band in range(bands):
+        band_signatures = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        band_keys = band_signatures.view(np.dtype((np.void, band_signatures.dtype.itemsize * rows))).ravel()
+        _, first_index, inverse = np.unique(band_keys, return_index=True, return_inverse=True)
+
+        # compare every narrative with the first narrative in the same bucket
+        leaders = first_index[inverse.ravel()]
+        candidates = np.nonzero(leaders != np.arange(len(narrative_ids)))[0]
+        if not len(candidates):
+            continue
+        similarity = (signatures[candidates] == signatures[leaders[candidates]]).mean(axis=1)
+        for i, j in zip(candidates[similarity >= threshold], leaders[candidates[similarity >= threshold]]):
+            root_i, root_j = find(i), find(j)
+            if root_i != root_j:
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    members = {}
+    for i, nid in enumerate(narrative_ids):
+        members.setdefault(narrative_ids[find(i)], []).append(nid)
+    representatives = {nid: narrative_id_desc_map[nid] for nid in members}
+
+    tokens_before = sum(estimate_tokens(desc) for desc in narrative_id_desc_map.values())
+    tokens_after = sum(estimate_tokens(desc) for desc in representatives.values())
+    logging.info(f"Collapsed {len(narrative_id_desc_map)} narratives into {len(representatives)} representatives, "
+                 f"reducing the estimated input tokens from {tokens_before} to {tokens_after}.")
+    return representatives, members
+
+
+def _minhash_signatures(descriptions: list[str], num_perm: int, seed: int) -> np.ndarray:
+    """
+    Computes the MinHash signatures of the word bigrams of each description.
+
+    Returns:
+    np.ndarray: Array of shape (len(descriptions), num_perm) with the signatures.
+    """
+    shingle_hashes = []
+    offsets = []
+    for index, description in enumerate(descriptions):
+        words = tokenize_words(description)
+        shingles = [f"{a} {b}" for a, b in zip(words, words[1:])] or words or [f"\0{index}"]
+        offsets.append(len(shingle_hashes))
+        # crc32 instead of hash(), which is salted per process, so signatures are the same in every run
+        shingle_hashes.extend({zlib.crc32(shingle.encode('utf-8')) for shingle in shingles})
+
+    hashes = np.array(shingle_hashes, dtype=np.uint64)
+    offsets = np.array(offsets, dtype=np.intp)
+
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, _MASK_32, size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, _MASK_32, size=num_perm, dtype=np.uint64)
+
+    signatures = np.empty((len(descriptions), num_perm), dtype=np.uint64)
+    chunk = 16  # permutations per step, to bound the memory of the intermediate matrix
+    for start in range(0, num_perm, chunk):
+        permuted = (a[start:start + chunk, None] * hashes[None, :] + b[start:start + chunk, None]) % _PRIME
+        signatures[:, start:start + chunk] = np.minimum.reduceat(permuted, offsets, axis=1).T
+    return signatures
@@ -1,23 +1,17 @@
 import ast
+import logging
+import time
 
-from langchain.chains import LLMChain
-from langchain_openai import ChatOpenAI
-from langchain.prompts import PromptTemplate
 from langchain.schema import BaseOutputParser
 
-from utils import read_from_file
+from llm_gateway import batch, invoke
+from metrics import get_metrics, timed
+from rate_limiter import backoff_delay
+from utils import read_from_file, estimate_tokens
 
+MAX_NARRATIVES = 10
 
-class NarrativeExtractionOutputParser(BaseOutputParser):
-
-    def parse(self, input_string: str):
-        # Convert the string representation to a list of strings
-        data = ast.literal_eval(input_string)
-        return data
-
-
-def extract_narratives(transcript: str) -> list[str]:
-    prompt_text = """### CONTEXT
+EXTRACT_NARRATIVES_PROMPT = """### CONTEXT
 The text below is a YouTube transcript  about the Israel-Hamas conflict that started on 7 October 2023:
 ---
 {transcript}
@@ -33,16 +27,170 @@ When summarizing narratives, avoid using self-referential phrases or attribution
 Respond as a list of strings, one for each narrative in the format ["string1",  "string2"].
 """
 
-    prompt_template = PromptTemplate(
-        input_variables=["transcript"],
-        template=prompt_text
-    )
+REDUCE_NARRATIVES_PROMPT = """### CONTEXT
+The texts below are narratives about the Israel-Hamas conflict that started on 7 October 2023, extracted from consecutive parts of the same YouTube transcript:
+---
+{narratives}
+---
+
+### OBJECTIVE
+Merge narratives that are the same or overlap, and reduce them to at most 10 narratives. If there are more, keep the ones most likely to contain disinformation or hate speech.
+
+### SPECIFICS
+Do NOT add new information that is not in the narratives. Avoid using self-referential phrases or attributions like "claims the speaker", "according to the speaker", or any similar terms. Ensure that all statements are in active language and present tense. This is crucial for the accurate creation of triples in a knowledge graph. Avoid using past participles as they can lead to inaccuracies and inconsistencies in the data structure. The results will used to detect hate speech and disinformation in a knowledge graph. If you include passive language or self-referential phrases this will fail  and the disinformation might not be detected.
+
+### RESULT
+Respond as a list of strings, one for each narrative in the format ["string1",  "string2"].
+"""
+
+
+class NarrativeExtractionOutputParser(BaseOutputParser):
+
+    def parse(self, input_string: str):
+        # Convert the string representation to a list of strings
+        data = ast.literal_eval(input_string)
+        return data
+
+
+@timed('extract_narratives')
+def extract_narratives(transcript: str) -> list[str]:
+    return invoke(EXTRACT_NARRATIVES_PROMPT,
+                  {"transcript": transcript},
+                  model_name='gpt-4-1106-preview',
+                  max_tokens=4000,
+                  temperature=1,
+                  output_parser=NarrativeExtractionOutputParser())
+
+
+@timed('extract_narratives')
+def extract_narratives_batch(transcripts: list[str], max_concurrency: int = 4) -> list[list[str]]:
+    """
+    Extracts the narratives of several transcripts (or chunks of one transcript), with up to max_concurrency
+    concurrent LLM calls.
+    """
+    return batch(EXTRACT_NARRATIVES_PROMPT,
+                 [{"transcript": transcript} for transcript in transcripts],
+                 model_name='gpt-4-1106-preview',
+                 max_tokens=4000,
+                 temperature=1,
+                 output_parser=NarrativeExtractionOutputParser(),
+                 max_concurrency=max_concurrency)
+
+
+def extract_narratives_chunked(transcript: str,
+                               captions: list[str] | None = None,
+                               max_single_call_tokens: int = 8000,
+                               max_chunk_tokens: int = 6000,
+                               overlap_tokens: int = 300,
+                               max_workers: int = 4) -> list[str]:
+    """
+    Extracts narratives from a transcript of any length. Short transcripts are handled with a single call to
+    extract_narratives. Long transcripts are split into overlapping chunks on caption boundaries, the narratives
+    of all chunks are extracted concurrently and then reduced to at most 10 narratives.
+
+    Args:
+    transcript (str): The transcript.
+    captions (list[str] | None): The caption texts the transcript consists of. If None, the transcript is split
+    on whitespace instead.
+    max_single_call_tokens (int): The maximum estimated number of tokens of a transcript that is not chunked.
+    max_chunk_tokens (int): The maximum estimated number of tokens per chunk.
+    overlap_tokens (int): The estimated number of tokens each chunk repeats from the end of the previous one.
+    max_workers (int): The maximum number of chunks processed concurrently.
+
+    Returns:
+    list[str]: The narratives.
+    """
+    if estimate_tokens(transcript) <= max_single_call_tokens:
+        return extract_narratives(transcript)
+
+    chunks = split_captions(captions if captions else transcript.split(), max_chunk_tokens, overlap_tokens)
+    chunk_narratives = extract_narratives_batch(chunks, max_workers)
+
+    narratives = list(dict.fromkeys(n for narratives_of_chunk in chunk_narratives for n in narratives_of_chunk))
+    if len(narratives) <= MAX_NARRATIVES:
+        return narratives
+    return reduce_narratives(narratives)
+
+
+def fetch_video_narratives(video, max_retries=1) -> list[str] | None:
+    """
+    Fetches the transcript of a video and extracts its narratives. Does not touch the content manager,
+    so it is safe to run for several videos concurrently.
+
+    Returns:
+    list[str] | None: The narrative descriptions, or None if the video has no transcript.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            video.fetch_transcript()
+            if not video.transcript:
+                logging.info(f"Video {video.video_id} has no transcript and is skipped.")
+                return None
+
+            return extract_narratives_chunked(video.transcript, video.get_captions())
+        except Exception as e:
+            if attempt == max_retries:
+                logging.error(f"Error processing video {video.url}: {e}", exc_info=True)
+                raise  # Reraise the exception after final attempt
+            get_metrics().count("video_retries", stage="process_video")
+            time.sleep(backoff_delay(attempt))
+    return None
+
+
+def split_captions(captions: list[str], max_chunk_tokens: int, overlap_tokens: int) -> list[str]:
+    """
+    Joins captions into chunks of at most max_chunk_tokens (estimated), never splitting a caption. Each chunk
+    starts with the last captions of the previous chunk, up to overlap_tokens and as far as the overlap fits in
+    the chunk, so narratives that cross a chunk boundary are not lost. Only a single caption that is longer than
+    max_chunk_tokens makes a chunk exceed the limit.
+
+    Args:
+    captions (list[str]): The caption texts.
+    max_chunk_tokens (int): The maximum estimated number of tokens per chunk.
+    overlap_tokens (int): The estimated number of tokens of overlap between consecutive chunks.
+
+    Returns:
+    list[str]: The chunks.
+    """
+    chunks = []
+    chunk = []
+    chunk_tokens = 0
+    for caption in captions:
+        caption_tokens = estimate_tokens(caption)
+        if chunk and chunk_tokens + caption_tokens > max_chunk_tokens:
+            chunks.append(' '.join(chunk))
+
+            # start the next chunk with the tail of the current one, leaving room for the caption
+            overlap = []
+            overlap_size = 0
+            for previous in reversed(chunk):
+                overlap_size += estimate_tokens(previous)
+                if overlap_size > overlap_tokens or overlap_size + caption_tokens > max_chunk_tokens:
+                    break
+                overlap.insert(0, previous)
+            chunk = overlap
+            chunk_tokens = sum(estimate_tokens(c) for c in chunk)
+
+        chunk.append(caption)
+        chunk_tokens += caption_tokens
+
+    if chunk:
+        chunks.append(' '.join(chunk))
+    return chunks
 
-    llm = ChatOpenAI(temperature=1, model_name='gpt-4-1106-preview', max_tokens=4000)
 
-    chain = LLMChain(llm=llm, prompt=prompt_template, output_parser=NarrativeExtractionOutputParser())
-    result = chain.invoke({"transcript": transcript})
-    return result["text"]
+@timed('extract_narratives')
+def reduce_narratives(narratives: list[str]) -> list[str]:
+    """
+    Reduces the narratives extracted from the chunks of one transcript to at most 10 narratives.
+    """
+    reduced = invoke(REDUCE_NARRATIVES_PROMPT,
+                     {"narratives": str(narratives)},
+                     model_name='gpt-4-1106-preview',
+                     max_tokens=4000,
+                     temperature=1,
+                     output_parser=NarrativeExtractionOutputParser())
+    return reduced[:MAX_NARRATIVES]  # the model does not always keep to the limit
 
 
 if __name__ == '__main__':
@@ -0,0 +1,290 @@
+import email.utils
+import logging
+import random
+import threading
+import time
+
+# Requests and tokens per minute of each provider and model. A model is limited by both its own limits and the limits
+# of its provider. None means unlimited.
+DEFAULT_LIMITS = {
+    "openai": {"requests_per_minute": 5000, "tokens_per_minute": None},
+    "openai/gpt-4-1106-preview": {"requests_per_minute": 500, "tokens_per_minute": 150_000},
+    "openai/gpt-3.5-turbo-16k": {"requests_per_minute": 3500, "tokens_per_minute": 180_000},
+    "duckduckgo": {"requests_per_minute": 20, "tokens_per_minute": None},
+    "youtube": {"requests_per_minute": 60, "tokens_per_minute": None},
+}
+
+# HTTP status codes and exception names of errors that are worth retrying
+TRANSIENT_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+TRANSIENT_ERROR_NAMES = ('RateLimit', 'Ratelimit', 'TooManyRequests', 'Timeout', 'Connection')
+
+
+class CircuitOpenError(Exception):
+    """Exception raised when a call is rejected because the circuit breaker of its rate limiter is open."""
+    pass
+
+
+class TokenBucket:
+    """
+    Token bucket that allows `per_minute` units per minute, with bursts of at most a minute's worth of units.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60  # units per second
+        self._tokens = per_minute
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1) -> float:
+        """
+        Takes amount units from the bucket, waiting until they are available. An amount larger than the capacity
+        waits for a full bucket.
+
+        Returns:
+        float: The number of seconds waited.
+        """
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return waited
+                delay = (amount - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class CircuitBreaker:
+    """
+    Rejects calls for reset_timeout seconds after failure_threshold consecutive failed calls. After that, calls are
+    allowed again; the circuit opens again at the next failure and closes at the next success.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.consecutive_failures = 0
+        self.opened_at: float | None = None
+        self._lock = threading.Lock()
+
+    def check(self, name: str) -> None:
+        with self._lock:
+            if self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"Circuit of {name} is open after {self.consecutive_failures} failed calls.")
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+
+    def record_failure(self) -> bool:
+        """
+        Returns:
+        bool: True if the failure opened the circuit.
+        """
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+
+def is_transient_error(error: Exception) -> bool:
+    """
+    Returns True if an error is likely transient (rate limit, timeout, connection or server error).
+    """
+    status_code = getattr(error, 'status_code', None)
+    if status_code is not None:
+        return status_code in TRANSIENT_STATUS_CODES
+    return any(name in type(error).__name__ for name in TRANSIENT_ERROR_NAMES)
+
+
+def retry_after_seconds(error: Exception) -> float | None:
+    """
+    Returns the delay the server asked for in the Retry-After (or retry-after-ms) header of an error's HTTP
+    response, or None if there is no such header.
+    """
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    if headers.get('retry-after-ms'):
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get('retry-after')
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+        return max(0.0, retry_date.timestamp() - time.time()) if retry_date else None
+
+
+def backoff_delay(attempt: int, base_delay: float = 1, max_delay: float = 60) -> float:
+    """
+    Returns the delay before retry number attempt + 1: exponential backoff with full jitter.
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+class RateLimiter:
+    """
+    Rate limiting, retries and circuit breaking for the calls to one provider or model.
+
+    Before each attempt, a call takes one request and its estimated tokens from the token buckets of the limiter.
+    Transient errors are retried with exponential backoff with jitter, or after the delay in the Retry-After header
+    of the response. A rate-limit error pauses all calls of the limiter for that delay, so concurrent callers do not
+    keep hitting the limit. The circuit breaker fails calls fast after repeated failures.
+    """
+
+    def __init__(self,
+                 name: str,
+                 buckets: list[tuple[TokenBucket | None, TokenBucket | None]],
+                 max_retries: int = 5,
+                 base_delay: float = 1,
+                 max_delay: float = 60,
+                 circuit_breaker: CircuitBreaker | None = None,
+                 is_retryable=is_transient_error):
+        """
+        Args:
+        name (str): The name of the limiter, e.g. "openai/gpt-4-1106-preview".
+        buckets (list[tuple]): Pairs of request and token buckets to acquire from, e.g. of the model and its provider.
+        max_retries (int): The maximum number of retries of a call.
+        base_delay (float): The backoff delay in seconds of the first retry.
+        max_delay (float): The maximum backoff delay in seconds.
+        circuit_breaker (CircuitBreaker | None): The circuit breaker; a default one is created if None.
+        is_retryable: Function that returns True if a call that raised the given exception should be retried.
+        """
+        self.name = name
+        self.buckets = buckets
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.is_retryable = is_retryable
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self.counters = {"calls": 0, "retries": 0, "failures": 0, "rate_limited": 0, "circuit_rejections": 0,
+                         "throttled_seconds": 0.0, "backoff_seconds": 0.0}
+
+    def call(self, function, *args, tokens: int = 0, **kwargs):
+        """
+        Calls function(*args, **kwargs) within the limits, retrying transient errors.
+
+        Args:
+        function: The function to call.
+        tokens (int): The estimated number of tokens of the call, for the tokens-per-minute limit.
+
+        Returns:
+        The result of the function.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.circuit_breaker.check(self.name)
+            except CircuitOpenError:
+                self._count("circuit_rejections")
+                raise
+            self._throttle(tokens)
+            self._count("calls")
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                if not self.is_retryable(e):
+                    raise  # e.g. a bad request; not a failure of the service
+                if attempt == self.max_retries:
+                    self._record_failure()
+                    raise
+
+                delay = retry_after_seconds(e)
+                if delay is not None or getattr(e, 'status_code', None) == 429:
+                    self._count("rate_limited")
+                    delay = delay if delay is not None else backoff_delay(attempt, self.base_delay, self.max_delay)
+                    with self._lock:
+                        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                else:
+                    delay = backoff_delay(attempt, self.base_delay, self.max_delay)
+                logging.warning(f"{self.name} call failed ({e}); retry {attempt + 1} in {delay:.1f} seconds.")
+                self._count("retries")
+                self._count("backoff_seconds", delay)
+                time.sleep(delay)
+            else:
+                self.circuit_breaker.record_success()
+                return result
+
+    def _throttle(self, tokens: int) -> None:
+        waited = max(0.0, self._paused_until - time.monotonic())
+        if waited:
+            time.sleep(waited)
+        for request_bucket, token_bucket in self.buckets:
+            if request_bucket:
+                waited += request_bucket.acquire(1)
+            if token_bucket and tokens:
+                waited += token_bucket.acquire(tokens)
+        if waited:
+            self._count("throttled_seconds", waited)
+
+    def _record_failure(self) -> None:
+        self._count("failures")
+        if self.circuit_breaker.record_failure():
+            logging.error(f"Circuit of {self.name} opened for {self.circuit_breaker.reset_timeout} seconds.")
+
+    def _count(self, counter: str, amount: float = 1) -> None:
+        with self._lock:
+            self.counters[counter] += amount
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.counters)
+
+
+_buckets: dict[str, tuple[TokenBucket | None, TokenBucket | None]] = {}
+_rate_limiters: dict[str, RateLimiter] = {}
+_registry_lock = threading.Lock()
+
+
+def _get_buckets(key: str) -> tuple[TokenBucket | None, TokenBucket | None] | None:
+    if key not in DEFAULT_LIMITS:
+        return None
+    if key not in _buckets:
+        limits = DEFAULT_LIMITS[key]
+        _buckets[key] = (TokenBucket(limits["requests_per_minute"]) if limits["requests_per_minute"] else None,
+                         TokenBucket(limits["tokens_per_minute"]) if limits["tokens_per_minute"] else None)
+    return _buckets[key]
+
+
+def get_rate_limiter(provider: str, model: str | None = None, **kwargs) -> RateLimiter:
+    """
+    Returns the shared rate limiter of a provider, or of a model of the provider, creating it on first use.
+    The limiter of a model acquires from the buckets of both the model and the provider, so all models of a provider
+    together stay within the limits of the provider.
+
+    Args:
+    provider (str): The provider, e.g. "openai" or "duckduckgo".
+    model (str | None): The model name, for providers with limits per model.
+    kwargs: Arguments of RateLimiter, used when the limiter is created.
+    """
+    name = f"{provider}/{model}" if model else provider
+    with _registry_lock:
+        if name not in _rate_limiters:
+            names = [name, provider] if model else [name]
+            buckets = [buckets for buckets in map(_get_buckets, names) if buckets]
+            _rate_limiters[name] = RateLimiter(name, buckets, **kwargs)
+        return _rate_limiters[name]
+
+
+def get_rate_limiter_stats() -> dict[str, dict]:
+    """
+    Returns the counters of all rate limiters: calls, retries, failures, rate-limit errors, rejected calls by an
+    open circuit, and the seconds spent waiting for the token buckets and in backoff.
+    """
+    with _registry_lock:
+        return {name: limiter.stats() for name, limiter in _rate_limiters.items()}
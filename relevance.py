@@ -0,0 +1,171 @@
+import logging
+import math
+from collections import Counter
+
+from metrics import get_metrics
+from utils import tokenize_words
+from video import Video
+
+# Words that do not make a video relevant
+STOP_WORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the their this to was were with "
+    "video videos news live full latest update updates".split())
+
+# Weights of the metadata fields in the term frequencies: a match in the title counts most
+FIELD_WEIGHTS = {"title": 3.0, "description": 1.0, "uploader": 0.5}
+
+
+def parse_duration(duration: str | None) -> int | None:
+    """
+    Converts a search result duration like "12:34" or "1:02:03" to seconds. Returns None if it cannot be parsed.
+    """
+    if not duration:
+        return None
+    seconds = 0
+    for part in duration.split(':'):
+        if not part.isdigit():
+            return None
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+
+class RelevanceFilter:
+    """
+    Cheap local relevance scoring of search results, so transcripts are only fetched and narratives only
+    extracted for the videos most likely to be about the search term and the seed topic of the crawl.
+
+    The score of a video (0 to 1) is a BM25F match of its title, description and uploader against the search
+    term and, with weight seed_weight, against the seed topic; each match is normalized by the maximum score of
+    its query. The candidates are the corpus for the document frequencies, so words that all candidates share
+    count less; pass all search results as the corpus, so a video scores the same whether or not other results
+    are already known. The score is halved for videos shorter than min_duration or longer than max_duration seconds
+    (mostly clips and live stream recordings) and slightly lowered for videos with few views.
+    """
+
+    def __init__(self,
+                 seed_topic: str,
+                 threshold: float = 0.15,
+                 seed_weight: float = 0.5,
+                 min_duration: int = 60,
+                 max_duration: int = 3 * 60 * 60,
+                 k1: float = 1.2,
+                 b: float = 0.75):
+        self.seed_topic = seed_topic
+        self.threshold = threshold
+        self.seed_weight = seed_weight
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+        self.k1 = k1
+        self.b = b
+
+    @staticmethod
+    def _query_words(text: str) -> list[str]:
+        return list(dict.fromkeys(word for word in tokenize_words(text) if word not in STOP_WORDS))
+
+    def _match(self, documents: list[tuple[Counter, float]], query: list[str]) -> list[float]:
+        # BM25 with weighted term frequencies, normalized by the score of a document that matches every word
+        if not query:
+            return [0.0] * len(documents)
+        average_length = sum(length for _, length in documents) / len(documents) or 1.0
+        idf = {word: math.log(1 + (len(documents) - df + 0.5) / (df + 0.5))
+               for word in query for df in [sum(1 for frequencies, _ in documents if word in frequencies)]}
+        max_score = sum(idf.values()) * (self.k1 + 1)
+
+        scores = []
+        for frequencies, length in documents:
+            norm = self.k1 * (1 - self.b + self.b * length / average_length)
+            score = sum(idf[word] * frequencies[word] * (self.k1 + 1) / (frequencies[word] + norm)
+                        for word in query if word in frequencies)
+            scores.append(score / max_score)
+        return scores
+
+    def score(self, videos: list[Video], search_term: str, corpus: list[Video] | None = None) -> list[dict[str, float]]:
+        """
+        Scores videos by their search metadata.
+
+        Args:
+        videos (list[Video]): The videos to score.
+        search_term (str): The search term they were found with.
+        corpus (list[Video] | None): The search results the document frequencies are computed on. If None, the
+        videos themselves.
+
+        Returns:
+        list[dict[str, float]]: Per video, the score and its components: the match of the search term and the
+        seed topic, and the factors for duration and popularity.
+        """
+        if not videos:
+            return []
+        corpus = corpus or videos
+        documents = []
+        for video in corpus:
+            frequencies = Counter()
+            length = 0.0
+            for field, weight in FIELD_WEIGHTS.items():
+                words = tokenize_words(getattr(video, field) or '')
+                for word in words:
+                    frequencies[word] += weight
+                length += weight * len(words)
+            documents.append((frequencies, length))
+
+        term_matches = self._match(documents, self._query_words(search_term))
+        seed_matches = self._match(documents, self._query_words(self.seed_topic))
+        positions = {id(video): position for position, video in enumerate(corpus)}
+
+        scores = []
+        for video in videos:
+            term_match, seed_match = term_matches[positions[id(video)]], seed_matches[positions[id(video)]]
+            seconds = parse_duration(video.duration)
+            duration_factor = 0.5 if seconds is not None and not self.min_duration <= seconds <= self.max_duration \
+                else 1.0
+            popularity_factor = 0.8 + 0.2 * min(1.0, math.log10(1 + video.view_count) / 6) \
+                if video.view_count is not None else 0.9
+            match = (term_match + self.seed_weight * seed_match) / (1 + self.seed_weight)
+            scores.append({"score": match * duration_factor * popularity_factor, "term_match": term_match,
+                           "seed_match": seed_match, "duration_factor": duration_factor,
+                           "popularity_factor": popularity_factor})
+        return scores
+
+    def select(self, videos: list[Video], search_term: str, top_n: int | None = None,
+               corpus: list[Video] | None = None) -> list[Video]:
+        """
+        Ranks videos by score and returns the top_n videos with a score of at least the threshold, best first.
+        Rejected videos are logged with their scores, so the filter can be audited.
+
+        Args:
+        videos (list[Video]): The candidate videos.
+        search_term (str): The search term they were found with.
+        top_n (int | None): The maximum number of videos to return. If None, all videos above the threshold are
+        returned.
+        corpus (list[Video] | None): All search results, which must include the candidates (see score).
+
+        Returns:
+        list[Video]: The selected videos.
+        """
+        ranked = sorted(zip(videos, self.score(videos, search_term, corpus)), key=lambda item: -item[1]["score"])
+        selected = []
+        for video, scores in ranked:
+            if scores["score"] < self.threshold:
+                reason = "below threshold"
+            elif top_n is not None and len(selected) >= top_n:
+                reason = f"not in top {top_n}"
+            else:
+                selected.append(video)
+                continue
+            logging.info(f"Rejected video {video.url} for '{search_term}' ({reason}): "
+                         + ', '.join(f"{name} {value:.3f}" for name, value in scores.items())
+                         + f", title {video.title!r}")
+        if len(selected) < len(videos):
+            get_metrics().count("relevance_rejections", len(videos) - len(selected), stage="search")
+        return selected
+
+
+if __name__ == '__main__':
+    from datetime import datetime
+    from yt_searcher import search_videos
+
+    search_term_ = 'Gaza humanitarian aid'
+    videos_ = list(search_videos(search_term_, datetime(2023, 10, 7), 20))
+    relevance_filter = RelevanceFilter('Israel Hamas')
+    for video_, scores_ in sorted(zip(videos_, relevance_filter.score(videos_, search_term_)),
+                                  key=lambda item: -item[1]["score"]):
+        print(f"{scores_['score']:.3f} {video_.title}")
@@ -0,0 +1,182 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from utils import tokenize_words
+
+DEFAULT_CACHE_PATH = './data/search_cache.sqlite'
+
+
+def normalize_search_term(search_term: str) -> str:
+    """
+    Normalizes a search term for comparison: lowercase words without punctuation, deduplicated and sorted,
+    so terms that only differ in word order, case or punctuation have the same normalized form.
+    """
+    return ' '.join(sorted(set(tokenize_words(search_term))))
+
+
+class SearchCache:
+    """
+    Local cache of video search results and per-term statistics on the number of new videos they yielded.
+
+    Results are keyed on the normalized search term, start date and max_results, and expire after ttl_seconds,
+    so new videos are found when a term is searched again later. They are stored as zlib-compressed JSON of the
+    DuckDuckGo search data.
+
+    Use journal_mode DELETE when processes on other hosts share the cache file; WAL mode needs them on one host.
+    """
+
+    def __init__(self, db_path: str, ttl_seconds: float = 24 * 60 * 60, journal_mode: str = 'WAL'):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute(f"PRAGMA journal_mode={journal_mode}")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS search_results (
+                                        term TEXT NOT NULL,
+                                        start_date TEXT NOT NULL,
+                                        max_results INTEGER NOT NULL,
+                                        results BLOB NOT NULL,
+                                        searched_at REAL NOT NULL,
+                                        PRIMARY KEY (term, start_date, max_results))""")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS term_yield (
+                                        term TEXT PRIMARY KEY,
+                                        searches INTEGER NOT NULL,
+                                        results INTEGER NOT NULL,
+                                        new_videos INTEGER NOT NULL)""")
+        self._connection.commit()
+
+    def get(self, search_term: str, start_date: datetime, max_results: int) -> list[dict] | None:
+        """
+        Looks up the search results of a search term.
+
+        Returns:
+        list[dict] | None: The search data of the results, or None if the search is not cached or has expired.
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT results, searched_at FROM search_results "
+                                           "WHERE term = ? AND start_date = ? AND max_results = ?",
+                                           (normalize_search_term(search_term), start_date.isoformat(),
+                                            max_results)).fetchone()
+        if row is None or row[1] + self.ttl_seconds < time.time():
+            return None
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, search_term: str, start_date: datetime, max_results: int, results: list[dict]) -> None:
+        blob = zlib.compress(json.dumps(results).encode('utf-8'))
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO search_results (term, start_date, max_results, results, "
+                                     "searched_at) VALUES (?, ?, ?, ?, ?)",
+                                     (normalize_search_term(search_term), start_date.isoformat(), max_results, blob,
+                                      time.time()))
+            self._connection.commit()
+
+    def record_yield(self, search_term: str, result_count: int, new_video_count: int) -> None:
+        """
+        Adds a search to the statistics of a search term: the number of results and how many of them were new.
+        """
+        with self._lock:
+            self._connection.execute("INSERT INTO term_yield (term, searches, results, new_videos) VALUES (?, 1, ?, ?) "
+                                     "ON CONFLICT (term) DO UPDATE SET searches = searches + 1, "
+                                     "results = results + excluded.results, "
+                                     "new_videos = new_videos + excluded.new_videos",
+                                     (normalize_search_term(search_term), result_count, new_video_count))
+            self._connection.commit()
+
+    def get_yield(self, search_term: str) -> dict | None:
+        """
+        Returns the statistics of a search term: the number of searches, results and new videos.
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT searches, results, new_videos FROM term_yield WHERE term = ?",
+                                           (normalize_search_term(search_term),)).fetchone()
+        return {"searches": row[0], "results": row[1], "new_videos": row[2]} if row else None
+
+    def is_low_yield(self, search_term: str, min_yield: float = 0.1, min_results: int = 8) -> bool:
+        """
+        Returns True if earlier searches of the term returned at least min_results results, of which less than
+        min_yield (fraction) were new videos, so searching it again is unlikely to be worth it.
+        """
+        stats = self.get_yield(search_term)
+        if stats is None or stats["results"] < min_results:
+            return False
+        return stats["new_videos"] / stats["results"] < min_yield
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class SearchedTerms:
+    """
+    The search terms that are searched in a crawl. A term counts as searched if a searched term has (nearly) the
+    same words: the Jaccard similarity of their normalized word sets is at least similarity_threshold.
+    """
+
+    def __init__(self, similarity_threshold: float = 0.8):
+        self.similarity_threshold = similarity_threshold
+        self._terms: dict[str, str] = {}  # normalized term -> the term that was searched
+        self._terms_by_word: dict[str, set[str]] = {}
+
+    def find_similar(self, search_term: str) -> str | None:
+        """
+        Returns the searched term that is most similar to search_term, or None if no term is similar enough.
+        """
+        normalized = normalize_search_term(search_term)
+        if normalized in self._terms:
+            return self._terms[normalized]
+
+        words = set(normalized.split())
+        candidates = set().union(*(self._terms_by_word.get(word, ()) for word in words))
+        best_term, best_similarity = None, 0.0
+        for candidate in candidates:
+            candidate_words = set(candidate.split())
+            similarity = len(words & candidate_words) / len(words | candidate_words)
+            if similarity > best_similarity:
+                best_term, best_similarity = candidate, similarity
+        return self._terms[best_term] if best_similarity >= self.similarity_threshold else None
+
+    def add(self, search_term: str) -> None:
+        normalized = normalize_search_term(search_term)
+        self._terms.setdefault(normalized, search_term)
+        for word in normalized.split():
+            self._terms_by_word.setdefault(word, set()).add(normalized)
+
+    def __contains__(self, search_term: str) -> bool:
+        return self.find_similar(search_term) is not None
+
+    def __len__(self) -> int:
+        return len(self._terms)
+
+    def __iter__(self):
+        return iter(self._terms.values())
+
+
+_search_cache: SearchCache | None = None
+_cache_disabled = False
+
+
+def get_search_cache() -> SearchCache | None:
+    """
+    Returns the search cache shared by all searches, creating it on first use. Returns None if caching is disabled.
+    """
+    global _search_cache
+    if _cache_disabled:
+        return None
+    if _search_cache is None:
+        os.makedirs(os.path.dirname(DEFAULT_CACHE_PATH), exist_ok=True)
+        _search_cache = SearchCache(DEFAULT_CACHE_PATH)
+    return _search_cache
+
+
+def set_search_cache(cache: SearchCache | None) -> None:
+    """
+    Replaces the shared search cache, e.g. to use another path or TTL. Pass None to disable caching.
+    """
+    global _search_cache, _cache_disabled
+    _search_cache = cache
+    _cache_disabled = cache is None
@@ -1,10 +1,7 @@
-from langchain.chains import LLMChain
-from langchain_openai import ChatOpenAI
-from langchain.prompts import PromptTemplate
+from llm_gateway import batch, invoke
+from metrics import timed
 
-
-def create_search_term(narrative: str) -> str:
-    prompt_text = """### CONTEXT
+SEARCH_TERM_PROMPT = """### CONTEXT
 The text below is a narrative found in YouTube videos:
 ---
 {narrative}
@@ -17,15 +14,27 @@ Only use words from the given narrative or derivatives of those words. Use at mo
 Respond with a single string containing the search term, and nothing else.
 """
 
-    prompt_template = PromptTemplate(
-        input_variables=["narrative"],
-        template=prompt_text
-    )
-    llm = ChatOpenAI(temperature=1, model_name='gpt-3.5-turbo-16k', max_tokens=25)
 
-    chain = LLMChain(llm=llm, prompt=prompt_template)
-    result = chain.invoke({"narrative": narrative})
-    return result["text"]
+@timed('search_term_creation')
+def create_search_term(narrative: str) -> str:
+    return invoke(SEARCH_TERM_PROMPT,
+                  {"narrative": narrative},
+                  model_name='gpt-3.5-turbo-16k',
+                  max_tokens=25,
+                  temperature=1)
+
+
+@timed('search_term_creation')
+def create_search_terms(narratives: list[str], max_concurrency: int = 4) -> list[str]:
+    """
+    Creates the search terms of several narratives, with up to max_concurrency concurrent LLM calls.
+    """
+    return batch(SEARCH_TERM_PROMPT,
+                 [{"narrative": narrative} for narrative in narratives],
+                 model_name='gpt-3.5-turbo-16k',
+                 max_tokens=25,
+                 temperature=1,
+                 max_concurrency=max_concurrency)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,138 @@
+import random
+from datetime import date, timedelta
+
+from content_manager import ContentManager
+from narrative import Narrative
+from video import Video
+
+# Corpus sizes (number of videos) of the benchmarks
+CORPUS_SIZES = {"1k": 1_000, "10k": 10_000, "100k": 100_000}
+
+# Topics of the synthetic narratives: each topic has its own subjects, verbs and objects, so narratives of the same
+# topic share words like real narratives about the same subject do
+TOPICS = [
+    (["Israel", "the IDF", "the Israeli government", "Netanyahu"],
+     ["bombs", "blockades", "invades", "attacks", "occupies"],
+     ["Gaza", "the Gaza Strip", "Rafah", "hospitals in Gaza", "refugee camps"]),
+    (["Hamas", "militants", "the Qassam Brigades", "Hamas leaders"],
+     ["attacks", "kidnaps", "fires rockets at", "infiltrates", "threatens"],
+     ["Israeli civilians", "kibbutzim", "the music festival", "southern Israel", "hostages"]),
+    (["the United States", "Biden", "the State Department", "Congress"],
+     ["supports", "funds", "arms", "criticizes", "pressures"],
+     ["Israel", "the ceasefire talks", "humanitarian aid", "Egypt", "Qatar"]),
+    (["Iran", "Hezbollah", "the Houthis", "proxy groups"],
+     ["funds", "supplies", "attacks", "threatens", "escalates against"],
+     ["shipping in the Red Sea", "northern Israel", "US bases", "Hamas", "the region"]),
+    (["the media", "Western journalists", "Al Jazeera", "social media"],
+     ["hides", "spreads", "distorts", "reports", "censors"],
+     ["the truth about Gaza", "propaganda", "civilian casualties", "the hostage crisis", "protests"]),
+    (["the United Nations", "UNRWA", "aid agencies", "the ICJ"],
+     ["condemns", "investigates", "delivers", "warns about", "demands"],
+     ["a humanitarian crisis", "famine in Gaza", "war crimes", "a ceasefire", "genocide"]),
+]
+
+UPLOADERS = [f"Channel {index}" for index in range(500)]
+
+
+def make_narrative(rng: random.Random, topic: int) -> str:
+    """
+    Returns a synthetic narrative description about a topic: one or two sentences of subject, verb and object.
+    """
+    subjects, verbs, objects = TOPICS[topic]
+    sentences = [f"{rng.choice(subjects)} {rng.choice(verbs)} {rng.choice(objects)}"
+                 for _ in range(rng.randint(1, 2))]
+    return '. '.join(sentence[0].upper() + sentence[1:] for sentence in sentences) + '.'
+
+
+def make_transcript(rng: random.Random, topic: int, sentence_count: int) -> list[str]:
+    """
+    Returns the captions of a synthetic transcript about a topic, mostly about that topic and partly about others.
+    """
+    return [make_narrative(rng, topic if rng.random() < 0.7 else rng.randrange(len(TOPICS)))
+            for _ in range(sentence_count)]
+
+
+def make_video(index: int, rng: random.Random, topic: int) -> Video:
+    video = Video()
+    video.video_id = f"syn{index:08d}"
+    video.url = f"https://www.youtube.com/watch?v={video.video_id}"
+    video.title = make_narrative(rng, topic)[:80]
+    video.description = make_narrative(rng, topic)
+    video.duration = f"{rng.randint(4, 19)}:{rng.randint(0, 59):02d}"
+    video.published_date = date(2023, 10, 7) + timedelta(days=rng.randrange(120))
+    video.publisher = "YouTube"
+    video.view_count = int(rng.paretovariate(1.2) * 1000)
+    video.uploader = rng.choice(UPLOADERS)
+    return video
+
+
+def generate_content_manager(video_count: int,
+                             narratives_per_video: int = 5,
+                             merged_cluster_size: int = 20,
+                             duplicate_rate: float = 0.3,
+                             seed: int = 0) -> ContentManager:
+    """
+    Generates a deterministic synthetic content manager, shaped like the result of a crawl with 3 iterations.
+
+    Videos are spread over the 3 iterations. Each video has narratives_per_video narratives about its topic, of
+    which about duplicate_rate are near-duplicates of earlier narratives. The narratives of each iteration are
+    merged per topic into narratives of the next iteration, each based on merged_cluster_size narratives, and
+    linked to the videos of the narratives they are based on, like ContentManager.cluster_and_merge_narratives.
+    Transcripts are not generated.
+
+    Args:
+    video_count (int): The number of videos.
+    narratives_per_video (int): The number of narratives per video.
+    merged_cluster_size (int): The number of narratives each merged narrative is based on.
+    duplicate_rate (float): The fraction of narratives that are near-duplicates of earlier narratives.
+    seed (int): The random seed.
+
+    Returns:
+    ContentManager: The content manager.
+    """
+    rng = random.Random(seed)
+    content_manager = ContentManager()
+    recent_narratives = [[] for _ in TOPICS]
+
+    for index in range(video_count):
+        topic = rng.randrange(len(TOPICS))
+        iteration = index * 3 // video_count + 1
+        descriptions = []
+        for _ in range(narratives_per_video):
+            if recent_narratives[topic] and rng.random() < duplicate_rate:
+                words = rng.choice(recent_narratives[topic]).split()
+                words[rng.randrange(len(words))] = rng.choice(TOPICS[topic][1])
+                descriptions.append(' '.join(words))
+            else:
+                descriptions.append(make_narrative(rng, topic))
+        recent_narratives[topic] = (recent_narratives[topic] + descriptions)[-50:]
+        search_term = ' '.join(make_narrative(rng, topic).split()[:4])
+        content_manager.add_video_narratives(make_video(index, rng, topic), descriptions, search_term, iteration)
+
+    for iteration in (1, 2, 3):
+        narratives = content_manager.get_narratives_by_iteration(iteration)
+        for start in range(0, len(narratives), merged_cluster_size):
+            based_on = [narrative.narrative_id for narrative in narratives[start:start + merged_cluster_size]]
+            merged = Narrative(content_manager.next_narrative_id, narratives[start].description, iteration + 1,
+                               based_on=based_on)
+            content_manager._register_narrative(merged)
+            video_ids = {video_id for narrative_id in based_on
+                         for video_id in content_manager.narrative_to_videos.get(narrative_id, ())}
+            for video_id in sorted(video_ids):
+                content_manager.link_video_narrative(video_id, merged.narrative_id)
+    return content_manager
+
+
+def write_corpus(path: str, video_count: int, seed: int = 0) -> ContentManager:
+    """
+    Generates a synthetic content manager and writes it to a content.json file.
+    """
+    content_manager = generate_content_manager(video_count, seed=seed)
+    with open(path, 'w') as file:
+        file.write(content_manager.serialize())
+    return content_manager
+
+
+if __name__ == '__main__':
+    for name, size in CORPUS_SIZES.items():
+        write_corpus(f'./data/synthetic_{name}.json', size)
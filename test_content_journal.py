@@ -0,0 +1,72 @@
+from content_journal import load_content_store, open_content_manager
+from video import Video
+
+
+def _video(video_id: str) -> Video:
+    video = Video()
+    video.video_id = video_id
+    video.url = f"https://www.youtube.com/watch?v={video_id}"
+    video.title = f"Video {video_id}"
+    video.transcript = f"Transcript of {video_id}"
+    return video
+
+
+def test_entries_after_a_torn_tail_survive_a_restart(tmp_path):
+    store_dir = str(tmp_path / 'store')
+    content_manager, journal = open_content_manager(store_dir)
+    content_manager.add_video_narratives(_video('a'), ["Narrative of a"], "term", 1)
+    journal.close()
+
+    # a crash in the middle of writing an entry leaves a torn last line
+    with open(journal.journal_path, 'a') as file:
+        file.write('{"seq": 3, "op": "add_vid')
+
+    content_manager, journal = open_content_manager(store_dir)
+    assert list(content_manager.videos) == ['a']
+    content_manager.add_video_narratives(_video('b'), ["Narrative of b"], "term", 1)
+    journal.close()
+
+    content_manager, journal = open_content_manager(store_dir)
+    journal.close()
+    assert sorted(content_manager.videos) == ['a', 'b']
+    assert sorted(narrative.description for narrative in content_manager.narratives.values()) == \
+        ["Narrative of a", "Narrative of b"]
+
+
+def test_complete_last_entry_without_newline_is_kept(tmp_path):
+    store_dir = str(tmp_path / 'store')
+    content_manager, journal = open_content_manager(store_dir)
+    content_manager.add_video(_video('a'))
+    journal.close()
+
+    # the entry is complete, but the crash happened before its newline was written
+    with open(journal.journal_path, 'rb+') as file:
+        file.seek(-1, 2)
+        file.truncate()
+
+    content_manager, journal = open_content_manager(store_dir)
+    content_manager.add_video(_video('b'))
+    journal.close()
+
+    content_manager, journal = open_content_manager(store_dir)
+    journal.close()
+    assert sorted(content_manager.videos) == ['a', 'b']
+
+
+def test_read_only_load_does_not_modify_the_store(tmp_path):
+    store_dir = str(tmp_path / 'store')
+    content_manager, journal = open_content_manager(store_dir)
+    content_manager.add_video_narratives(_video('a'), ["Narrative of a"], "term", 1)
+    journal.compact()
+    content_manager.add_video(_video('b'))
+    journal.close()
+
+    # a crawl is writing an entry while the store is read
+    with open(journal.journal_path, 'a') as file:
+        file.write('{"seq": 4, "op": "add_vid')
+    files = {path: path.read_bytes() for path in (tmp_path / 'store').iterdir()}
+
+    content_manager = load_content_store(store_dir)
+    assert sorted(content_manager.videos) == ['a', 'b']
+    assert content_manager.videos['a'].transcript == "Transcript of a"
+    assert {path: path.read_bytes() for path in (tmp_path / 'store').iterdir()} == files
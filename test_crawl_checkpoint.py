@@ -0,0 +1,51 @@
+from datetime import datetime
+
+import pytest
+
+from content_manager import ContentManager
+from crawl_checkpoint import CrawlCheckpoint
+from crawler import PipelinedCrawler
+from fakes import fake_services
+from main import iterative_narrative_expansion
+
+
+def _crawl(content_manager: ContentManager, pipelined: bool) -> None:
+    if pipelined:
+        PipelinedCrawler(content_manager, datetime(2023, 10, 7), 20).run("Israel Hamas", 2,
+                                                                           checkpoint=CrawlCheckpoint())
+    else:
+        iterative_narrative_expansion(content_manager, "Israel Hamas", datetime(2023, 10, 7), 2, 20,
+                                      checkpoint=CrawlCheckpoint())
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_new_crawl_keeps_the_merges_of_earlier_crawls(pipelined):
+    content_manager = ContentManager()
+    with fake_services():
+        _crawl(content_manager, pipelined)
+        earlier_merged = {narrative.narrative_id for narrative in content_manager.get_merged_narratives()}
+        assert earlier_merged
+
+        # a new crawl (not resumed) over the same store starts with an empty checkpoint
+        _crawl(content_manager, pipelined)
+
+    assert earlier_merged <= set(content_manager.narratives)
+    for narrative in content_manager.narratives.values():
+        assert all(narrative_id in content_manager.narratives for narrative_id in narrative.based_on or ())
+
+
+def test_interrupted_merge_of_the_crawl_is_discarded():
+    content_manager = ContentManager()
+    with fake_services():
+        _crawl(content_manager, pipelined=False)
+        earlier_merged = {narrative.narrative_id for narrative in content_manager.get_merged_narratives()}
+
+        # the new crawl is interrupted while it merges its first iteration
+        checkpoint = CrawlCheckpoint()
+        checkpoint.start("Israel Hamas", 2, content_manager.next_narrative_id)
+        unfinished = content_manager.cluster_and_merge_narratives(content_manager.get_narratives_by_iteration(1), 1)
+        assert unfinished
+
+    checkpoint.discard_unfinished_merge(content_manager, 1)
+    assert not {narrative.narrative_id for narrative in unfinished} & set(content_manager.narratives)
+    assert earlier_merged <= set(content_manager.narratives)
@@ -0,0 +1,42 @@
+from unittest import mock
+
+import narrative_clustering
+from narrative_clustering import cluster_narratives_hierarchical
+
+
+def _drop_first_id(narrative_id_desc_map: dict[int, str]) -> list[tuple[str, list[int]]]:
+    """Fake clustering call: one cluster of all narratives except the first, which the model leaves out."""
+    return [("Cluster", list(narrative_id_desc_map)[1:])]
+
+
+def _all_ids(clusters: list[tuple[str, list[int]]]) -> list[int]:
+    return sorted(narrative_id for _, based_on in clusters for narrative_id in based_on)
+
+
+def test_narratives_left_out_of_a_single_call_are_kept():
+    narratives = {narrative_id: f"Narrative {narrative_id}" for narrative_id in range(1, 6)}
+    with mock.patch.object(narrative_clustering, 'cluster_narratives', _drop_first_id):
+        clusters = cluster_narratives_hierarchical(narratives)
+    assert clusters == [("Cluster", [2, 3, 4, 5]), ("Narrative 1", [1])]
+
+
+def test_failed_single_call_keeps_every_narrative():
+    narratives = {narrative_id: f"Narrative {narrative_id}" for narrative_id in range(1, 4)}
+    with mock.patch.object(narrative_clustering, 'cluster_narratives', side_effect=ValueError("unparsable")):
+        clusters = cluster_narratives_hierarchical(narratives)
+    assert _all_ids(clusters) == [1, 2, 3]
+
+
+def test_summaries_left_out_at_the_top_level_keep_their_narratives():
+    narratives = {narrative_id: f"Narrative {narrative_id} about topic {narrative_id % 10}"
+                  for narrative_id in range(1, 201)}
+
+    def cluster_batches(batches, max_concurrency):
+        # each batch is reduced to two clusters, so the summaries of all batches fit in one call
+        return [[(f"Summary {index}a", list(batch)[::2]), (f"Summary {index}b", list(batch)[1::2])]
+                for index, batch in enumerate(batches)]
+
+    with mock.patch.object(narrative_clustering, 'cluster_narratives_batch', cluster_batches), \
+            mock.patch.object(narrative_clustering, 'cluster_narratives', _drop_first_id):
+        clusters = cluster_narratives_hierarchical(narratives)
+    assert _all_ids(clusters) == list(range(1, 201))
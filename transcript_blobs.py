@@ -0,0 +1,74 @@
+import mmap
+import os
+import threading
+
+
+class TranscriptBlobFile:
+    """
+    Append-only file of UTF-8 encoded transcripts, read through mmap.
+
+    A transcript is addressed by its (offset, length) in the file; the index of those positions is kept by the
+    caller. Transcripts are never rewritten, so existing positions stay valid when new transcripts are appended.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        self._mmap = None
+        self._mapped_size = 0
+
+    def append(self, transcript: str) -> tuple[int, int]:
+        """
+        Appends a transcript to the file.
+
+        Args:
+        transcript (str): The transcript.
+
+        Returns:
+        tuple[int, int]: The offset and the length in bytes of the stored transcript.
+        """
+        data = transcript.encode('utf-8')
+        with self._lock:
+            with open(self.path, 'ab') as file:
+                offset = file.tell()
+                file.write(data)
+        return offset, len(data)
+
+    def read(self, offset: int, length: int) -> str:
+        """
+        Reads the transcript stored at the given offset.
+        """
+        if length == 0:
+            return ""
+        with self._lock:
+            if offset + length > self._mapped_size:
+                self._remap()
+            return self._mmap[offset:offset + length].decode('utf-8')
+
+    def _remap(self) -> None:
+        self._close_map()
+        self._file = open(self.path, 'rb')
+        self._mapped_size = os.fstat(self._file.fileno()).st_size
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _close_map(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._mapped_size = 0
+
+    def flush(self) -> None:
+        """
+        Forces appended transcripts to disk.
+        """
+        with self._lock:
+            with open(self.path, 'ab') as file:
+                os.fsync(file.fileno())
+
+    def close(self) -> None:
+        with self._lock:
+            self._close_map()
@@ -0,0 +1,167 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from cassette import through_cassette
+from metrics import get_metrics
+from rate_limiter import get_rate_limiter
+
+DEFAULT_STORE_PATH = './data/transcripts.sqlite'
+
+
+class TranscriptStore:
+    """
+    Local store of YouTube transcripts, keyed by video ID.
+
+    Captions are stored as zlib-compressed JSON blobs in SQLite. Videos without a transcript are recorded as
+    well (negative caching), so they are not fetched again until missing_ttl_seconds have passed.
+
+    With journal_mode DELETE instead of WAL, the store can be shared by processes on several hosts.
+    """
+
+    def __init__(self, db_path: str, missing_ttl_seconds: float = 7 * 24 * 60 * 60, journal_mode: str = 'WAL'):
+        self.db_path = db_path
+        self.missing_ttl_seconds = missing_ttl_seconds
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute(f"PRAGMA journal_mode={journal_mode}")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS transcripts (
+                                        video_id TEXT PRIMARY KEY,
+                                        has_transcript INTEGER NOT NULL,
+                                        captions BLOB,
+                                        fetched_at REAL NOT NULL)""")
+        self._connection.commit()
+
+    def get(self, video_id: str) -> list[dict] | None:
+        """
+        Looks up the captions of a video in the store.
+
+        Args:
+        video_id (str): The YouTube video ID.
+
+        Returns:
+        list[dict] | None: The captions, an empty list if the video is known to have no transcript,
+        or None if the video is not in the store (or its "no transcript" record has expired).
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT has_transcript, captions, fetched_at FROM transcripts "
+                                           "WHERE video_id = ?", (video_id,)).fetchone()
+        if row is None:
+            return None
+
+        has_transcript, captions, fetched_at = row
+        if has_transcript:
+            return json.loads(zlib.decompress(captions))
+        if fetched_at + self.missing_ttl_seconds < time.time():
+            return None
+        return []
+
+    def put(self, video_id: str, captions: list[dict]) -> None:
+        """
+        Stores the captions of a video. An empty list records that the video has no transcript.
+        """
+        blob = zlib.compress(json.dumps(captions).encode('utf-8')) if captions else None
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO transcripts (video_id, has_transcript, captions, "
+                                     "fetched_at) VALUES (?, ?, ?, ?)",
+                                     (video_id, 1 if captions else 0, blob, time.time()))
+            self._connection.commit()
+
+    def fetch(self, video_id: str) -> list[dict]:
+        """
+        Returns the captions of a video from the store, fetching them from YouTube if they are not stored yet.
+        Transient fetch errors are raised and not recorded, so the video is retried next time. When a cassette is
+        active (see cassette.py), the fetch is recorded to or replayed from the cassette.
+
+        Args:
+        video_id (str): The YouTube video ID.
+
+        Returns:
+        list[dict]: The captions (dicts with 'text', 'start' and 'duration'), or an empty list if the video
+        has no transcript.
+        """
+        captions = self.get(video_id)
+        if captions is not None:
+            get_metrics().count("transcript_cache_hits", stage="transcript_fetch")
+            return captions
+
+        captions = through_cassette("transcript", video_id, lambda: self._fetch_from_youtube(video_id))
+        self.put(video_id, captions)
+        return captions
+
+    @staticmethod
+    def _fetch_from_youtube(video_id: str) -> list[dict]:
+        from youtube_transcript_api import YouTubeTranscriptApi, InvalidVideoId, NoTranscriptAvailable, \
+            NoTranscriptFound, TranscriptsDisabled, VideoUnavailable
+
+        # errors that mean the video has no usable transcript, as opposed to transient (network) errors
+        missing_transcript_errors = (NoTranscriptFound, NoTranscriptAvailable, TranscriptsDisabled, VideoUnavailable,
+                                     InvalidVideoId)
+        try:
+            with get_metrics().stage("transcript_fetch"):
+                return get_rate_limiter("youtube").call(YouTubeTranscriptApi.get_transcript, video_id)
+        except missing_transcript_errors:
+            get_metrics().count("missing_transcripts", stage="transcript_fetch")
+            return []
+
+    def prefetch(self, video_ids: list[str], max_workers: int = 8) -> dict[str, int]:
+        """
+        Fetches the transcripts of all given videos that are not in the store yet.
+
+        Args:
+        video_ids (list[str]): The YouTube video IDs.
+        max_workers (int): The maximum number of concurrent fetches.
+
+        Returns:
+        dict[str, int]: The number of videos that were already stored, fetched, without transcript and failed.
+        """
+        counts = {"stored": 0, "fetched": 0, "missing": 0, "failed": 0}
+        to_fetch = []
+        for video_id in dict.fromkeys(video_ids):
+            if self.get(video_id) is None:
+                to_fetch.append(video_id)
+            else:
+                counts["stored"] += 1
+
+        def fetch_one(video_id):
+            try:
+                return "fetched" if self.fetch(video_id) else "missing"
+            except Exception as e:
+                logging.warning(f"Prefetching transcript of video {video_id} failed: {e}")
+                return "failed"
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for outcome in executor.map(fetch_one, to_fetch):
+                counts[outcome] += 1
+        return counts
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+_transcript_store: TranscriptStore | None = None
+
+
+def get_transcript_store() -> TranscriptStore:
+    """
+    Returns the transcript store shared by all videos, creating it on first use.
+    """
+    global _transcript_store
+    if _transcript_store is None:
+        os.makedirs(os.path.dirname(DEFAULT_STORE_PATH), exist_ok=True)
+        _transcript_store = TranscriptStore(DEFAULT_STORE_PATH)
+    return _transcript_store
+
+
+def set_transcript_store(store: TranscriptStore) -> None:
+    """
+    Replaces the shared transcript store, e.g. to use another path or TTL.
+    """
+    global _transcript_store
+    _transcript_store = store
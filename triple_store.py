@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+
+from utils import read_from_file
+
+DEFAULT_TRIPLE_STORE_PATH = './data/triple_store.json'
+
+
+class TripleStore:
+    """
+    Persisted triples per narrative and the canonical mappings of entities and predicates, so that a knowledge
+    graph rebuild only extracts and standardizes the triples of new or changed narratives.
+
+    A narrative's triples are stored with a hash of the description they were extracted from. The mappings map
+    every entity and predicate text that was seen to its canonical text.
+    """
+
+    def __init__(self, path: str = DEFAULT_TRIPLE_STORE_PATH):
+        self.path = path
+        self.narrative_triples: dict[int, dict] = {}  # narrative ID -> {"hash": ..., "triples": [...]}
+        self.entity_map: dict[str, str] = {}
+        self.predicate_map: dict[str, str] = {}
+        if os.path.exists(path):
+            self._load()
+
+    @staticmethod
+    def description_hash(description: str) -> str:
+        return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+    def changed_narratives(self, narrative_id_desc_map: dict[int, str]) -> dict[int, str]:
+        """
+        Returns the narratives that are new or whose description changed since their triples were stored.
+        """
+        return {nid: desc for nid, desc in narrative_id_desc_map.items()
+                if self.narrative_triples.get(nid, {}).get("hash") != self.description_hash(desc)}
+
+    def set_triples(self, narrative_id: int, description: str, triples: list[tuple]) -> None:
+        self.narrative_triples[narrative_id] = {"hash": self.description_hash(description),
+                                                "triples": [tuple(triple) for triple in triples]}
+
+    def retain(self, narrative_ids) -> list[int]:
+        """
+        Removes the triples of all narratives that are not in narrative_ids.
+
+        Returns:
+        list[int]: The IDs of the removed narratives.
+        """
+        narrative_ids = set(narrative_ids)
+        removed = [nid for nid in self.narrative_triples if nid not in narrative_ids]
+        for nid in removed:
+            del self.narrative_triples[nid]
+        return removed
+
+    def get_triples(self, narrative_ids) -> list[tuple]:
+        """
+        Returns the raw (not standardized) triples of the given narratives, without duplicates.
+        """
+        triples = {}
+        for nid in narrative_ids:
+            for triple in self.narrative_triples.get(nid, {}).get("triples", []):
+                triples[triple] = None
+        return list(triples)
+
+    def _load(self) -> None:
+        data = json.loads(read_from_file(self.path))
+        self.narrative_triples = {int(nid): {"hash": entry["hash"], "triples": [tuple(t) for t in entry["triples"]]}
+                                  for nid, entry in data["narratives"].items()}
+        self.entity_map = data["entity_map"]
+        self.predicate_map = data["predicate_map"]
+
+    def save(self) -> None:
+        """
+        Writes the store to disk, atomically replacing the previous version.
+        """
+        data = {
+            "narratives": self.narrative_triples,
+            "entity_map": self.entity_map,
+            "predicate_map": self.predicate_map,
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(data, file)
+        os.replace(tmp_path, self.path)
@@ -1,21 +1,12 @@
 import ast
+import logging
 
-from langchain.chains import LLMChain
-from langchain_openai import ChatOpenAI
-from langchain.prompts import PromptTemplate
 from langchain.schema import BaseOutputParser
 
+from llm_gateway import batch, invoke
+from metrics import get_metrics, timed
 
-class TriplesExtractionOutputParser(BaseOutputParser):
-
-    def parse(self, input_string: str):
-        # Convert the string representation to a list of strings
-        data = ast.literal_eval(input_string)
-        return data
-
-
-def extract_triples(narrative: str) -> list[str]:
-    prompt_text = """### CONTEXT
+TRIPLES_PROMPT = """### CONTEXT
 The text below is a narrative found in YouTube videos about the Israel-Hamas conflict that started on 7 October 2023:
 ---
 {narrative}
@@ -28,16 +19,138 @@ Extract triples for this text that can be used in a knowledge graph. For verbs u
 Respond as a list of 3-tuples in the format [("man" ,"eats", "lunch"), ("Peter", "lives in", "London")]. Do NOT add any other text.
 """
 
-    prompt_template = PromptTemplate(
-        input_variables=["narrative"],
-        template=prompt_text
-    )
+BATCH_TRIPLES_PROMPT = """### CONTEXT
+The dict below maps IDs to narratives found in YouTube videos about the Israel-Hamas conflict that started on 7 October 2023:
+---
+{narrative_id_desc_map}
+---
+
+### OBJECTIVE
+Extract triples for each narrative that can be used in a knowledge graph. For verbs use present tense. Try to prevent complex triple parts consisting of multiple words.
+
+### RESULT
+Respond as a dict that maps each narrative ID to a list of 3-tuples, in the format {{1: [("man" ,"eats", "lunch")], 2: [("Peter", "lives in", "London")]}}. Do NOT add any other text.
+"""
+
+
+class TriplesExtractionOutputParser(BaseOutputParser):
+
+    def parse(self, input_string: str):
+        # Convert the string representation to a list of 3-tuples of strings
+        data = ast.literal_eval(input_string)
+
+        if not isinstance(data, (list, tuple)) or not all(
+                isinstance(triple, (tuple, list)) and len(triple) == 3 and all(isinstance(part, str) for part in triple)
+                for triple in data):
+            raise ValueError("Input string does not represent a list of 3-tuples of strings.")
+        return [tuple(triple) for triple in data]
+
+
+class TriplesBatchExtractionOutputParser(BaseOutputParser):
+
+    def parse(self, input_string: str):
+        # Convert the string representation of the dict to a dict of narrative IDs to lists of 3-tuples
+        data = ast.literal_eval(input_string)
+
+        if not isinstance(data, dict):
+            raise ValueError("Input string does not represent a dict of narrative IDs to triples.")
+
+        processed_data = {}
+        for narrative_id, triples in data.items():
+            if not isinstance(narrative_id, int) or not isinstance(triples, list) or not all(
+                    isinstance(triple, (tuple, list)) and len(triple) == 3
+                    and all(isinstance(part, str) for part in triple) for triple in triples):
+                raise ValueError("Items are not in the expected format (integer, list of 3-tuples of strings).")
+            processed_data[narrative_id] = [tuple(triple) for triple in triples]
+
+        return processed_data
+
+
+@timed('triple_extraction')
+def extract_triples(narrative: str) -> list[str]:
+    return invoke(TRIPLES_PROMPT,
+                  {"narrative": narrative},
+                  model_name='gpt-4-1106-preview',
+                  max_tokens=500,
+                  temperature=1,
+                  output_parser=TriplesExtractionOutputParser())
+
+
+@timed('triple_extraction')
+def extract_triples_batch(narrative_id_desc_map: dict[int, str]) -> dict[int, list[tuple]]:
+    """
+    Extracts the triples of several narratives with a single LLM call.
+
+    Args:
+    narrative_id_desc_map (dict[int, str]): Maps narrative IDs to narrative descriptions.
+
+    Returns:
+    dict[int, list[tuple]]: Maps narrative IDs to their triples.
+    """
+    return invoke(BATCH_TRIPLES_PROMPT,
+                  {"narrative_id_desc_map": str(narrative_id_desc_map)},
+                  model_name='gpt-4-1106-preview',
+                  max_tokens=min(4000, 500 * len(narrative_id_desc_map)),
+                  temperature=1,
+                  output_parser=TriplesBatchExtractionOutputParser())
+
+
+def extract_triples_batched(narrative_id_desc_map: dict[int, str],
+                            batch_size: int = 8,
+                            max_workers: int = 4) -> dict[int, list[tuple]]:
+    """
+    Extracts the triples of many narratives, packing batch_size narratives into each LLM call and running up to
+    max_workers calls concurrently on the shared chat model of the LLM gateway. Narratives of a batch that fails
+    to parse, or that are missing from its response, are extracted with single-narrative calls instead. Narratives
+    whose single-narrative call fails too are logged and left out of the result, so they are extracted again by the
+    next build of the knowledge graph.
+
+    Args:
+    narrative_id_desc_map (dict[int, str]): Maps narrative IDs to narrative descriptions.
+    batch_size (int): The maximum number of narratives per LLM call.
+    max_workers (int): The maximum number of concurrent LLM calls.
+
+    Returns:
+    dict[int, list[tuple]]: Maps narrative IDs to their triples, in the order of narrative_id_desc_map.
+    """
+    narrative_ids = list(narrative_id_desc_map)
+    batches = [{nid: narrative_id_desc_map[nid] for nid in narrative_ids[i:i + batch_size]}
+               for i in range(0, len(narrative_ids), batch_size)]
 
-    llm = ChatOpenAI(temperature=1, model_name='gpt-4-1106-preview', max_tokens=200)
+    triples = {}
+    with get_metrics().stage('triple_extraction'):
+        responses = batch(BATCH_TRIPLES_PROMPT,
+                          [{"narrative_id_desc_map": str(narrative_batch)} for narrative_batch in batches],
+                          model_name='gpt-4-1106-preview',
+                          max_tokens=min(4000, 500 * batch_size),
+                          temperature=1,
+                          output_parser=TriplesBatchExtractionOutputParser(),
+                          max_concurrency=max_workers,
+                          return_exceptions=True)
+        for narrative_batch, batch_triples in zip(batches, responses):
+            if isinstance(batch_triples, Exception):
+                logging.warning(f"Batched triple extraction failed, falling back to single narratives: "
+                                f"{batch_triples}")
+                batch_triples = {}
+            triples.update((nid, batch_triples[nid]) for nid in narrative_batch if nid in batch_triples)
 
-    chain = LLMChain(llm=llm, prompt=prompt_template, output_parser=TriplesExtractionOutputParser())
-    result = chain.invoke({"narrative": narrative})
-    return result["text"]
+        missing_ids = [nid for nid in narrative_ids if nid not in triples]
+        responses = batch(TRIPLES_PROMPT,
+                          [{"narrative": narrative_id_desc_map[nid]} for nid in missing_ids],
+                          model_name='gpt-4-1106-preview',
+                          max_tokens=500,
+                          temperature=1,
+                          output_parser=TriplesExtractionOutputParser(),
+                          max_concurrency=max_workers,
+                          return_exceptions=True)
+        for nid, narrative_triples in zip(missing_ids, responses):
+            if isinstance(narrative_triples, Exception):
+                logging.warning(f"Triple extraction of narrative {nid} failed, the narrative is skipped: "
+                                f"{narrative_triples}")
+                get_metrics().count("skipped_narratives")
+                continue
+            triples[nid] = narrative_triples
+    return {nid: triples[nid] for nid in narrative_ids if nid in triples}
 
 
 if __name__ == '__main__':
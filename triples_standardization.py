@@ -1,40 +1,337 @@
 import ast
+import logging
+import re
+from collections import Counter
 
-from langchain.chains import LLMChain
-from langchain_openai import ChatOpenAI
-from langchain.prompts import PromptTemplate
 from langchain.schema import BaseOutputParser
 
+from llm_gateway import batch
+from metrics import timed
+from utils import tokenize_words
 
-class TriplesStandardizationOutputParser(BaseOutputParser):
+ARTICLES = ("the ", "a ", "an ")
 
-    def parse(self, input_string: str):
-        # Convert the string representation to a list of strings
-        data = ast.literal_eval(input_string)
-        return data
+# Auxiliary verbs that are reduced to a single form in predicates
+AUXILIARY_LEMMAS = {"are": "is", "was": "is", "were": "is", "be": "is", "been": "is", "being": "is",
+                    "have": "has", "had": "has"}
 
+# Words that do not make two phrases similar
+STOP_WORDS = frozenset("a an and as at by for from in into is of on or over the to with".split())
 
-def standardize_triples(triples: list[tuple]) -> list[tuple]:
-    prompt_text = """### CONTEXT
-The triples below are about the Israel-Hamas conflict that started on 7 October 2023:
+MAP_SYNONYMS_PROMPT = """### CONTEXT
+The lists below are groups of similar {kind} from the triples of a knowledge graph about the Israel-Hamas conflict that started on 7 October 2023:
 ---
-{triples}
+{groups}
 ---
 
 ### OBJECTIVE
-Standardize these triples by replacing synonyms and alternative phrasings in these triples with a single, consistent text throughout all triples, so that I can create a single consistent knowledge graph with them.
+Within each group, find the {kind} that are synonyms or alternative phrasings of each other, and choose one of them as the single, consistent text that replaces the others, so that I can create a single consistent knowledge graph. Only map {kind} that really mean the same thing.
 
 ### RESULT
-Respond as a list of 3-tuples in the format [("man" ,"eats", "lunch"), ("Peter", "lives in", "London")]. Do NOT add any other text.
+Respond as a dict that maps each of the {kind} that must be replaced to the text of the same group that replaces it, in the format {{"phrase1": "phrase2"}}. Do NOT add any other text.
 """
 
-    prompt_template = PromptTemplate(
-        input_variables=["triples"],
-        template=prompt_text
-    )
 
-    llm = ChatOpenAI(temperature=1, model_name='gpt-4-1106-preview', max_tokens=4000)
+class PhraseMappingOutputParser(BaseOutputParser):
+
+    def parse(self, input_string: str):
+        # Convert the string representation of the dict to a dict of phrases to canonical phrases
+        data = ast.literal_eval(input_string)
+
+        if not isinstance(data, dict) or not all(
+                isinstance(phrase, str) and isinstance(canonical, str) for phrase, canonical in data.items()):
+            raise ValueError("Input string does not represent a dict of phrases to canonical phrases.")
+
+        return data
+
+
+def normalize_phrase(phrase: str) -> str:
+    """
+    Normalizes case, whitespace and punctuation of a triple part and removes a leading article.
+    """
+    normalized = re.sub(r"[^\w\s'-]", " ", phrase.lower())
+    normalized = re.sub(r"\s+", " ", normalized.replace("-", " ")).strip()
+    for article in ARTICLES:
+        if normalized.startswith(article):
+            normalized = normalized[len(article):]
+            break
+    return normalized
+
+
+def singularize(word: str) -> str:
+    """
+    Reduces a plural noun or a third-person singular verb to its base form with simple suffix rules.
+    """
+    if len(word) <= 3 or word.endswith(("ss", "us", "is")):
+        return word
+    if word.endswith("ies"):
+        return word[:-3] + "y"
+    if word.endswith(("sses", "ches", "shes", "xes", "zes")):
+        return word[:-2]
+    if word.endswith("s"):
+        return word[:-1]
+    return word
+
+
+def entity_key(entity: str) -> str:
+    """
+    Returns the local canonical form of an entity: normalized, with its last word in singular.
+    """
+    words = normalize_phrase(entity).split()
+    if words:
+        words[-1] = singularize(words[-1])
+    return " ".join(words)
+
+
+def predicate_key(predicate: str) -> str:
+    """
+    Returns the local canonical form of a predicate: normalized, with auxiliaries unified and the verb lemmatized.
+    """
+    words = normalize_phrase(predicate).split()
+    if words:
+        words[0] = AUXILIARY_LEMMAS.get(words[0], words[0])
+        if words[0] not in ("is", "has"):
+            words[0] = singularize(words[0])
+    return " ".join(words)
+
+
+def standardize_triples(triples: list[tuple], max_workers: int = 4, max_batch_size: int = 100) -> list[tuple]:
+    """
+    Standardizes triples by replacing synonyms and alternative phrasings of entities and predicates with a single,
+    consistent text. Variants that only differ in case, punctuation, articles or inflection are unified locally.
+    Only groups of similar but not identical phrases are sent to the LLM, in bounded, parallel batches.
+
+    Args:
+    triples (list[tuple]): The (subject, predicate, object) triples.
+    max_workers (int): The maximum number of concurrent LLM calls.
+    max_batch_size (int): The maximum number of phrases per LLM call.
+
+    Returns:
+    list[tuple]: The standardized triples, without duplicates.
+    """
+    entity_map, predicate_map = build_standardization_mapping(triples, max_workers, max_batch_size)
+    return apply_standardization_mapping(triples, entity_map, predicate_map)
+
+
+def build_standardization_mapping(triples: list[tuple],
+                                  max_workers: int = 4,
+                                  max_batch_size: int = 100,
+                                  entity_map: dict[str, str] | None = None,
+                                  predicate_map: dict[str, str] | None = None) -> tuple[dict[str, str], dict[str, str]]:
+    """
+    Creates the mappings of entities and predicates to their canonical text. If existing mappings are given, they
+    are extended: texts that are already mapped keep their canonical text, and new texts are standardized against
+    the existing canonical vocabulary.
+
+    Args:
+    triples (list[tuple]): The (subject, predicate, object) triples.
+    max_workers (int): The maximum number of concurrent LLM calls.
+    max_batch_size (int): The maximum number of phrases per LLM call.
+    entity_map (dict[str, str] | None): An existing entity mapping.
+    predicate_map (dict[str, str] | None): An existing predicate mapping.
+
+    Returns:
+    tuple[dict[str, str], dict[str, str]]: The entity mapping and the predicate mapping, including all entries
+    of the existing mappings.
+    """
+    entities = Counter()
+    predicates = Counter()
+    for subject, predicate, obj in triples:
+        entities[subject] += 1
+        entities[obj] += 1
+        predicates[predicate] += 1
+
+    new_entity_map = canonicalize_phrases(entities, entity_key, "entities", max_workers, max_batch_size, entity_map)
+    new_predicate_map = canonicalize_phrases(predicates, predicate_key, "predicates", max_workers, max_batch_size,
+                                             predicate_map)
+    return {**(entity_map or {}), **new_entity_map}, {**(predicate_map or {}), **new_predicate_map}
+
+
+def apply_standardization_mapping(triples: list[tuple],
+                                  entity_map: dict[str, str],
+                                  predicate_map: dict[str, str]) -> list[tuple]:
+    """
+    Replaces the entities and predicates of triples by their canonical text and removes duplicates.
+    """
+    standardized = {}
+    for subject, predicate, obj in triples:
+        triple = (entity_map.get(subject, subject), predicate_map.get(predicate, predicate), entity_map.get(obj, obj))
+        standardized[triple] = None
+    return list(standardized)
+
+
+def canonicalize_phrases(phrase_counts: Counter,
+                         key_function,
+                         kind: str,
+                         max_workers: int = 4,
+                         max_batch_size: int = 100,
+                         existing_map: dict[str, str] | None = None) -> dict[str, str]:
+    """
+    Maps each phrase to a canonical phrase.
+
+    1. Phrases with the same local key (see entity_key and predicate_key) are unified to their most frequent text,
+       or to the existing canonical text with that key.
+    2. The remaining distinct phrases are grouped with a union-find over candidate pairs that share a word
+       (blocking) and have a word-set Jaccard similarity of at least 0.5. Existing canonical texts take part in
+       the grouping, but pairs of two existing texts are not considered again.
+    3. Only groups with more than one phrase are ambiguous; the LLM decides which of their phrases are synonyms.
+
+    Args:
+    phrase_counts (Counter): The number of occurrences of each phrase.
+    key_function: Function that returns the local canonical key of a phrase.
+    kind (str): "entities" or "predicates", used in the LLM prompt.
+    max_workers (int): The maximum number of concurrent LLM calls.
+    max_batch_size (int): The maximum number of phrases per LLM call.
+    existing_map (dict[str, str] | None): An existing mapping of phrases to canonical phrases.
+
+    Returns:
+    dict[str, str]: Maps each phrase to its canonical phrase.
+    """
+    existing_map = existing_map or {}
+    existing_by_key = {}
+    for canonical in sorted(set(existing_map.values())):
+        existing_by_key.setdefault(key_function(canonical), canonical)
+
+    # 1. local canonicalization
+    phrases_by_key = {}
+    for phrase, count in phrase_counts.items():
+        if phrase not in existing_map:
+            phrases_by_key.setdefault(key_function(phrase), Counter())[phrase] += count
+    canonical_by_key = {key: existing_by_key.get(key) or min(counts, key=lambda p: (-counts[p], len(p), p))
+                        for key, counts in phrases_by_key.items()}
+
+    # 2. alias grouping of the new keys, against each other and against the existing vocabulary
+    new_keys = [key for key in canonical_by_key if key not in existing_by_key]
+    groups = group_similar_phrases(new_keys + list(existing_by_key), new_phrase_count=len(new_keys))
+    surface = {**existing_by_key, **canonical_by_key}
+
+    # 3. LLM only for ambiguous groups
+    ambiguous_groups = [[surface[key] for key in group] for group in groups if len(group) > 1]
+    new_surfaces = {canonical_by_key[key] for key in new_keys}
+    llm_mapping = {phrase: canonical for phrase, canonical in
+                   resolve_ambiguous_groups(ambiguous_groups, kind, max_workers, max_batch_size).items()
+                   if phrase in new_surfaces}  # existing canonical texts are never changed
+    logging.info(f"Standardized {len(phrases_by_key)} new {kind} into {len(new_keys)} new local forms; "
+                 f"{sum(len(g) for g in ambiguous_groups)} forms in {len(ambiguous_groups)} groups went to the LLM.")
+
+    mapping = {phrase: existing_map[phrase] for phrase in phrase_counts if phrase in existing_map}
+    for key, counts in phrases_by_key.items():
+        canonical = canonical_by_key[key]
+        for _ in range(len(llm_mapping)):  # follow chains of replacements, e.g. a -> b -> c
+            if llm_mapping.get(canonical, canonical) == canonical:
+                break
+            canonical = llm_mapping[canonical]
+        for phrase in counts:
+            mapping[phrase] = canonical
+    return mapping
+
+
+def group_similar_phrases(phrases: list[str],
+                          min_similarity: float = 0.5,
+                          max_block_size: int = 200,
+                          new_phrase_count: int | None = None) -> list[list[str]]:
+    """
+    Groups phrases with a union-find over candidate pairs. Candidates are phrases that share a word that is not
+    a stop word (blocking); words shared by more than max_block_size phrases are too common to be used for
+    blocking. A candidate pair is joined if the Jaccard similarity of their word sets is at least min_similarity.
+    If new_phrase_count is given, only pairs that include one of the first new_phrase_count phrases are compared,
+    so the cost depends on the number of new phrases rather than on all phrases.
+
+    Returns:
+    list[list[str]]: The groups, including groups of one phrase.
+    """
+    words = [frozenset(tokenize_words(phrase)) - STOP_WORDS for phrase in phrases]
+    parent = list(range(len(phrases)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    blocks = {}
+    for i, phrase_words in enumerate(words):
+        for word in phrase_words:
+            blocks.setdefault(word, []).append(i)
+
+    new_phrase_count = len(phrases) if new_phrase_count is None else new_phrase_count
+    for block in blocks.values():
+        if len(block) > max_block_size or block[0] >= new_phrase_count:
+            continue  # too common, or no new phrases (indices in a block are ascending)
+        for position, i in enumerate(block):
+            if i >= new_phrase_count:
+                break
+            for j in block[position + 1:]:
+                root_i, root_j = find(i), find(j)
+                if root_i == root_j:
+                    continue
+                if len(words[i] & words[j]) / len(words[i] | words[j]) >= min_similarity:
+                    parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    groups = {}
+    for i, phrase in enumerate(phrases):
+        groups.setdefault(find(i), []).append(phrase)
+    return list(groups.values())
+
+
+def resolve_ambiguous_groups(groups: list[list[str]],
+                             kind: str,
+                             max_workers: int = 4,
+                             max_batch_size: int = 100) -> dict[str, str]:
+    """
+    Lets the LLM decide which phrases of each group are synonyms. Groups are packed into batches of at most
+    max_batch_size phrases (larger groups are split) that are sent concurrently. A phrase can only be mapped to
+    a phrase of its own group; failed batches leave their phrases unchanged.
+
+    Returns:
+    dict[str, str]: Maps phrases to the canonical phrase chosen by the LLM.
+    """
+    batches = []
+    group_batch = []
+    batch_size = 0
+    for group in groups:
+        for start in range(0, len(group), max_batch_size):
+            part = group[start:start + max_batch_size]
+            if group_batch and batch_size + len(part) > max_batch_size:
+                batches.append(group_batch)
+                group_batch, batch_size = [], 0
+            group_batch.append(part)
+            batch_size += len(part)
+    if group_batch:
+        batches.append(group_batch)
+
+    result = {}
+    for batch_groups, mapping in zip(batches, map_synonyms_batch(batches, kind, max_workers)):
+        if isinstance(mapping, Exception):
+            logging.warning(f"Standardizing a batch of {kind} failed, its phrases are left unchanged: {mapping}")
+            continue
+        group_of = {phrase: index for index, group in enumerate(batch_groups) for phrase in group}
+        result.update((phrase, canonical) for phrase, canonical in mapping.items()
+                      if phrase in group_of and group_of.get(canonical) == group_of[phrase])
+    return result
+
+
+@timed('standardization')
+def map_synonyms_batch(group_batches: list[list[list[str]]], kind: str,
+                       max_concurrency: int = 4) -> list[dict[str, str] | Exception]:
+    """
+    Asks the LLM to map the phrases of each group of similar phrases to a single text per meaning, for several
+    batches of groups, with up to max_concurrency concurrent LLM calls.
+
+    Args:
+    group_batches (list[list[list[str]]]): Batches of groups of similar phrases.
+    kind (str): "entities" or "predicates".
+    max_concurrency (int): The maximum number of concurrent LLM calls.
 
-    chain = LLMChain(llm=llm, prompt=prompt_template, output_parser=TriplesStandardizationOutputParser())
-    result = chain.invoke({"triples": str(triples)})
-    return result["text"]
+    Returns:
+    list[dict[str, str] | Exception]: Per batch, a map of phrases to their canonical phrase, or the exception of
+    its call if it failed.
+    """
+    return batch(MAP_SYNONYMS_PROMPT,
+                 [{"kind": kind, "groups": "\n".join(str(group) for group in groups)} for groups in group_batches],
+                 model_name='gpt-4-1106-preview',
+                 max_tokens=4000,
+                 temperature=1,
+                 output_parser=PhraseMappingOutputParser(),
+                 max_concurrency=max_concurrency,
+                 return_exceptions=True)
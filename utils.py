@@ -1,4 +1,5 @@
 import os
+import re
 
 
 def read_from_file(file_path: str) -> str:
@@ -26,3 +27,29 @@ def write_to_file(file_path: str, data: str) -> None:
     os.makedirs(os.path.dirname(file_path), exist_ok=True)
     with open(file_path, 'w') as file:
         file.write(data)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimates the number of LLM tokens in a text (roughly 4 characters per token for English text).
+
+    Args:
+    text (str): The text.
+
+    Returns:
+    int: The estimated number of tokens.
+    """
+    return len(text) // 4 + 1
+
+
+def tokenize_words(text: str) -> list[str]:
+    """
+    Splits a text into lowercase words, ignoring punctuation.
+
+    Args:
+    text (str): The text.
+
+    Returns:
+    list[str]: The words of the text.
+    """
+    return re.findall(r"[a-z0-9]+(?:'[a-z]+)?", text.lower())
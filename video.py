@@ -1,11 +1,22 @@
 import re
-from datetime import date
+import sys
+from datetime import date, datetime
 
 from dateutil import parser
-from youtube_transcript_api import YouTubeTranscriptApi
+
+from transcript_store import get_transcript_store
 
 
 class Video:
+    # Slotted to keep large corpora compact: no per-instance __dict__, statistics flattened into view_count and
+    # publisher/uploader interned, as they are shared by many videos.
+    __slots__ = ('url', 'video_id', 'description', 'duration', 'published_date', 'publisher', 'view_count', 'title',
+                 'uploader', '_transcript', '_transcript_source')
+
+    # Fields of the compact row representation, see to_row and from_row
+    ROW_FIELDS = ('url', 'video_id', 'description', 'duration', 'published_date', 'publisher', 'view_count',
+                  'title', 'uploader')
+
     def __init__(self):
         self.url: str | None = None
         self.video_id: str | None = None
@@ -13,10 +24,50 @@ class Video:
         self.duration: str | None = None
         self.published_date: date | None = None
         self.publisher: str | None = None
-        self.statistics: dict | None = None
+        self.view_count: int | None = None
         self.title: str | None = None
         self.uploader: str | None = None
-        self.transcript: str | None = None
+        self._transcript: str | None = None
+        self._transcript_source = None  # (blob file, offset, length) of a transcript that is loaded lazily
+
+    @property
+    def statistics(self) -> dict | None:
+        """
+        The statistics of the video as in the DuckDuckGo search data.
+        """
+        return {"viewCount": self.view_count} if self.view_count is not None else None
+
+    @statistics.setter
+    def statistics(self, statistics: dict | None) -> None:
+        view_count = statistics.get('viewCount') if statistics else None
+        self.view_count = int(view_count) if view_count is not None else None
+
+    @property
+    def transcript(self) -> str | None:
+        """
+        The transcript of the video. A transcript stored in a transcript blob file is read on each access
+        instead of being kept in memory.
+        """
+        if self._transcript_source is not None:
+            blob_file, offset, length = self._transcript_source
+            return blob_file.read(offset, length)
+        return self._transcript
+
+    @transcript.setter
+    def transcript(self, transcript: str | None) -> None:
+        self._transcript = transcript
+        self._transcript_source = None
+
+    @property
+    def transcript_source(self) -> tuple | None:
+        return self._transcript_source
+
+    def set_transcript_source(self, blob_file, offset: int, length: int) -> None:
+        """
+        Makes the transcript lazily loaded from a transcript blob file and releases the in-memory transcript.
+        """
+        self._transcript = None
+        self._transcript_source = (blob_file, offset, length)
 
     @classmethod
     def from_search_data(cls, search_data: dict) -> 'Video':
@@ -32,10 +83,10 @@ class Video:
         video.description = search_data.get('description')
         video.duration = search_data.get('duration')
         video.published_date = parser.parse(search_data.get('published')).date() if search_data.get('published') else None
-        video.publisher = search_data.get('publisher')
+        video.publisher = _intern(search_data.get('publisher'))
         video.statistics = search_data.get('statistics')
         video.title = search_data.get('title')
-        video.uploader = search_data.get('uploader')
+        video.uploader = _intern(search_data.get('uploader'))
         return video
 
     @classmethod
@@ -47,7 +98,54 @@ class Video:
         json_data (dict): A dictionary containing video data in JSON format.
         """
         video = cls()
-        video.__dict__.update(json_data)
+        for attribute, value in json_data.items():
+            setattr(video, attribute, value)
+        video.publisher = _intern(video.publisher)
+        video.uploader = _intern(video.uploader)
+        return video
+
+    def to_json_data(self, include_transcript: bool = True) -> dict:
+        """
+        Returns the video as JSON data (serialization), in the same layout that from_json_data reads.
+
+        Args:
+        include_transcript (bool): Whether the transcript is included.
+        """
+        json_data = {
+            'url': self.url,
+            'video_id': self.video_id,
+            'description': self.description,
+            'duration': self.duration,
+            'published_date': self.published_date.isoformat() if self.published_date else self.published_date,
+            'publisher': self.publisher,
+            'statistics': self.statistics,
+            'title': self.title,
+            'uploader': self.uploader,
+        }
+        if include_transcript:
+            json_data['transcript'] = self.transcript
+        return json_data
+
+    def to_row(self) -> list:
+        """
+        Returns the video (without transcript) as a list of values in the order of ROW_FIELDS, the compact
+        serialization used by the content store.
+        """
+        return [self.url, self.video_id, self.description, self.duration,
+                self.published_date.isoformat() if self.published_date else None, self.publisher, self.view_count,
+                self.title, self.uploader]
+
+    @classmethod
+    def from_row(cls, row: list) -> 'Video':
+        """
+        Initialize a Video object from a row created by to_row.
+        """
+        video = cls()
+        (video.url, video.video_id, video.description, video.duration, published_date, publisher, video.view_count,
+         video.title, uploader) = row
+        video.published_date = datetime.fromisoformat(published_date) if published_date else None
+        video.publisher = _intern(publisher)
+        video.uploader = _intern(uploader)
         return video
 
     @staticmethod
@@ -83,16 +181,30 @@ class Video:
     def fetch_transcript(self) -> None:
         """
         Fetches the transcript for the video and updates the transcript attribute.
-        If fetching fails, sets the transcript to an empty string.
+        The local transcript store is consulted first, so transcripts (and missing transcripts) are only
+        fetched from YouTube once. If fetching fails, sets the transcript to an empty string.
         """
         if self.is_youtube_video(self.url):
             try:
-                transcript_list = YouTubeTranscriptApi.get_transcript(self.video_id)
+                transcript_list = get_transcript_store().fetch(self.video_id)
                 self.transcript = ' '.join([entry['text'] for entry in transcript_list])
             except Exception:
                 self.transcript = ""
         else:
             self.transcript = ""
 
+    def get_captions(self) -> list[str]:
+        """
+        Returns the caption texts of the transcript from the local transcript store, or an empty list if they
+        are not stored.
+        """
+        if not self.is_youtube_video(self.url):
+            return []
+        return [entry['text'] for entry in get_transcript_store().get(self.video_id) or []]
+
     def __repr__(self) -> str:
         return f"Video(title='{self.title}', uploader='{self.uploader}', published_date='{self.published_date}')"
+
+
+def _intern(text: str | None) -> str | None:
+    return sys.intern(text) if text is not None else None
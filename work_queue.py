@@ -0,0 +1,328 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+import llm_gateway
+import search_cache
+import transcript_store
+from content_manager import ContentManager
+from llm_cache import LLMCache
+from metrics import get_metrics
+from video import Video
+
+DEFAULT_QUEUE_PATH = './data/work_queue.sqlite'
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+COMMITTED = 'committed'
+
+
+@dataclass
+class Job:
+    """A leased video job: the video to process, the search term it was found with and the lease token."""
+    job_id: int
+    level: int
+    video: Video
+    search_term: str
+    attempts: int
+    lease_token: str
+
+
+class WorkQueue:
+    """
+    Durable queue of video processing jobs in SQLite, so any number of worker processes, also on other hosts that
+    share the file system, can fetch transcripts and extract narratives for one crawl without a message broker.
+    The file system must support file locks (SQLite does not work on file systems without them).
+
+    A job is a video found in a BFS level. A worker leases jobs for lease_seconds; a job whose lease expires, e.g.
+    because its worker died, is leased again by another worker. A job that fails or expires max_attempts times is
+    marked as failed. Results are stored in the queue and only the coordinator (the crawl) commits them to the
+    content manager, when all jobs of the level are done (see commit_level). A result is only accepted with the
+    token of the current lease, and committing skips videos the content manager already has, so every video is
+    committed exactly once, also when the coordinator is interrupted while committing.
+
+    The queue and the caches in ./data (LLM cache, search cache and transcript store, see open_shared_caches) can
+    be shared by all hosts. The content store, the application log and the metrics reports are written by the
+    coordinator only, so no other host may run a crawl or write to them.
+    """
+
+    def __init__(self,
+                 db_path: str = DEFAULT_QUEUE_PATH,
+                 lease_seconds: float = 600,
+                 max_attempts: int = 3,
+                 poll_interval: float = 2.0):
+        """
+        Args:
+        db_path (str): The path of the SQLite file of the queue.
+        lease_seconds (float): Seconds after which the job of a worker that does not finish is leased again.
+        max_attempts (int): The maximum number of times a job is leased.
+        poll_interval (float): Seconds between checks of an empty queue (workers) or an undrained level (coordinator).
+        """
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        # other processes hold the write lock for short transactions only, so wait for it instead of failing
+        self._connection = sqlite3.connect(db_path, timeout=60, check_same_thread=False, isolation_level=None)
+        # not WAL: its index is shared memory, which workers on other hosts that share the file system cannot see
+        self._connection.execute("PRAGMA journal_mode=DELETE")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                        job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                        level INTEGER NOT NULL,
+                                        video_id TEXT NOT NULL,
+                                        video TEXT NOT NULL,
+                                        search_term TEXT NOT NULL,
+                                        status TEXT NOT NULL,
+                                        attempts INTEGER NOT NULL DEFAULT 0,
+                                        lease_token TEXT,
+                                        lease_owner TEXT,
+                                        lease_expires REAL,
+                                        result BLOB,
+                                        error TEXT,
+                                        UNIQUE (level, video_id))""")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, job_id)")
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Runs a write transaction. BEGIN IMMEDIATE takes the write lock at the start, so two workers never lease the
+        same job.
+        """
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def enqueue(self, level: int, videos: list[Video], search_term: str) -> int:
+        """
+        Adds a job per video to a BFS level, in the given order. Videos that are already queued in the level are
+        ignored, so enqueueing the results of a search again (e.g. when a crawl is resumed) adds nothing.
+
+        Returns:
+        int: The number of jobs added.
+        """
+        rows = [(level, video.video_id, _dumps(ContentManager._convert_video_to_dict(video, include_transcript=False)),
+                 search_term, PENDING) for video in videos]
+        with self._transaction() as connection:
+            before = connection.total_changes
+            connection.executemany("INSERT OR IGNORE INTO jobs (level, video_id, video, search_term, status) "
+                                   "VALUES (?, ?, ?, ?, ?)", rows)
+            added = connection.total_changes - before
+        get_metrics().count("queue_jobs_enqueued", added, stage="search")
+        return added
+
+    def queued_video_ids(self, level: int) -> set[str]:
+        with self._lock:
+            rows = self._connection.execute("SELECT video_id FROM jobs WHERE level = ?", (level,)).fetchall()
+        return {video_id for video_id, in rows}
+
+    def lease(self, worker_id: str, count: int = 1) -> list[Job]:
+        """
+        Leases up to count jobs, oldest first: pending jobs and jobs whose lease has expired. Expired jobs that
+        were already leased max_attempts times are marked as failed instead.
+
+        Args:
+        worker_id (str): Identifies the worker in the queue, for monitoring.
+        count (int): The maximum number of jobs to lease.
+
+        Returns:
+        list[Job]: The leased jobs, possibly none.
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            expired = connection.execute("UPDATE jobs SET status = ?, error = 'lease expired' WHERE status = ? "
+                                         "AND lease_expires < ? AND attempts >= ?",
+                                         (FAILED, LEASED, now, self.max_attempts)).rowcount
+            rows = connection.execute("SELECT job_id, level, video, search_term, attempts FROM jobs "
+                                      "WHERE status = ? OR (status = ? AND lease_expires < ?) ORDER BY job_id LIMIT ?",
+                                      (PENDING, LEASED, now, count)).fetchall()
+            jobs = []
+            for job_id, level, video, search_term, attempts in rows:
+                lease_token = uuid.uuid4().hex
+                connection.execute("UPDATE jobs SET status = ?, attempts = ?, lease_token = ?, lease_owner = ?, "
+                                   "lease_expires = ? WHERE job_id = ?",
+                                   (LEASED, attempts + 1, lease_token, worker_id, now + self.lease_seconds, job_id))
+                jobs.append(Job(job_id, level, ContentManager._convert_dict_to_video(json.loads(video)), search_term,
+                                attempts + 1, lease_token))
+        if expired:
+            get_metrics().count("queue_jobs_failed", expired, stage="process_video")
+        return jobs
+
+    def complete(self, job: Job, narrative_descriptions: list[str] | None) -> bool:
+        """
+        Stores the result of a job: the narratives and transcript of its video, or None if the video has no
+        transcript.
+
+        Returns:
+        bool: True if the result is stored, False if the lease of the job was lost to another worker.
+        """
+        result = None
+        if narrative_descriptions is not None:
+            result = zlib.compress(_dumps({"transcript": job.video.transcript,
+                                           "narratives": narrative_descriptions}).encode('utf-8'))
+        with self._transaction() as connection:
+            stored = connection.execute("UPDATE jobs SET status = ?, result = ?, error = NULL, lease_expires = NULL "
+                                        "WHERE job_id = ? AND status = ? AND lease_token = ?",
+                                        (DONE, result, job.job_id, LEASED, job.lease_token)).rowcount == 1
+        if not stored:
+            logging.warning(f"The result of job {job.job_id} is discarded, as its lease was lost.")
+        return stored
+
+    def fail(self, job: Job, error: str) -> None:
+        """
+        Returns a failed job to the queue, or marks it as failed if it has been attempted max_attempts times.
+        """
+        status = FAILED if job.attempts >= self.max_attempts else PENDING
+        with self._transaction() as connection:
+            connection.execute("UPDATE jobs SET status = ?, error = ?, lease_expires = NULL "
+                               "WHERE job_id = ? AND status = ? AND lease_token = ?",
+                               (status, error, job.job_id, LEASED, job.lease_token))
+        get_metrics().count("queue_jobs_failed" if status == FAILED else "queue_job_retries", stage="process_video")
+
+    def counts(self, level: int | None = None) -> dict[str, int]:
+        """
+        Returns the number of jobs per status, of one level or of all levels.
+        """
+        query = "SELECT status, COUNT(*) FROM jobs" + (" WHERE level = ?" if level is not None else "") \
+            + " GROUP BY status"
+        with self._lock:
+            return dict(self._connection.execute(query, (level,) if level is not None else ()).fetchall())
+
+    def is_drained(self, level: int) -> bool:
+        """
+        Returns True if no job of the level is pending or leased.
+        """
+        counts = self.counts(level)
+        return not counts.get(PENDING) and not counts.get(LEASED)
+
+    def wait_until_drained(self, level: int) -> None:
+        """
+        Waits until all jobs of a level are done or failed, logging the progress.
+        """
+        while not self.is_drained(level):
+            logging.info(f"Waiting for the jobs of level {level}: {self.counts(level)}")
+            time.sleep(self.poll_interval)
+
+    def commit_level(self, level: int, content_manager: ContentManager) -> int:
+        """
+        Commits the results of the done jobs of a level to the content manager, in the order they were enqueued,
+        so narrative IDs do not depend on which worker finished first. Videos that the content manager already has
+        (e.g. committed before the coordinator was interrupted) are not added again.
+
+        Returns:
+        int: The number of videos committed.
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT job_id, video, search_term, result FROM jobs "
+                                            "WHERE level = ? AND status = ? ORDER BY job_id", (level, DONE)).fetchall()
+        committed = 0
+        for job_id, video_data, search_term, result in rows:
+            video = ContentManager._convert_dict_to_video(json.loads(video_data))
+            if result is not None and not content_manager.contains_video(video):
+                result = json.loads(zlib.decompress(result))
+                video.transcript = result["transcript"]
+                content_manager.add_video_narratives(video, result["narratives"], search_term, level)
+                committed += 1
+            with self._transaction() as connection:
+                connection.execute("UPDATE jobs SET status = ?, result = NULL WHERE job_id = ?", (COMMITTED, job_id))
+        return committed
+
+    def clear(self) -> None:
+        """
+        Removes all jobs, for a new crawl.
+        """
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM jobs")
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+def _dumps(data) -> str:
+    return json.dumps(data, default=ContentManager._json_serialize)
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def open_shared_caches() -> None:
+    """
+    Opens the LLM cache, the search cache and the transcript store at their default paths with the rollback
+    journal instead of WAL, so the coordinator and the workers can share them, also across hosts. Call it before
+    the caches are first used, in the coordinator and in every worker process.
+    """
+    for path in (llm_gateway.DEFAULT_CACHE_PATH, search_cache.DEFAULT_CACHE_PATH, transcript_store.DEFAULT_STORE_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    llm_gateway.set_llm_cache(LLMCache(llm_gateway.DEFAULT_CACHE_PATH, journal_mode='DELETE'))
+    search_cache.set_search_cache(search_cache.SearchCache(search_cache.DEFAULT_CACHE_PATH, journal_mode='DELETE'))
+    transcript_store.set_transcript_store(transcript_store.TranscriptStore(transcript_store.DEFAULT_STORE_PATH,
+                                                                           journal_mode='DELETE'))
+
+
+def run_worker(work_queue: WorkQueue,
+               worker_id: str | None = None,
+               batch_size: int = 1,
+               idle_timeout: float | None = None,
+               stop: threading.Event | None = None) -> int:
+    """
+    Processes jobs of a work queue: fetches the transcript of each leased video and extracts its narratives.
+    Retries are left to the queue, so a failing job is returned to the queue and may be done by another worker.
+
+    Args:
+    work_queue (WorkQueue): The work queue.
+    worker_id (str | None): Identifies the worker in the queue. Defaults to the host name and process ID.
+    batch_size (int): The number of jobs leased at a time.
+    idle_timeout (float | None): The worker stops when the queue has been empty for this many seconds. If None,
+    it runs until it is stopped.
+    stop (threading.Event | None): The worker stops when this event is set (for workers in threads).
+
+    Returns:
+    int: The number of jobs done.
+    """
+    # imported here, so the coordinator does not import the LLM libraries through this module
+    from narrative_extraction import fetch_video_narratives
+
+    worker_id = worker_id or default_worker_id()
+    done = 0
+    idle_since = time.monotonic()
+    while stop is None or not stop.is_set():
+        jobs = work_queue.lease(worker_id, batch_size)
+        if not jobs:
+            if idle_timeout is not None and time.monotonic() - idle_since >= idle_timeout:
+                return done
+            time.sleep(work_queue.poll_interval)
+            continue
+
+        for job in jobs:
+            try:
+                narrative_descriptions = fetch_video_narratives(job.video, max_retries=0)
+            except Exception as e:
+                work_queue.fail(job, f"{type(e).__name__}: {e}")
+                continue
+            if work_queue.complete(job, narrative_descriptions):
+                done += 1
+        idle_since = time.monotonic()
+    return done
+
+
+if __name__ == '__main__':
+    queue = WorkQueue()
+    for status, count in sorted(queue.counts().items()):
+        print(f"{status}: {count}")
@@ -1,7 +1,13 @@
-from duckduckgo_search import DDGS
 from datetime import datetime
+
 from dateutil import parser
+from duckduckgo_search import DDGS
+from duckduckgo_search.exceptions import DuckDuckGoSearchException
 
+from cassette import through_cassette
+from metrics import get_metrics
+from rate_limiter import get_rate_limiter
+from search_cache import get_search_cache
 from video import Video
 
 
@@ -11,6 +17,11 @@ def search_videos(search_term: str, start_date: datetime, max_results: int):
     Yields a dictionary of video information if the video is published by YouTube, has a description,
     and is published on or after the start date.
 
+    Search results are cached (see search_cache.py): a search with the same normalized search term, start date and
+    max_results is answered from the cache until it expires. Results are only cached if all are consumed.
+    Searches go through the shared DuckDuckGo rate limiter, which throttles them and retries rate-limit blocks.
+    When a cassette is active (see cassette.py), the search is recorded to or replayed from the cassette.
+
     Args:
     search_term (str): The search term to query for videos.
     start_date (datetime): The starting date to filter videos.
@@ -19,17 +30,36 @@ def search_videos(search_term: str, start_date: datetime, max_results: int):
     Yields:
     dict: A dictionary containing information about each video that meets the criteria.
     """
-    with DDGS() as ddgs:
-        ddgs_videos_gen = ddgs.videos(
-            search_term,
-            safesearch="off",
-            duration="medium",  # exclude shorts; longer videos are rare anyway, so no problem they are excluded as well
-            max_results=max_results,
-        )
-        for r in ddgs_videos_gen:
-            published_date = parser.parse(r['published'])
-            if published_date >= start_date and r['publisher'] == 'YouTube' and r['description']:
-                yield Video.from_search_data(r)
+    cache = get_search_cache()
+    cached_results = cache.get(search_term, start_date, max_results) if cache else None
+    if cached_results is not None:
+        get_metrics().count("search_cache_hits", stage="search")
+        for r in cached_results:
+            yield Video.from_search_data(r)
+        return
+
+    def search():
+        with DDGS() as ddgs:
+            return list(ddgs.videos(
+                search_term,
+                safesearch="off",
+                duration="medium",  # exclude shorts; longer videos are rare anyway, so no problem they are excluded too
+                max_results=max_results,
+            ))
+
+    # DuckDuckGo reports rate-limit blocks and network errors with the same exception, so all of them are retried
+    rate_limiter = get_rate_limiter("duckduckgo", is_retryable=lambda e: isinstance(e, DuckDuckGoSearchException))
+    with get_metrics().stage("search"):
+        search_results = through_cassette("search", f"{search_term}|{start_date.isoformat()}|{max_results}",
+                                          lambda: rate_limiter.call(search))
+    results = []
+    for r in search_results:
+        published_date = parser.parse(r['published'])
+        if published_date >= start_date and r['publisher'] == 'YouTube' and r['description']:
+            results.append(r)
+            yield Video.from_search_data(r)
+    if cache:
+        cache.put(search_term, start_date, max_results, results)
 
 
 if __name__ == '__main__':